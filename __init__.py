@@ -1,7 +1,17 @@
 from .util import get_EUR, json_mod, get_btc_rates
+from .store import (
+    TradeStore, load_store, write_store, append_journal, journal_size)
+from . import store
+from . import candles
+from . import indicators
+from . import perf
+from .orders import OrderHistory, CostBasis, Ledger
+from .balances import BalanceHistory
 
 import logging as log
 import threading
+from collections import namedtuple
+from types import MappingProxyType
 import os
 import time
 import numpy as np
@@ -47,24 +57,52 @@ def sma(data, N):
     return (cumsum[N:] - cumsum[:-N]) * N_ret
 
 
+@perf.timed()
 def ema(data, alpha):
     ''' returns eponential moving average
+        y[i] = alpha * x[i] + (1 - alpha) * y[i - 1], y[-1] = x[0]
+        The recursion is solved in blocks of length L: inside a block
+        y[k] = beta^(k+1) * c + alpha * beta^k * cumsum(x[j] / beta^j)
+        with beta = 1 - alpha and c being the last value of the previous
+        block. L is chosen so that beta^-L stays small enough not to cost
+        precision, only the carries c are computed sequentially.
     '''
-    alpha_n = 1 - alpha
-    result = []
-    n = data[0]
-    for x in data:
-        n = alpha * x + alpha_n * n
-        result.append(n)
-    return result
-
-
+    x = np.asarray(data, dtype=np.float64)
+    if not len(x): return x.copy()
+    beta = 1. - alpha
+    if beta <= 0.: return x.copy()
+    if beta >= 1.: return np.full_like(x, x[0])
+    block = int(max(1, min(len(x), np.log(1e4) / -np.log(beta))))
+    blocks = -(-len(x) // block)
+    powers = beta ** np.arange(1, block + 1)     # beta^(k+1)
+
+    weights = beta / powers                      # beta^-j
+    result = np.zeros(blocks * block)
+    result[:len(x)] = x
+    result = result.reshape(blocks, block)
+
+    # last value of each block for c = 0, then the carries
+    lasts = (result @ weights) * (alpha * powers[-1] / beta)
+    carries = np.empty(blocks)
+    carry = x[0]
+    factor = powers[-1]
+    for i, last in enumerate(lasts):
+        carries[i] = carry
+        carry = last + factor * carry
+
+    # beta^(k+1) * c == alpha * beta^k * (beta * c / alpha)
+    result *= weights
+    result[:, 0] += carries * (beta / alpha)
+    np.cumsum(result, axis=1, out=result)
+    result *= alpha / weights
+    return result.reshape(-1)[:len(x)]
+
+
+@perf.timed()
 def vema(totals, amounts, a):
     ''' returns the volume weighted eponential moving average
     '''
-    smooth_totals = ema(totals, a)
-    smooth_amounts = ema(amounts, a)
-    return [t / c for t, c in zip(smooth_totals, smooth_amounts)]
+    return ema(totals, a) / ema(amounts, a)
 
 
 def trim(*lists):
@@ -82,6 +120,10 @@ def trim(*lists):
 
 
 def sum_trades(history: list) -> tuple:
+    if isinstance(history, TradeStore):
+        if not history: return 0.0, 0.0, +99999999, -99999999
+        return (float(history.total.sum()), float(history.amount.sum()),
+                float(history.rate.min()), float(history.rate.max()))
     total = 0.0
     amount = 0.0
     min_rate = +99999999
@@ -113,150 +155,212 @@ def extract_coin_data(ticker_data):
     return coins
 
 
+class Snapshot(namedtuple('Snapshot', (
+        'balances', 'trade_history', 'open_orders', 'available_coins',
+        'available_markets', 'btc_usd_price', 'eur_price', 'ledger'))):
+    ''' Consistent state of TraderData at one point in time. Snapshots get
+        replaced as a whole and never modified, so they can be read from
+        any thread without locking. '''
+    __slots__ = ()
+
+    @classmethod
+    def empty(cls):
+        return cls(balances=MappingProxyType({}),
+                   trade_history=MappingProxyType({}),
+                   open_orders=MappingProxyType({}),
+                   available_coins=MappingProxyType({}),
+                   available_markets=frozenset(),
+                   btc_usd_price=0., eur_price=0.,
+                   ledger=Ledger.empty())
+
+
 class TraderData:
+    ''' Personal and market data needed for trading. The update_*()
+        methods can run concurrently (e.g. by a live.Scheduler with
+        refresh_jobs()), each one publishes a new Snapshot while readers
+        keep using the one they took. '''
+    # default seconds between two updates (see refresh_jobs())
+    REFRESH_INTERVALS = {
+        'available_markets': 300,
+        'balances': 30,
+        'trade_history': 120,
+        'open_orders': 10,
+        'btc_usd_rate': 300,
+    }
+
     def __init__(self):
-        self._last_thread = None
-        self._balances = {}
-        self._trade_history = {}
-        self._btc_usd_price = 0.
-        self._eur_price = 0.
-        self._open_orders = []
-        self._available_coins = {}
-        self._available_markets = set()
+        self._snapshot = Snapshot.empty()
+        # serializes publishing new snapshots only, never network calls
+        self._publish_lock = threading.Lock()
+        # serializes updating the cost basis (from update_trade_history() and
+        # load()) - readers use the Ledger published with the snapshot
+        self._ledger_lock = threading.Lock()
+        self._orders = OrderHistory()
+        self._cost_basis = CostBasis()
+        self._balance_history = BalanceHistory()
         self._market_history = {}
 
-    def _called_from_same_thread(self):
-        thread_id = threading.current_thread().ident
-        if not self._last_thread:
-            self._last_thread = thread_id
-        return self._last_thread == thread_id
+    def snapshot(self) -> Snapshot:
+        return self._snapshot
+
+    def _publish(self, **changes):
+        with self._publish_lock:
+            self._snapshot = self._snapshot._replace(**changes)
 
     def create_trade_history(self, market, max_duration=24*3600):
         new_market = TradeHistory(market, history_max_duration=max_duration)
+        new_market.add_indicator('vwap50', indicators.VWAP(50))
+        new_market.add_indicator('min50', indicators.RollingMin(50))
+        new_market.add_indicator('max50', indicators.RollingMax(50))
         self._market_history[market] = new_market
         return new_market
 
     def update_available_markets(self, api):
-        assert(self._called_from_same_thread())
         ticker = api.get_ticker()
-        self._available_coins = extract_coin_data(ticker)
-        self._available_markets = set(ticker.keys())
+        self._publish(
+            available_coins=MappingProxyType(extract_coin_data(ticker)),
+            available_markets=frozenset(ticker.keys()))
 
     def update_balances(self, api):
-        assert(self._called_from_same_thread())
-        self._balances = api.get_balances()
+        balances = api.get_balances()
+        self._publish(balances=MappingProxyType(balances))
+        self._balance_history.record(balances)
 
     def update_trade_history(self, api):
-        assert(self._called_from_same_thread())
-        # trade history is not a list!
-        #last_order_time = (self._trade_history[-1]['time']
-        #                   if self._trade_history else 0)
-        #self._trade_history = merge_time_list(
-        #    self._trade_history, api.get_order_history())
-        self._trade_history = api.get_order_history()
+        # only trades newer than the stored ones get fetched
+        self._orders.sync(api)
+        with self._ledger_lock:
+            self._cost_basis.update(self._orders)
+            ledger = self._cost_basis.ledger()
+        self._publish(trade_history=MappingProxyType(self._orders.trades()),
+                      ledger=ledger)
 
     def update_open_orders(self, api):
-        assert(self._called_from_same_thread())
-        self._open_orders = api.get_open_orders()
+        self._publish(open_orders=MappingProxyType(api.get_open_orders()))
 
     def update_btc_usd_rate(self):
-        assert(self._called_from_same_thread())
-        self._btc_usd_price, self._eur_price = get_btc_rates()
+        btc_usd_price, eur_price = get_btc_rates()
+        self._publish(btc_usd_price=btc_usd_price, eur_price=eur_price)
+
+    def refresh_jobs(self, api, intervals=None) -> dict:
+        ''' returns name -> (interval in seconds, function) for all update_*()
+            methods, with default intervals overridden by @intervals '''
+        intervals = dict(self.REFRESH_INTERVALS, **(intervals or {}))
+        return {
+            'available_markets': (intervals['available_markets'],
+                                  lambda: self.update_available_markets(api)),
+            'balances': (intervals['balances'],
+                         lambda: self.update_balances(api)),
+            'trade_history': (intervals['trade_history'],
+                              lambda: self.update_trade_history(api)),
+            'open_orders': (intervals['open_orders'],
+                            lambda: self.update_open_orders(api)),
+            'btc_usd_rate': (intervals['btc_usd_rate'],
+                             self.update_btc_usd_rate)}
 
     def available_coins(self) -> dict:
-        return self._available_coins
+        return self._snapshot.available_coins
 
     def available_markets(self) -> set:
-        return self._available_markets
+        return self._snapshot.available_markets
 
     def balances(self, market=None):
-        return self._balances[market] if market else self._balances
+        balances = self._snapshot.balances
+        return balances[market] if market else balances
 
     def trade_history(self):
-        return self._trade_history
+        return self._snapshot.trade_history
+
+    def balance_history(self) -> BalanceHistory:
+        return self._balance_history
+
+    def ledger(self) -> Ledger:
+        return self._snapshot.ledger
 
     def open_orders(self):
-        return self._open_orders
+        return self._snapshot.open_orders
 
     def btc_usd_price(self):
-        return self._btc_usd_price
+        return self._snapshot.btc_usd_price
 
     def btc_eur_price(self):
-        return self._eur_price
+        return self._snapshot.eur_price
 
     def load(self):
+        self._orders.load()
+        balances = {}
         try:
             with open('personal.json') as f:
                 personal_data = json_mod.load(f)
-                self._balances = personal_data['balances']
-                self._trade_history = personal_data['trade_history']
+                balances = personal_data['balances']
+                # older versions stored the trade history here
+                if not len(self._orders):
+                    self._orders.merge(personal_data.get('trade_history', {}))
         except FileNotFoundError:
             pass
+        with self._ledger_lock:
+            self._cost_basis.update(self._orders)
+            ledger = self._cost_basis.ledger()
+        self._publish(balances=MappingProxyType(balances),
+                      trade_history=MappingProxyType(self._orders.trades()),
+                      ledger=ledger)
 
     def save(self):
         #        os.makedirs('personal', exist_ok=True)
         with open('personal.json', 'w') as f:
-            json_mod.dump({'balances': self._balances,
-                       'trade_history': self._trade_history}, f)
+            json_mod.dump({'balances': dict(self._snapshot.balances)}, f)
 
-    def get_asset_cost(self, coin):
-        ''' returns cost for given asset in BTC
+    def get_asset_cost(self, coin, snapshot=None):
+        ''' returns cost for given asset in BTC (FIFO, including fees)
         '''
-        if not self._balances: return 0
-        if not coin in self._balances: return 0
-        if not self._trade_history: return 0
-        if coin == 'BTC': return self._balances[coin]
-        history = self._trade_history['BTC_' + coin]
-        #print(list(self._trade_history.keys()))
-        #print(coin, self._balances[coin])
-        asset = self._balances[coin]
-        cost = 0.
-        for h in history:
-            if h['type'] == 'sell': continue
-            assert h['type'] == 'buy'
-            #print(h['time'], h['type'], h['amount'], h['total'])
-            if asset > h['amount']:
-                cost += h['total']  # todo: +fee?
-                asset -= h['amount']
-            else:
-                cost += h['total'] / h['amount'] * asset  # todo: +fee?
-                break
-        return cost
-
+        snapshot = snapshot or self._snapshot
+        balances = snapshot.balances
+        if not balances: return 0
+        if not coin in balances: return 0
+        if coin == 'BTC': return balances[coin]
+        # the balance might be smaller than what's been bought (withdrawals)
+        return snapshot.ledger.cost('BTC_' + coin, balances[coin])
 
     def get_current_rate(self, market):
         # ==> move to TraderStrategy
         try:
-            total, amount, minr, maxr = sum_trades(self._market_history[market].data()[-50:])
+            history = self._market_history[market]
         except KeyError as exc:
             raise ValueError('market %r not subscribed' % market) from exc
-        return total / amount, minr, maxr
+        # kept up to date by the history for the last 50 trades
+        return (history.indicator('vwap50').value(),
+                history.indicator('min50').value(),
+                history.indicator('max50').value())
 
     def suggest_order(self, *,
                     sell: tuple, buy: str,
                     suggestion_factor: float) -> dict:
         # ==> move to TraderStrategy
-        if not self._balances or not self._available_coins:
+        # one snapshot for all checks - updates can happen meanwhile
+        snapshot = self._snapshot
+        balances, available_coins = (snapshot.balances,
+                                     snapshot.available_coins)
+        if not balances or not available_coins:
             raise RuntimeError('not ready')
 
         amount, what_to_sell = sell
         log.info('try to sell %f %r for %r', amount, what_to_sell, buy)# todo: correct
 
-        if not what_to_sell in self._balances:
+        if not what_to_sell in balances:
             raise ValueError(
                 'You do not have %r to sell' % what_to_sell)
-        log.info('> you have %f %r', self._balances[what_to_sell], what_to_sell)
-        if self._balances[what_to_sell] < amount:
+        log.info('> you have %f %r', balances[what_to_sell], what_to_sell)
+        if balances[what_to_sell] < amount:
             raise ValueError(
                 'You do not have enough %r to sell (just %f)' % (
-                    what_to_sell, self._balances[what_to_sell]))
+                    what_to_sell, balances[what_to_sell]))
 
-        if (what_to_sell in self._available_coins and
-                buy in self._available_coins[what_to_sell]):
+        if (what_to_sell in available_coins and
+                buy in available_coins[what_to_sell]):
             market = what_to_sell + '_' + buy
             action = 'buy'
-        elif (buy in self._available_coins and
-                  what_to_sell in self._available_coins[buy]):
+        elif (buy in available_coins and
+                  what_to_sell in available_coins[buy]):
             market = buy + '_' + what_to_sell
             action = 'sell'
         else:
@@ -282,13 +386,28 @@ class TraderData:
 
 
 class TradeHistory:
+    COMPACT_MIN_JOURNAL_SIZE = 4 * 1024 * 1024
+    # bounds for the adaptive fetch window
+    MIN_WINDOW_SEC = 60
+    MAX_WINDOW_SEC = 30 * 24 * 3600
+
     def __init__(self, market, *,
                  step_size_sec=3600,
                  history_max_duration=24*3600,
                  update_threshold=60):
         self._market = market
-        self._hdata = []
+        self._hdata = TradeStore()
+        # changes not saved yet, None if a complete write is needed
+        self._journal = None
+        self._candles = candles.CandlePyramid()
+        self._indicators = {}
         self._step_size_sec = step_size_sec
+        # size of the next window to fetch, adapted to the trade rate
+        self._window_sec = step_size_sec
+        # sorted [begin, end] time ranges inside the history which are
+        # known to be incomplete
+        self._gaps = []
+        self._saved_gaps = []
         self._update_threshold_sec = update_threshold
         self._history_max_duration = history_max_duration
 
@@ -298,12 +417,72 @@ class TradeHistory:
     def friendly_name(self):
         return '/'.join(get_long_name(c) for c in self._market.split('_'))
 
+    @staticmethod
+    def stored_markets(directory='.') -> set:
+        ''' returns the names of all markets with saved trade history '''
+        return {f.split('.')[0].split('-')[1]
+                for f in os.listdir(directory)
+                if f.startswith('trade_history-') and
+                (f.endswith('.json') or '.' not in f)}
+
+    def _store_dir(self, directory):
+        return os.path.join(directory, 'trade_history-%s' % self._market)
+
+    def _candles_file(self, directory):
+        return os.path.join(self._store_dir(directory), 'candles.npz')
+
+    def _gaps_file(self, directory):
+        return os.path.join(self._store_dir(directory), 'gaps.json')
+
+    def _load_gaps(self, directory):
+        try:
+            with open(self._gaps_file(directory)) as f:
+                self._gaps = [list(g) for g in json_mod.load(f)]
+        except FileNotFoundError:
+            self._gaps = []
+        self._saved_gaps = [list(g) for g in self._gaps]
+
+    def _save_gaps(self, directory):
+        if self._gaps == self._saved_gaps: return
+        filename = self._gaps_file(directory)
+        with open(filename + '.tmp', 'w') as f:
+            json_mod.dump(self._gaps, f)
+        os.replace(filename + '.tmp', filename)
+        self._saved_gaps = [list(g) for g in self._gaps]
+
+    def gaps(self) -> list:
+        ''' returns the (begin, end) time ranges known to be incomplete '''
+        return [tuple(g) for g in self._gaps]
+
+    def _json_file(self, directory):
+        return os.path.join(directory, 'trade_history-%s.json' % self._market)
+
+    @perf.timed()
     def load(self, directory='.'):
+        ''' loads (memory maps) the binary history and falls back to the
+            old JSON format '''
         try:
-            filename = os.path.join(
-                directory, 'trade_history-%s.json' % self._market)
-            with open(filename) as f:
-                self._hdata = json_mod.load(f)
+            self._hdata = load_store(self._store_dir(directory))
+            self._journal = []
+            self._load_gaps(directory)
+            if self._candles.load(self._candles_file(directory)):
+                self._candles.catch_up(self._hdata)
+            else:
+                self._candles.rebuild(self._hdata)
+            self._refeed_indicators()
+            return
+        except FileNotFoundError:
+            pass
+        except ValueError as exc:
+            log.error(
+                'could not load TradeHistory for %r: %r', self._market, exc)
+            raise
+        try:
+            with open(self._json_file(directory)) as f:
+                self._hdata = TradeStore.from_dicts(json_mod.load(f))
+                self._journal = None
+                self._candles.rebuild(self._hdata)
+                self._refeed_indicators()
         except FileNotFoundError:
             pass
         except ValueError as exc:
@@ -311,15 +490,52 @@ class TradeHistory:
                 'could not load TradeHistory for %r: %r', self._market, exc)
             raise
 
+    @perf.timed()
     def save(self, directory='.'):
-        filename = os.path.join(
-            directory, 'trade_history-%s.json' % self._market)
+        ''' writes only the changes since the last save() to the journal
+            and compacts the history once the journal has grown too big '''
+        store_dir = self._store_dir(directory)
+        if self._journal is None or not os.path.isdir(store_dir):
+            self.compact(directory)
+            return
+        if self._journal:
+            append_journal(store_dir, self._journal)
+            self._journal = []
+        self._save_gaps(directory)
+        if journal_size(store_dir) > max(
+                self.COMPACT_MIN_JOURNAL_SIZE, self._hdata.nbytes() // 4):
+            self.compact(directory)
+
+    @perf.timed()
+    def compact(self, directory='.'):
+        ''' rewrites the complete history and drops the journal '''
         os.makedirs(directory, exist_ok=True)
-        with open(filename, 'w') as f:
-            json_mod.dump(self._hdata, f)
+        write_store(self._hdata, self._store_dir(directory))
+        self._journal = []
+        self._saved_gaps = None
+        self._save_gaps(directory)
+        # candles are only saved here - load() catches up from the trades
+        self._candles.save(self._candles_file(directory))
+
+    def _log_change(self, kind, value):
+        if self._journal is not None:
+            self._journal.append((kind, value))
+
+    @staticmethod
+    def convert_json(market, directory='.') -> 'TradeHistory':
+        ''' converts trade_history-<market>.json to the binary format '''
+        history = TradeHistory(market)
+        with open(history._json_file(directory)) as f:
+            history._hdata = TradeStore.from_dicts(json_mod.load(f))
+        history.compact(directory)
+        return history
 
     def clear(self):
-        self._hdata = []
+        self._hdata = TradeStore()
+        self._journal = None
+        self._gaps = []
+        self._candles.clear()
+        self._refeed_indicators()
 
     def __str__(self):
         return self.__repr__()
@@ -328,50 +544,126 @@ class TradeHistory:
         return 'TradeHistory(%r, duration=%.1fmin, len=%d)' % (
             self._market, self.duration() / 60, len(self._hdata))
 
-    def fetch_next(self, *, api, max_duration=None, only_old=False):
+    @perf.timed()
+    def fetch_next(self, *, api, max_duration=None, only_old=False,
+                   only_new=False):
+        ''' fetches one window of trades - new ones first, then gaps, then
+            older ones (unless @only_new). The window size adapts to the
+            trade rate so that responses stay below api.TRADE_HISTORY_LIMIT
+            and trades cut off anyway are remembered as gap. Without
+            @max_duration the history gets trimmed to history_max_duration.
+            Returns False if there was nothing to do. '''
         now = time.time()
         log.debug('update trade history for %r after %d seconds',
                  self._market, now - self.last_time())
 
-        if self._hdata and now - self.last_time() > 6 * 3600:
-            # last update too long ago to fill the gap (for now)
-            #self.clear()
-            log.warning('big gap')
-
+        gap = None
         if not self._hdata:
-            log.debug('fetch_next: there is no data yet - fetch an hour')
-            start = 0 if max_duration else now - self._step_size_sec
+            log.debug('fetch_next: there is no data yet - fetch a window')
+            start = now - self._window_sec
             end = time.time() + 60
         elif not only_old and now - self.last_time() > self._update_threshold_sec:
             log.debug('fetch_next: more than a couple of seconds have passed '
                       'since last update - do an update now')
             start = self.last_time()
             end = time.time() + 60
+        elif self._gaps:
+            gap = self._gaps[-1]
+            log.debug('fetch_next: fill gap %r', gap)
+            # big gaps get filled from their end in adaptive windows
+            start, end = max(gap[0], gap[1] - self._window_sec), gap[1]
+        elif only_new:
+            return False
         elif max_duration or now - self.first_time() < self._history_max_duration:
             log.debug("fetch_next: we don't need to update recent parts of the "
                       "graph - fetch older data instead.")
-            start = 0 if max_duration else self.first_time() - self._step_size_sec
+            start = self.first_time() - self._window_sec
             end = self.first_time()
         else:
             log.debug("fetch_next: no need to update anything - just exit")
             return False
 
-        new_data = api.get_trade_history(*self._market.split('_'), start, end)
-        try:
-            self._attach_data(new_data)
-        except DiscontiguousLists:
-            log.warning(
-                'lists are discontiguous after update (%.2fh)- clear data',
-                (now - self.last_time()) / 3600)
-            self._hdata = new_data
+        new_data, truncated = api.get_trade_window(self._market, start, end)
+        # a truncated response contains the newest trades of the window
+        # only, so [start, new_data.time[0]] is missing
+        complete_since = (float(new_data.time[0]) if truncated and new_data
+                          else start)
+        self._adapt_window(len(new_data), end - complete_since, truncated,
+                           api.TRADE_HISTORY_LIMIT // 2)
+
+        if gap is not None:
+            self._fill_gap(gap, new_data, complete_since)
+        else:
+            first_time = self.first_time()
+            inside = bool(self._hdata) and start >= first_time
+            if new_data:
+                self._attach_data(new_data, allow_gap=True)
+            if inside and complete_since > start:
+                log.warning('%r: trades between %.0f and %.0f are missing - '
+                            'will be fetched later', self._market,
+                            start, complete_since)
+                self._gaps.append([start, complete_since])
+                self._gaps.sort()
+            elif (end == first_time and self.first_time() >= first_time and
+                  end - start >= self.MAX_WINDOW_SEC):
+                log.info('%r: no trades before %.0f', self._market, end)
+                return False
         if not max_duration:
+            first_gid = self._hdata.gid[0] if self._hdata else 0
             self._hdata = self.trim(self._hdata,  self._history_max_duration)
+            if self._hdata and self._hdata.gid[0] != first_gid:
+                self._log_change(store.DROP, self._hdata.gid[0])
+                self._gaps = [[max(b, self.first_time()), e]
+                              for b, e in self._gaps if e > self.first_time()]
 
         return True
 
+    def _adapt_window(self, count, span, truncated, target):
+        ''' sizes the next window to contain about @target trades given
+            @count trades in the last @span seconds - changes at most by a
+            factor of 4 per step '''
+        if count < 2 or span <= 0:
+            window = self._window_sec * 4
+        else:
+            window = span * target / count
+        window = max(self._window_sec / 4, min(window, self._window_sec * 4))
+        if truncated:
+            window = min(window, span / 2)
+        self._window_sec = max(self.MIN_WINDOW_SEC,
+                               min(window, self.MAX_WINDOW_SEC))
+
+    @perf.timed()
+    def _fill_gap(self, gap, data, complete_since):
+        ''' puts @data into the middle of the history and shrinks @gap to
+            what is still missing '''
+        begin, _ = gap
+        if complete_since > begin:
+            gap[1] = complete_since
+        else:
+            self._gaps.remove(gap)
+        if not data: return
+        first = self._hdata.index_of_gid(data.gid[0])
+        last = self._hdata.index_of_gid(data.gid[-1] + 1)
+        tail = TradeStore({key: np.array(values) for key, values
+                           in self._hdata[last:].columns().items()})
+        self._hdata.truncate(first)
+        self._hdata.append(data)
+        self._hdata.append(tail)
+        # journaled as replacing everything from the gap on - costs the
+        # trades behind the gap instead of a rewrite of the whole history
+        self._log_change(store.APPEND, TradeStore(
+            {key: np.array(values) for key, values
+             in self._hdata[first:].columns().items()}))
+        self._candles.update(self._hdata, data.time[0], data.time[-1])
+        self._refeed_indicators()
+
     @staticmethod
     def trim(data, duration):
         if TradeHistory.list_duration(data) <= duration: return data
+        if isinstance(data, TradeStore):
+            low = data.index_of_time(data.time[-1] - duration)
+            data.drop_front(max(low - 1, 0))
+            return data
         low = 0
         high = len(data) - 1
         current = high
@@ -394,11 +686,11 @@ class TradeHistory:
 
     def first_time(self):
         if not self._hdata: return 0.
-        return self._hdata[0]['time']
+        return float(self._hdata.time[0])
 
     def last_rate(self):
         if not self._hdata: return 0.
-        return self._hdata[-1]['total'] / self._hdata[-1]['amount']
+        return float(self._hdata.total[-1] / self._hdata.amount[-1])
 
     def get_current_rate(self):
         total, amount, minr, maxr = sum_trades(self._hdata[-20:])
@@ -406,89 +698,128 @@ class TradeHistory:
 
     def last_time(self):
         if not self._hdata: return 0.
-        return self._hdata[-1]['time']
+        return float(self._hdata.time[-1])
 
     @staticmethod
     def list_duration(data):
         if not data: return 0
+        if isinstance(data, TradeStore):
+            return float(data.time[-1] - data.time[0])
         return data[-1]['time'] - data[0]['time']
 
     def duration(self):
         return self.list_duration(self._hdata)
 
-    def _attach_data(self, data):
+    @perf.timed()
+    def _attach_data(self, data, *, allow_gap=False):
+        ''' merges @data into the history - if @allow_gap is set @data
+            doesn't have to overlap with it '''
         if not data:
             log.warning('_attach_data tries to handle an empy list')
             return
+        data = TradeStore.from_dicts(data)
+        perf.count('trades.attached', len(data))
         if not self._hdata:
             self._hdata = data
+            self._log_change(store.APPEND, data)
+            self._candles.rebuild(data)
+            self._refeed_indicators()
             return
 
         # check contiguousity
         # good:    [......(.].....)
         # bad:     [......].(.....)
         # bad too: [......](......)
-        if (data[0]['time'] > self._hdata[-1]['time'] or
-            self._hdata[0]['time'] > data[-1]['time']):
+        if not allow_gap and (data.time[0] > self._hdata.time[-1] or
+                              self._hdata.time[0] > data.time[-1]):
             raise DiscontiguousLists('lists are discontiguous')
 
         # check merge contains new data
         # bad: [..(..)..]
-        assert (data[0]['time'] <= self._hdata[0]['time'] or
-                data[-1]['time'] >= self._hdata[-1]['time'])
-
-        def merge(list1, list2):
-            def find(lst, key, value):
-                for i, dic in enumerate(lst):
-                    if dic[key] == value:
-                        return i
-                return -1
-            return (list1[:find(list1, 'globalTradeID',
-                                list2[0]['globalTradeID'])] +
-                    list2)
-
-        self._hdata = (merge(data, self._hdata)
-                       if data[0]['time'] < self._hdata[0]['time'] else
-                       merge(self._hdata, data))
+        assert (data.time[0] <= self._hdata.time[0] or
+                data.time[-1] >= self._hdata.time[-1])
+
+        # both lists are ordered by globalTradeID so the splice points can
+        # be bisected - cost is O(len(data) + log(len(self._hdata)))
+        if data.time[0] < self._hdata.time[0]:
+            # data[:i] + hdata
+            segment = data[:data.index_of_gid(self._hdata.gid[0])]
+            old_count = len(self._hdata)
+            self._hdata.prepend(segment)
+            self._log_change(store.PREPEND, segment)
+            # only indicators looking further back than the old data
+            # are affected by older trades
+            self._refeed_indicators(
+                lambda i: i.window is None or i.window > old_count)
+        else:
+            # hdata[:i] + data
+            last_gid = self._hdata.gid[-1]
+            self._hdata.truncate(self._hdata.index_of_gid(data.gid[0]))
+            self._hdata.append(data)
+            self._log_change(store.APPEND, data)
+            new_trades = self._hdata[self._hdata.index_of_gid(last_gid + 1):]
+            for indicator in self._indicators.values():
+                indicator.feed(new_trades)
+        self._candles.update(self._hdata, data.time[0], data.time[-1])
+
+    def add_indicator(self, name, indicator):
+        ''' registers a streaming indicator (see mftl.indicators) which gets
+            updated with every new trade from now on. Indicators with a
+            window (including EMA and VEMA) get fed their window only when
+            they have to be rebuilt (on load() or when older trades get
+            prepended within their window). Cumulative ones (window None,
+            e.g. VWAP()) get fed the whole history then, and trades dropped
+            by trimming stay in their value until the next rebuild. '''
+        self._indicators[name] = indicator
+        self._refeed_indicators(lambda i: i is indicator)
+        return indicator
+
+    def indicator(self, name):
+        return self._indicators[name]
+
+    @perf.timed()
+    def _refeed_indicators(self, predicate=None):
+        for indicator in self._indicators.values():
+            if predicate and not predicate(indicator):
+                continue
+            indicator.reset()
+            indicator.feed(self._hdata if indicator.window is None else
+                           self._hdata[-indicator.window:])
 
     def get_plot_data(self, ema_factor=0.005, cut=50):
         if not self._hdata: return [], []
-        totals = [e['total'] for e in self._hdata]
-        amounts = [e['amount'] for e in self._hdata]
-        times = [e['time'] for e in self._hdata]
-        rates_vema = vema(totals, amounts, ema_factor)
+        times = self._hdata.time
+        rates_vema = vema(self._hdata.total, self._hdata.amount, ema_factor)
         return times[cut:], rates_vema[cut:]
 
+    @perf.timed()
+    def candles(self, interval='5m', *, start=None, end=None,
+                max_points=None) -> dict:
+        ''' returns OHLCV data for buckets of @interval in [@start, @end) as
+            dict of arrays (see candles.resample()). Candles are taken from
+            the candle pyramid if possible, which also covers trimmed data.
+            With @max_points given instead of @interval the coarsest
+            pyramid level providing that many candles gets chosen.
+        '''
+        if interval is None:
+            first, last = self._candles.covered() or (0., 0.)
+            interval = self._candles.level_for_span(
+                (last if end is None else end) -
+                (first if start is None else start), max_points)
+        if (self._candles.covered() and
+                self._candles.level_for(interval) is not None):
+            return self._candles.query(interval, start, end)
+        trades = self._hdata
+        if start is not None or end is not None:
+            trades = trades[trades.index_of_time(start or 0.):
+                            len(trades) if end is None else
+                            trades.index_of_time(end)]
+        return candles.resample(trades, interval)
+
+    @perf.timed()
     def rate_buckets(self, size=5*60):
-        result = []
-        current = None
-        totals_buy = amounts_buy = totals_sell = amounts_sell = 0.
-        for d in self._hdata:
-            t = int(d['time'] / size)
-            if t != current:
-                if current:
-                    result.append({'time': current*size,
-                                   'total_buy': totals_buy,
-                                   'amount_buy': amounts_buy,
-                                   'total_sell': totals_sell,
-                                   'amount_sell': amounts_sell,
-                                   #'open_buy': 0,
-                                   #'open_sell': 0,
-                                   #'close_buy': 0,
-                                   #'close_sell': 0,
-                                   #'high_buy': 0,
-                                   #'high_sell': 0,
-                                   #'low_buy': 0,
-                                   #'low_sell': 0,
-                                   })
-                totals_buy = amounts_buy = totals_sell = amounts_sell = 0.
-                current = t
-            if d['type'] == 'buy':
-                totals_buy += d['total']
-                amounts_buy += d['amount']
-            else:
-                assert d['type'] == 'sell'
-                totals_sell += d['total']
-                amounts_sell += d['amount']
-
-        return result
+        data = self.candles(size)
+        keys = ('time', 'total_buy', 'amount_buy', 'total_sell', 'amount_sell',
+                'open', 'high', 'low', 'close')
+        return [dict(zip(keys, values))
+                for values in zip(*(data[k].tolist() for k in keys))]
@@ -0,0 +1,240 @@
+''' vectorized backtests of moving average crossover strategies
+'''
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+__all__ = ['FEE', 'grid', 'moving_averages', 'signals', 'executed',
+           'evaluate', 'sweep', 'sweep_markets', 'ranked', 'RESULT_DTYPE']
+
+FEE = 0.9975
+
+BUY, SELL = 1, -1
+
+RESULT_DTYPE = np.dtype([
+    ('fast', np.int32), ('medium', np.int32), ('slow', np.int32),
+    ('gain', np.float64), ('trades', np.int32), ('drawdown', np.float64)])
+
+
+def grid(fast, medium, slow) -> np.ndarray:
+    ''' returns all (fast, medium, slow) combinations of the given window
+        sizes with fast < medium < slow as an (N, 3) array '''
+    f, m, s = np.meshgrid(np.asarray(fast), np.asarray(medium),
+                          np.asarray(slow), indexing='ij')
+    combinations = np.stack((f.ravel(), m.ravel(), s.ravel()), axis=1)
+    return combinations[(combinations[:, 0] < combinations[:, 1]) &
+                        (combinations[:, 1] < combinations[:, 2])]
+
+
+def moving_averages(rates, windows, length=None) -> np.ndarray:
+    ''' returns the simple moving averages of @rates for all @windows as
+        rows of one array, computed from one shared cumulative sum. Rows
+        end with the last rate and are @length long (defaults to what the
+        biggest window allows) '''
+    windows = np.asarray(windows, np.int64)
+    if length is None:
+        length = len(rates) - int(windows.max()) + 1
+    cumsum = np.cumsum(np.insert(np.asarray(rates, np.float64), 0, 0.))
+    end = cumsum[-length:]
+    starts = (len(cumsum) - length - windows)[:, None] + np.arange(length)
+    return (end - cumsum[starts]) / windows[:, None]
+
+
+def signals(fast, medium, slow) -> np.ndarray:
+    ''' returns BUY where @fast crosses @medium upwards while being above
+        @slow, SELL for the opposite and 0 otherwise (along the last axis) '''
+    result = _crossings(fast, medium)
+    result[(result == BUY) & ~(fast > slow)] = 0
+    result[(result == SELL) & ~(fast < slow)] = 0
+    return result
+
+
+def _crossings(fast, medium) -> np.ndarray:
+    above = fast >= medium
+    below = fast <= medium
+    result = np.zeros(np.shape(fast), np.int8)
+    result[..., 1:][above[..., 1:] & ~above[..., :-1]] = BUY
+    result[..., 1:][below[..., 1:] & ~below[..., :-1]] = SELL
+    return result
+
+
+def _executed(rows, columns, values) -> np.ndarray:
+    ''' returns a mask for the signals (sorted by row, column) which can
+        be executed, see executed() '''
+    if not len(rows): return np.zeros(0, bool)
+    first = np.r_[True, rows[1:] != rows[:-1]]
+    previous = np.r_[SELL, values[:-1]]
+    previous[first] = SELL
+    keep = values != previous
+    # drop the last action of a row if it's a buy
+    kept = np.flatnonzero(keep)
+    last = kept[np.r_[rows[kept][1:] != rows[kept][:-1], True]]
+    keep[last[values[last] == BUY]] = False
+    return keep
+
+
+def executed(signal) -> np.ndarray:
+    ''' reduces @signal to the actions which can actually be taken starting
+        without assets: signals repeating the previous action get dropped
+        and a final buy (no sell following) is dropped as well '''
+    signal = np.atleast_2d(signal)
+    rows, columns = np.nonzero(signal)
+    keep = _executed(rows, columns, signal[rows, columns])
+    result = np.zeros(signal.shape, np.int8)
+    result[rows[keep], columns[keep]] = signal[rows[keep], columns[keep]]
+    return result
+
+
+def _evaluate(count, rows, columns, values, log_rates, fee) -> tuple:
+    ''' evaluate() for @count rows of executed actions given as sorted
+        (@rows, @columns, @values) '''
+    trades = np.bincount(rows, minlength=count)
+    gain = np.exp(np.bincount(rows, -values * log_rates[columns],
+                              minlength=count) + trades * np.log(fee))
+    # the value only changes while holding - between a buy and a sell
+    holding = np.zeros((count, len(log_rates)), np.int8)
+    holding[rows, columns] = values
+    holding = np.cumsum(holding, axis=1, dtype=np.int8) > 0
+    value = np.zeros(holding.shape)
+    np.multiply(holding[:, :-1], np.diff(log_rates), out=value[:, 1:])
+    value[rows, columns] += np.log(fee)
+    np.cumsum(value, axis=1, out=value)
+    drawdown = 1. - np.exp(
+        (value - np.maximum.accumulate(value, axis=1)).min(axis=1))
+    return gain, trades, drawdown
+
+
+def evaluate(rates, actions, fee=FEE) -> tuple:
+    ''' returns gain (final amount / initial amount), number of trades and
+        maximum drawdown (of the value marked to market) for @actions (see
+        executed()) on @rates - one value per row '''
+    actions = np.atleast_2d(actions)
+    rows, columns = np.nonzero(actions)
+    return _evaluate(len(actions), rows, columns,
+                     actions[rows, columns].astype(np.float64),
+                     np.log(rates), fee)
+
+
+def _ranges(starts, counts):
+    ''' concatenated aranges [start, start + count) '''
+    offsets = np.cumsum(counts) - counts
+    return (np.repeat(starts - offsets, counts) +
+            np.arange(int(counts.sum())))
+
+
+def sweep(rates, combinations, fee=FEE, max_cells=4_000_000,
+          length=None) -> np.ndarray:
+    ''' backtests all (fast, medium, slow) @combinations (see grid()) on
+        @rates at once and returns an array of RESULT_DTYPE. All combinations
+        are evaluated on the last @length rates (defaults to what the biggest
+        window allows).
+        Moving averages are computed once per window size and crossings
+        once per (fast, medium) pair, @max_cells limits the size of the
+        intermediate (combinations x rates) arrays '''
+    combinations = np.atleast_2d(np.asarray(combinations, np.int64))
+    result = np.zeros(len(combinations), RESULT_DTYPE)
+    result['fast'], result['medium'], result['slow'] = combinations.T
+    if not len(combinations): return result
+    rates = np.asarray(rates, np.float64)
+    windows, index = np.unique(combinations, return_inverse=True)
+    index = index.reshape(combinations.shape)
+    if length is None:
+        length = len(rates) - int(windows[-1]) + 1
+    if length < 2 or length > len(rates) - int(windows[-1]) + 1:
+        raise ValueError('not enough data for window size %d' % windows[-1])
+    averages = moving_averages(rates, windows, length)
+    log_rates = np.log(rates[-length:])
+    step = max(1, max_cells // length)
+
+    # crossings of fast and medium averages as sorted (pair, column, value)
+    pairs, pair_of = np.unique(index[:, :2], axis=0, return_inverse=True)
+    pair_of = pair_of.ravel()
+    events = []
+    for first in range(0, len(pairs), step):
+        part = pairs[first:first + step]
+        crossings = _crossings(averages[part[:, 0]], averages[part[:, 1]])
+        rows, columns = np.nonzero(crossings)
+        events.append((rows + first, columns, crossings[rows, columns]))
+    pair_rows, pair_columns, pair_values = (
+        np.concatenate(e) for e in zip(*events))
+    pair_starts = np.searchsorted(pair_rows, np.arange(len(pairs)))
+    pair_counts = np.bincount(pair_rows, minlength=len(pairs))
+
+    for first in range(0, len(combinations), step):
+        part = index[first:first + step]
+        counts = pair_counts[pair_of[first:first + step]]
+        selected = _ranges(pair_starts[pair_of[first:first + step]], counts)
+        rows = np.repeat(np.arange(len(part)), counts)
+        columns = pair_columns[selected]
+        values = pair_values[selected]
+        fast = averages[part[rows, 0], columns]
+        slow = averages[part[rows, 2], columns]
+        valid = np.where(values == BUY, fast > slow, fast < slow)
+        rows, columns, values = rows[valid], columns[valid], values[valid]
+        keep = _executed(rows, columns, values)
+        gain, trades, drawdown = _evaluate(
+            len(part), rows[keep], columns[keep],
+            values[keep].astype(np.float64), log_rates, fee)
+        chunk = result[first:first + step]
+        chunk['gain'], chunk['trades'], chunk['drawdown'] = (
+            gain, trades, drawdown)
+    return result
+
+
+def ranked(results, key='gain') -> np.ndarray:
+    ''' returns @results (see sweep()) ordered by @key, best first '''
+    order = np.argsort(results[key], kind='stable')
+    return results[order if key == 'drawdown' else order[::-1]]
+
+
+# rates of all markets for the worker processes of sweep_markets()
+_SHARED = {}
+
+
+def _attach(filename, layout):
+    rates = np.load(filename, mmap_mode='r')
+    _SHARED.update({market: rates[offset:offset + count]
+                    for market, (offset, count) in layout.items()})
+
+
+def _sweep_job(market, combinations, fee, length):
+    return market, sweep(_SHARED[market], combinations, fee, length=length)
+
+
+def sweep_markets(series, combinations, *, fee=FEE, workers=None,
+                  jobs_per_market=None) -> dict:
+    ''' runs sweep() for all @combinations on the rates of every market in
+        @series (market -> rates) using @workers processes. The rates get
+        written once to a file all workers memory map, so they share the
+        same pages instead of getting copies. Returns market -> results of
+        RESULT_DTYPE. '''
+    combinations = np.atleast_2d(np.asarray(combinations, np.int64))
+    workers = workers or os.cpu_count() or 1
+    biggest = int(combinations.max()) if len(combinations) else 0
+    series = {market: np.asarray(rates, np.float64)
+              for market, rates in series.items() if len(rates) > biggest}
+    if not series or not len(combinations): return {}
+    # split the parameter sets so all workers have something to do
+    jobs_per_market = jobs_per_market or -(-2 * workers // len(series))
+    chunks = np.array_split(
+        combinations, min(jobs_per_market, len(combinations)))
+
+    layout, offset = {}, 0
+    for market, rates in series.items():
+        layout[market] = (offset, len(rates))
+        offset += len(rates)
+    results = {market: [] for market in series}
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'rates.npy')
+        np.save(filename, np.concatenate(list(series.values())))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach,
+                                 initargs=(filename, layout)) as executor:
+            futures = [
+                executor.submit(_sweep_job, market, chunk, fee,
+                                len(rates) - biggest + 1)
+                for market, rates in series.items() for chunk in chunks]
+            for future in futures:
+                market, result = future.result()
+                results[market].append(result)
+    return {market: np.concatenate(parts) for market, parts in results.items()}
@@ -0,0 +1,106 @@
+''' append-only history of our balances
+'''
+import os
+import time
+import numpy as np
+
+from ..downsample import minmax
+
+__all__ = ['BalanceHistory', 'RECORD_DTYPE']
+
+# one record per change of the balance of a coin - 16 bytes
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('amount', '<f8')])
+
+
+class BalanceHistory:
+    ''' Balances of every coin over time, stored in @directory as one binary
+        file of (time, amount) records per coin. Only changes get recorded,
+        so a balance is valid from its time on until the next record.
+        Files are only appended to - a torn last record (interrupted write)
+        gets ignored - and read via memory mapping, so range queries don't
+        read more than the requested records.
+    '''
+    def __init__(self, directory='balances'):
+        self._directory = directory
+        # coin -> last recorded amount
+        self._last = {}
+
+    def _file(self, coin):
+        return os.path.join(self._directory, coin + '.bin')
+
+    def coins(self) -> list:
+        try:
+            names = os.listdir(self._directory)
+        except FileNotFoundError:
+            return []
+        return sorted(n[:-4] for n in names if n.endswith('.bin'))
+
+    def records(self, coin) -> np.ndarray:
+        ''' returns all (read only) records of @coin, oldest first '''
+        try:
+            size = os.path.getsize(self._file(coin))
+        except FileNotFoundError:
+            return np.zeros(0, RECORD_DTYPE)
+        count = size // RECORD_DTYPE.itemsize
+        if not count:
+            return np.zeros(0, RECORD_DTYPE)
+        return np.memmap(self._file(coin), RECORD_DTYPE, 'r', shape=(count,))
+
+    def last(self, coin) -> float:
+        ''' returns the last recorded amount of @coin (0 if unknown) '''
+        if coin not in self._last:
+            records = self.records(coin)
+            self._last[coin] = float(records['amount'][-1]) if len(
+                records) else 0.
+        return self._last[coin]
+
+    def record(self, balances, t=None) -> int:
+        ''' records @balances (coin -> amount, coins not contained have a
+            balance of 0) at time @t (default: now) and returns the number
+            of coins whose balance has changed '''
+        t = time.time() if t is None else t
+        changed = {coin: float(amount) for coin, amount in balances.items()
+                   if float(amount) != self.last(coin)}
+        changed.update({coin: 0. for coin in self.coins()
+                        if coin not in balances and self.last(coin) != 0.})
+        if not changed: return 0
+        os.makedirs(self._directory, exist_ok=True)
+        for coin, amount in changed.items():
+            filename = self._file(coin)
+            with open(filename, 'ab') as f:
+                # drop a torn record from an interrupted write
+                size = f.tell()
+                if size % RECORD_DTYPE.itemsize:
+                    f.truncate(size - size % RECORD_DTYPE.itemsize)
+                f.write(np.array([(t, amount)], RECORD_DTYPE).tobytes())
+            self._last[coin] = amount
+        return len(changed)
+
+    def series(self, coin, start=-np.inf, end=np.inf, width=None) -> tuple:
+        ''' returns the balances (times, amounts) of @coin between @start
+            and @end. The balance valid at @start is included (with its
+            original time). With @width given the result gets reduced to
+            what can be seen @width pixels wide (see downsample.minmax()) '''
+        records = self.records(coin)
+        times = records['time']
+        first = max(int(np.searchsorted(times, start, 'right')) - 1, 0)
+        last = int(np.searchsorted(times, end, 'right'))
+        times = np.array(times[first:last])
+        amounts = np.array(records['amount'][first:last])
+        if width is None:
+            return times, amounts
+        return minmax(times, amounts, width)
+
+    def at(self, coin, times) -> np.ndarray:
+        ''' returns the balances of @coin at @times (0 before the first
+            record) '''
+        records = self.records(coin)
+        positions = np.searchsorted(records['time'], times, 'right') - 1
+        return np.r_[0., records['amount']][positions + 1]
+
+    def value(self, times, rates) -> np.ndarray:
+        ''' returns the value of all balances at @times given @rates
+            (coin -> rate or array of rates at @times) '''
+        times = np.asarray(times, np.float64)
+        return sum((self.at(coin, times) * np.asarray(rate, np.float64)
+                    for coin, rate in rates.items()), np.zeros(len(times)))
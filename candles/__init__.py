@@ -0,0 +1,251 @@
+''' resampling of trades into OHLCV candles
+'''
+import os
+import logging as log
+import numpy as np
+
+from ..store import ColumnStore
+
+__all__ = ['parse_interval', 'resample', 'aggregate', 'CandlePyramid',
+           'FIELDS', 'LEVELS']
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 24 * 3600, 'w': 7 * 24 * 3600}
+
+FIELDS = ('time', 'open', 'high', 'low', 'close',
+          'amount_buy', 'amount_sell', 'total_buy', 'total_sell',
+          'amount', 'total', 'vwap', 'count')
+
+
+def parse_interval(interval) -> int:
+    ''' turns '5m', '1h', '1d' etc. (or seconds) into seconds '''
+    if isinstance(interval, str):
+        try:
+            return int(interval[:-1]) * _UNITS[interval[-1]]
+        except (KeyError, ValueError) as exc:
+            raise ValueError('invalid interval %r' % interval) from exc
+    if interval <= 0:
+        raise ValueError('invalid interval %r' % interval)
+    return int(interval)
+
+
+# bucket sizes of CandlePyramid, each one a multiple of the previous one
+LEVELS = (60, 5 * 60, 3600, 24 * 3600)
+
+
+def empty() -> dict:
+    return {key: np.empty(0, np.int64 if key == 'count' else np.float64)
+            for key in FIELDS}
+
+
+def _bounds(times, size):
+    slots = np.floor_divide(times, size)
+    starts = np.flatnonzero(np.r_[True, slots[1:] != slots[:-1]])
+    ends = np.r_[starts[1:], len(slots)]
+    return slots[starts] * size, starts, ends
+
+
+def _add_totals(result) -> dict:
+    result['amount'] = result['amount_buy'] + result['amount_sell']
+    result['total'] = result['total_buy'] + result['total_sell']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result['vwap'] = result['total'] / result['amount']
+    return result
+
+
+def resample(trades, interval) -> dict:
+    ''' groups @trades (a TradeStore) into buckets of @interval and returns
+        a dict of arrays (see FIELDS). 'time' is the start of a bucket,
+        buckets without trades are left out, the last (still open) bucket
+        is contained.
+    '''
+    size = parse_interval(interval)
+    if not trades: return empty()
+    times, starts, ends = _bounds(trades.time, size)
+    rate, amount, total, buy = (
+        trades.rate, trades.amount, trades.total, trades.buy)
+
+    result = {
+        'time': times,
+        'open': rate[starts],
+        'high': np.maximum.reduceat(rate, starts),
+        'low': np.minimum.reduceat(rate, starts),
+        'close': rate[ends - 1],
+        'amount_buy': np.add.reduceat(np.where(buy, amount, 0.), starts),
+        'amount_sell': np.add.reduceat(np.where(buy, 0., amount), starts),
+        'total_buy': np.add.reduceat(np.where(buy, total, 0.), starts),
+        'total_sell': np.add.reduceat(np.where(buy, 0., total), starts),
+        'count': ends - starts,
+    }
+    return _add_totals(result)
+
+
+def aggregate(data, interval) -> dict:
+    ''' merges candles (as returned by resample()) into buckets of
+        @interval which has to be a multiple of the original interval '''
+    size = parse_interval(interval)
+    if not len(data['time']): return empty()
+    times, starts, ends = _bounds(data['time'], size)
+    result = {key: np.add.reduceat(data[key], starts)
+              for key in ('amount_buy', 'amount_sell', 'total_buy',
+                          'total_sell', 'count')}
+    result.update({
+        'time': times,
+        'open': data['open'][starts],
+        'high': np.maximum.reduceat(data['high'], starts),
+        'low': np.minimum.reduceat(data['low'], starts),
+        'close': data['close'][ends - 1],
+    })
+    return _add_totals(result)
+
+
+class Candles(ColumnStore):
+    ''' growable time ordered candles, see resample() for the columns '''
+    COLUMNS = tuple((key, np.int64 if key == 'count' else np.float64)
+                    for key in FIELDS)
+
+    def select(self, begin=None, end=None) -> dict:
+        ''' returns the candles in [@begin, @end) as dict of arrays '''
+        times = self.column('time')
+        first = 0 if begin is None else int(np.searchsorted(times, begin))
+        last = len(times) if end is None else int(np.searchsorted(times, end))
+        return self[first:last].columns()
+
+    def splice(self, new, begin, end):
+        ''' replaces the candles in [@begin, @end) with @new - cheap for
+            the head and the tail '''
+        times = self.column('time')
+        first = int(np.searchsorted(times, begin))
+        last = int(np.searchsorted(times, end))
+        if last == len(self):
+            self.truncate(first)
+            self.append(new)
+        elif first == 0:
+            self.drop_front(last)
+            self.prepend(new)
+        else:
+            tail = Candles({key: np.array(values)
+                            for key, values in self[last:].columns().items()})
+            self.truncate(first)
+            self.append(new)
+            self.append(tail)
+
+
+class CandlePyramid:
+    ''' Candles for several intervals (see LEVELS) which are kept up to date
+        by re-aggregating only the buckets touched by new trades. The
+        finest level is built from trades, every other level from the level
+        below. Candles stay valid when the underlying trades get trimmed.
+    '''
+    def __init__(self, levels=LEVELS):
+        assert all(b % a == 0 for a, b in zip(levels, levels[1:]))
+        self._sizes = tuple(levels)
+        self._levels = {size: Candles() for size in self._sizes}
+        # time range of the trades the candles have been built from
+        self._covered = None
+
+    def __repr__(self):
+        return 'CandlePyramid(%s)' % ', '.join(
+            '%ds: %d' % (size, len(self._levels[size]))
+            for size in self._sizes)
+
+    def sizes(self) -> tuple:
+        return self._sizes
+
+    def covered(self) -> tuple:
+        return self._covered
+
+    def clear(self):
+        self._levels = {size: Candles() for size in self._sizes}
+        self._covered = None
+
+    def rebuild(self, trades):
+        self.clear()
+        if trades:
+            self.update(trades, trades.time[0], trades.time[-1])
+
+    def update(self, trades, begin, end):
+        ''' re-aggregates all buckets touching the time range [@begin, @end]
+            from @trades (a TradeStore) '''
+        if not trades: return
+        size = self._sizes[0]
+        lower = begin // size * size
+        upper = end // size * size + size
+        new = resample(
+            trades[trades.index_of_time(lower):trades.index_of_time(upper)],
+            size)
+        self._levels[size].splice(new, lower, upper)
+        for finer, size in zip(self._sizes, self._sizes[1:]):
+            lower = lower // size * size
+            upper = -(-upper // size) * size
+            new = aggregate(self._levels[finer].select(lower, upper), size)
+            self._levels[size].splice(new, lower, upper)
+        first, last = float(trades.time[0]), float(trades.time[-1])
+        self._covered = ((min(first, self._covered[0]),
+                          max(last, self._covered[1]))
+                         if self._covered else (first, last))
+
+    def catch_up(self, trades):
+        ''' updates the candles for trades outside the covered range '''
+        if not trades: return
+        if not self._covered:
+            self.rebuild(trades)
+            return
+        first, last = float(trades.time[0]), float(trades.time[-1])
+        if first < self._covered[0]:
+            self.update(trades, first, self._covered[0])
+        if last > self._covered[1]:
+            self.update(trades, self._covered[1], last)
+
+    def level_for(self, interval) -> int:
+        ''' returns the coarsest level @interval can be aggregated from or
+            None if there is none '''
+        size = parse_interval(interval)
+        usable = [s for s in self._sizes if size % s == 0]
+        return usable[-1] if usable else None
+
+    def level_for_span(self, span, max_points) -> int:
+        ''' returns the coarsest level which still provides @max_points
+            candles for a time range of @span seconds '''
+        usable = [s for s in self._sizes if s * max_points <= span]
+        return usable[-1] if usable else self._sizes[0]
+
+    def query(self, interval, begin=None, end=None) -> dict:
+        ''' returns candles of @interval for [@begin, @end) '''
+        size = parse_interval(interval)
+        level = self.level_for(size)
+        if level is None:
+            raise ValueError('interval %r not supported' % interval)
+        if begin is not None:
+            begin = begin // size * size
+        data = self._levels[level].select(begin, end)
+        return data if level == size else aggregate(data, size)
+
+    def save(self, filename):
+        tmp_name = filename + '.tmp'
+        with open(tmp_name, 'wb') as f:
+            np.savez(f, sizes=np.array(self._sizes),
+                     covered=np.array(self._covered or (np.nan, np.nan)),
+                     **{'%d_%s' % (size, key): self._levels[size].column(key)
+                        for size in self._sizes for key in FIELDS})
+        os.replace(tmp_name, filename)
+
+    def load(self, filename) -> bool:
+        ''' loads candles saved with save(), returns False if there are none
+            or if they have been saved with other levels '''
+        try:
+            with np.load(filename) as data:
+                if tuple(data['sizes']) != self._sizes:
+                    return False
+                covered = tuple(float(c) for c in data['covered'])
+                self._levels = {
+                    size: Candles({key: data['%d_%s' % (size, key)]
+                                   for key in FIELDS})
+                    for size in self._sizes}
+        except FileNotFoundError:
+            return False
+        except (ValueError, KeyError, OSError) as exc:
+            log.warning('could not load candles from %r: %r', filename, exc)
+            self.clear()
+            return False
+        self._covered = None if np.isnan(covered[0]) else covered
+        return True
@@ -0,0 +1,146 @@
+''' level of detail for plotting: reduces curves to what can be seen
+'''
+import numpy as np
+
+__all__ = ['MinMaxIndex', 'minmax']
+
+# number of buckets of one level merged into a bucket of the next level
+FACTOR = 4
+
+
+class _Buffer:
+    ''' array which can be overwritten/extended at its end in amortized
+        O(len(new values)) '''
+    def __init__(self, dtype):
+        self._data = np.empty(0, dtype)
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def values(self):
+        return self._data[:self._length]
+
+    def put(self, start, values):
+        ''' replaces everything from @start on with @values '''
+        end = start + len(values)
+        if end > len(self._data):
+            data = np.empty(max(end, 2 * len(self._data), 1024),
+                            self._data.dtype)
+            data[:start] = self._data[:start]
+            self._data = data
+        self._data[start:end] = values
+        self._length = end
+
+
+class MinMaxIndex:
+    ''' Multi resolution index over the points (@x, @y) of a curve (@x
+        ascending). Every level stores the positions of the minimum and the
+        maximum of buckets FACTOR times bigger than the ones of the level
+        below, so query() can pick the level fitting a given range and
+        width in pixels and returns O(width) points for any range.
+        NaN values are ignored. Points can be appended in O(new points).
+    '''
+    def __init__(self, x=(), y=()):
+        self._x = _Buffer(np.float64)
+        self._y = _Buffer(np.float64)
+        # [bucket size, minima, positions of minima, maxima, positions of
+        # maxima] with level 0 being the points themselves
+        self._levels = []
+        self.append(x, y)
+
+    @property
+    def x(self):
+        return self._x.values
+
+    @property
+    def y(self):
+        return self._y.values
+
+    def append(self, x, y):
+        ''' adds the points (@x, @y) behind the existing ones '''
+        x = np.asarray(x, np.float64)
+        y = np.asarray(y, np.float64)
+        assert len(x) == len(y)
+        if not len(x): return
+        changed = len(self._x)
+        self._x.put(changed, x)
+        self._y.put(changed, y)
+        nan = np.isnan(y)
+        positions = np.arange(changed, changed + len(y))
+        if not self._levels:
+            self._levels.append([1] + [_Buffer(t) for t in (
+                np.float64, np.int64, np.float64, np.int64)])
+        _, low, low_pos, high, high_pos = self._levels[0]
+        low.put(changed, np.where(nan, np.inf, y))
+        low_pos.put(changed, positions)
+        high.put(changed, np.where(nan, -np.inf, y))
+        high_pos.put(changed, positions)
+
+        level = 0
+        while len(self._levels[level][1]) > FACTOR:
+            size, low, low_pos, high, high_pos = self._levels[level]
+            if level + 1 == len(self._levels):
+                self._levels.append([size * FACTOR] + [_Buffer(t) for t in (
+                    np.float64, np.int64, np.float64, np.int64)])
+            # rebuild the buckets containing changed ones of the level below
+            changed //= FACTOR
+            start = changed * FACTOR
+            _, *upper = self._levels[level + 1]
+            for (values, positions), (up_values, up_positions), fill, arg in (
+                    ((low, low_pos), upper[:2], np.inf, np.argmin),
+                    ((high, high_pos), upper[2:], -np.inf, np.argmax)):
+                new_values, new_positions = self._reduce(
+                    values.values[start:], positions.values[start:], fill, arg)
+                up_values.put(changed, new_values)
+                up_positions.put(changed, new_positions)
+            level += 1
+
+    @staticmethod
+    def _reduce(values, positions, fill, arg):
+        count = -(-len(values) // FACTOR)
+        padding = count * FACTOR - len(values)
+        values = np.r_[values, np.full(padding, fill)].reshape(count, FACTOR)
+        positions = np.r_[positions, np.full(padding, positions[-1])].reshape(
+            count, FACTOR)
+        chosen = arg(values, axis=1)[:, None]
+        return (np.take_along_axis(values, chosen, 1)[:, 0],
+                np.take_along_axis(positions, chosen, 1)[:, 0])
+
+    def __len__(self):
+        return len(self._x)
+
+    def nbytes(self):
+        return sum(b.values.nbytes for level in self._levels[1:]
+                   for b in level[1:])
+
+    def query(self, x0=-np.inf, x1=np.inf, width=1000) -> tuple:
+        ''' returns the points (x, y) needed to draw the curve between @x0
+            and @x1 @width pixels wide: at most 2 * FACTOR points per pixel
+            containing every local minimum and maximum plus one point
+            outside the range on both ends '''
+        x, y = self.x, self.y
+        first = max(int(np.searchsorted(x, x0, 'left')) - 1, 0)
+        last = min(int(np.searchsorted(x, x1, 'right')) + 1, len(x))
+        count = last - first
+        if count <= 2 * FACTOR * width:
+            return x[first:last], y[first:last]
+        # biggest buckets still giving at least one bucket per pixel
+        level = min(int(np.log(count / width) / np.log(FACTOR)),
+                    len(self._levels) - 1)
+        size, _, low_pos, _, high_pos = self._levels[level]
+        low_pos = low_pos.values[first // size:-(-last // size)]
+        high_pos = high_pos.values[first // size:-(-last // size)]
+        positions = np.stack((np.minimum(low_pos, high_pos),
+                              np.maximum(low_pos, high_pos)), axis=1).ravel()
+        # edge buckets may reach out of the range
+        positions = positions[(positions > first) & (positions < last - 1) &
+                              ~np.isnan(y[positions])]
+        positions = np.r_[first, positions, last - 1]
+        return x[positions], y[positions]
+
+
+def minmax(x, y, width, x0=-np.inf, x1=np.inf) -> tuple:
+    ''' one shot version of MinMaxIndex(@x, @y).query(@x0, @x1, @width) '''
+    return MinMaxIndex(x, y).query(x0, x1, width)
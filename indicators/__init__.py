@@ -0,0 +1,181 @@
+''' stateful indicators which get updated trade by trade in O(1)
+'''
+import abc
+from collections import deque
+import numpy as np
+
+from .. import perf
+
+__all__ = ['SMA', 'EMA', 'VEMA', 'RollingMin', 'RollingMax', 'VWAP',
+           'ema_window']
+
+# trades older than the window of an EMA weigh less than this together
+EMA_PRECISION = 1e-9
+
+
+def ema_window(alpha):
+    ''' returns the number of recent values an EMA with @alpha depends on
+        (up to EMA_PRECISION) - None for alpha 0 (the first value only) '''
+    if alpha >= 1: return 1
+    if alpha <= 0: return None
+    return int(np.ceil(np.log(EMA_PRECISION) / np.log1p(-alpha)))
+
+
+class Indicator(abc.ABC):
+    ''' base class - INPUTS names the TradeStore columns update() takes,
+        window is the number of recent trades the value depends on (None
+        for the whole history) '''
+    INPUTS = ('rate',)
+    window = None
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._value = None
+
+    def value(self):
+        ''' returns the current value or None if there is none yet '''
+        return self._value
+
+    @abc.abstractmethod
+    def update(self, *values):
+        ''' adds the INPUTS of one trade and returns the new value '''
+
+    def feed(self, trades) -> np.ndarray:
+        ''' updates with all @trades (a TradeStore) and returns the values
+            after each trade '''
+        with perf.timer('indicators.%s' % type(self).__name__, len(trades)):
+            columns = [trades.column(name).tolist() for name in self.INPUTS]
+            return np.array([self.update(*v) for v in zip(*columns)],
+                            dtype=np.float64)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._value)
+
+
+class SMA(Indicator):
+    ''' simple moving average over the last @N values '''
+    def __init__(self, N):
+        self.window = N
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        self._values = deque()
+        self._sum = 0.
+        self._count = 0
+
+    def update(self, x):
+        self._values.append(x)
+        self._sum += x
+        if len(self._values) > self.window:
+            self._sum -= self._values.popleft()
+        self._count += 1
+        if self._count % self.window == 0:
+            # avoid accumulating rounding errors
+            self._sum = sum(self._values)
+        self._value = self._sum / len(self._values)
+        return self._value
+
+
+class EMA(Indicator):
+    ''' same as mftl.ema() but one value at a time - older values than
+        window have no (relevant) influence '''
+    def __init__(self, alpha):
+        self._alpha = alpha
+        self.window = ema_window(alpha)
+        super().__init__()
+
+    def update(self, x):
+        self._value = (x if self._value is None else
+                       self._alpha * x + (1 - self._alpha) * self._value)
+        return self._value
+
+
+class VEMA(Indicator):
+    ''' same as mftl.vema() but one trade at a time '''
+    INPUTS = ('total', 'amount')
+
+    def __init__(self, alpha):
+        self._totals = EMA(alpha)
+        self._amounts = EMA(alpha)
+        self.window = self._totals.window
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        self._totals.reset()
+        self._amounts.reset()
+
+    def update(self, total, amount):
+        self._value = self._totals.update(total) / self._amounts.update(amount)
+        return self._value
+
+
+class RollingMin(Indicator):
+    ''' minimum of the last @N values (amortized O(1) with a monotonic
+        queue) '''
+    def __init__(self, N):
+        self.window = N
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        self._queue = deque()
+        self._count = 0
+
+    @staticmethod
+    def _dominates(a, b):
+        return a <= b
+
+    def update(self, x):
+        queue = self._queue
+        while queue and self._dominates(x, queue[-1][1]):
+            queue.pop()
+        queue.append((self._count, x))
+        if queue[0][0] <= self._count - self.window:
+            queue.popleft()
+        self._count += 1
+        self._value = queue[0][1]
+        return self._value
+
+
+class RollingMax(RollingMin):
+    ''' maximum of the last @N values '''
+    @staticmethod
+    def _dominates(a, b):
+        return a >= b
+
+
+class VWAP(Indicator):
+    ''' volume weighted average rate of the last @N trades (or all trades
+        if @N is None) '''
+    INPUTS = ('total', 'amount')
+
+    def __init__(self, N=None):
+        self.window = N
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        self._trades = deque()
+        self._total = self._amount = 0.
+        self._count = 0
+
+    def update(self, total, amount):
+        self._total += total
+        self._amount += amount
+        if self.window:
+            self._trades.append((total, amount))
+            if len(self._trades) > self.window:
+                old_total, old_amount = self._trades.popleft()
+                self._total -= old_total
+                self._amount -= old_amount
+            self._count += 1
+            if self._count % self.window == 0:
+                # avoid accumulating rounding errors
+                self._total = sum(t for t, _ in self._trades)
+                self._amount = sum(a for _, a in self._trades)
+        self._value = self._total / self._amount if self._amount else None
+        return self._value
@@ -0,0 +1,176 @@
+''' keeping trade histories and other data up to date in the background
+'''
+import threading
+import queue
+import time
+import logging as log
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .. import TradeHistory
+from ..indicators import VEMA
+from ..util import ServerError
+from .. import perf
+
+__all__ = ['Watcher', 'Scheduler']
+
+
+class Watcher(threading.Thread):
+    ''' Loads and then updates the TradeHistory of all @markets every
+        @interval seconds in a background thread. New trades are turned into
+        batches of points (dicts with arrays 'time', 'rate' and 'vema') which
+        can be picked up with updates() without ever blocking - so a UI
+        thread can show them without waiting for the network. If older
+        trades got added (e.g. a filled gap) a batch with 'reset' set
+        contains the complete series which replaces everything published
+        before.
+    '''
+    def __init__(self, markets, api, *, interval=10., alpha=0.005,
+                 directory='.', save_interval=300.):
+        super().__init__(daemon=True)
+        self._markets = list(markets)
+        self._api = api
+        self._interval = interval
+        self._alpha = alpha
+        self._directory = directory
+        self._save_interval = save_interval
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._histories = {}
+        self._vemas = {}
+        self._last_gids = {}
+        # market -> number of trades published
+        self._published = {}
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self.join(timeout)
+
+    def updates(self) -> list:
+        ''' returns all (market, points) batches available right now '''
+        result = []
+        while True:
+            try:
+                result.append(self._queue.get_nowait())
+            except queue.Empty:
+                return result
+
+    def _publish(self, market):
+        history = self._histories[market]
+        trades = history.data()
+        if not trades: return
+        last_gid = self._last_gids.get(market)
+        first = 0 if last_gid is None else trades.index_of_gid(last_gid + 1)
+        reset = first != self._published.get(market, 0)
+        if reset:
+            # trades have been inserted before the published ones
+            first = 0
+            self._vemas[market].reset()
+        new = trades[first:]
+        if not new: return
+        self._last_gids[market] = int(new.gid[-1])
+        self._published[market] = len(trades)
+        points = {
+            'time': np.array(new.time),
+            'rate': np.array(new.rate),
+            'vema': self._vemas[market].feed(new)}
+        if reset:
+            points['reset'] = True
+        self._queue.put((market, points))
+
+    def run(self):
+        for market in self._markets:
+            history = TradeHistory(market)
+            history.load(self._directory)
+            self._histories[market] = history
+            self._vemas[market] = VEMA(self._alpha)
+            self._publish(market)
+
+        last_save = time.time()
+        while not self._stopped.is_set():
+            for market, history in self._histories.items():
+                if self._stopped.is_set(): break
+                try:
+                    # fill gaps left by a cut off update before publishing -
+                    # never trim, the stored history might be a complete one
+                    while history.fetch_next(api=self._api, max_duration=-1,
+                                             only_new=True):
+                        if not history.gaps(): break
+                except ServerError as exc:
+                    log.warning('could not update %r: %r', market, exc)
+                    continue
+                self._publish(market)
+            if time.time() - last_save > self._save_interval:
+                for history in self._histories.values():
+                    history.save(self._directory)
+                last_save = time.time()
+            self._stopped.wait(self._interval)
+        for history in self._histories.values():
+            history.save(self._directory)
+
+
+class Scheduler(threading.Thread):
+    ''' Runs the @jobs (name -> (interval in seconds, function)) every
+        interval seconds on a pool of @workers threads. A job doesn't get
+        started again while it's still running, so slow jobs (e.g. network
+        calls) don't delay the others. Exceptions get logged and the job
+        gets retried after its interval.
+    '''
+    def __init__(self, jobs, *, workers=None, tick=0.1):
+        super().__init__(daemon=True)
+        self._jobs = dict(jobs)
+        self._workers = workers or len(self._jobs) or 1
+        self._tick = tick
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._running = set()
+        # name -> time of the last completed run
+        self._completed = {}
+        self._failures = {}
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self.join(timeout)
+
+    def completed(self) -> dict:
+        ''' returns name -> time of the last successful run '''
+        with self._lock:
+            return dict(self._completed)
+
+    def failures(self) -> dict:
+        ''' returns name -> number of failed runs '''
+        with self._lock:
+            return dict(self._failures)
+
+    def _run_job(self, name, function):
+        try:
+            with perf.timer('refresh.' + name):
+                function()
+        except ServerError as exc:
+            log.warning('could not refresh %r: %r', name, exc)
+            failed = True
+        except Exception:  # pylint: disable=broad-except
+            log.exception('could not refresh %r', name)
+            failed = True
+        else:
+            failed = False
+        with self._lock:
+            self._running.discard(name)
+            if failed:
+                self._failures[name] = self._failures.get(name, 0) + 1
+            else:
+                self._completed[name] = time.time()
+
+    def run(self):
+        due = {name: 0. for name in self._jobs}
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            while not self._stopped.is_set():
+                now = time.monotonic()
+                for name, (interval, function) in self._jobs.items():
+                    with self._lock:
+                        if due[name] > now or name in self._running:
+                            continue
+                        self._running.add(name)
+                    due[name] = now + interval
+                    executor.submit(self._run_job, name, function)
+                self._stopped.wait(self._tick)
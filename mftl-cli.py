@@ -4,16 +4,18 @@ import os, sys
 import ast
 import logging as log
 import argparse
+import csv
 import time
 import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import mftl
 import mftl.px
-import mftl.qwtgraph
-from mftl.qwtgraph import Pen
+import mftl.backtest
 
-FEE = 0.9975
+FEE = mftl.backtest.FEE
 HOUR = 1 / 3600
 DAY = 1 * HOUR / 24
 
@@ -29,109 +31,282 @@ class Strategy:
         self._slow_ma = slow_ma
 
     def feed(self, history, amount):
-        trades = []
         plots = []
         #    data = th.data()
         #    trade_rates = [e['total'] / e['amount'] for e in data]
         #    trade_times = [e['time'] - now for e in data]
 
         # generate 5min-buckets
-        bucket_data = history.rate_buckets()
-        now = bucket_data[-1]['time']
+        bucket_data = history.candles('5m')
+        now = bucket_data['time'][-1]
         t_factor = 1 / 3600 / 24
-        times = [(e['time'] - now) * t_factor for e in bucket_data]
-        rates = [(e['total_sell'] + e['total_buy']) /
-                 (e['amount_sell'] + e['amount_buy']) for e in bucket_data]
+        times = (bucket_data['time'] - now) * t_factor
+        rates = bucket_data['vwap']
         rates_fast = mftl.sma(rates, self._fast_ma)
         rates_medium = mftl.sma(rates, self._medium_ma)
         rates_slow = mftl.sma(rates, self._slow_ma)
         times, rates, rates_fast, rates_medium, rates_slow = mftl.trim(
             times, rates, rates_fast, rates_medium, rates_slow)
 
-        plots.append((times, ((rates, Pen.gray_fat),
-                              (rates_medium, Pen.dark_cyan_fat),
-                              (rates_fast, Pen.dark_magenta_fat),
-                              (rates_slow, Pen.dark_yellow_fat),
+        plots.append((times, ((rates, 'gray_fat'),
+                              (rates_medium, 'dark_cyan_fat'),
+                              (rates_fast, 'dark_magenta_fat'),
+                              (rates_slow, 'dark_yellow_fat'),
                               )))
 
-        amount_C1 = amount  # amount of primary coin we start with
-        amount_C2 = 0.      # amount of secondary coin (asset) we start with
-
-        last_C1 = 0
-        last_C2 = 0
-        for i, d in enumerate(rates):
-            if i == 0: continue
-            # verkaufen, wenn fast MA
-            action = ('buy' if (rates_fast[i] >= rates_medium[i] and
-                                rates_fast[i - 1] < rates_medium[i - 1] and
-                                rates_fast[i] > rates_slow[i]) else
-                      'sell' if (rates_fast[i] <= rates_medium[i] and
-                                 rates_fast[i - 1] > rates_medium[i - 1] and
-                                 rates_fast[i] < rates_slow[i]) else
-                      'none')
-            if action == 'none': continue
-            if action == 'buy':
-                if amount_C1 == 0.: continue
-                new_c2 = amount_C1 / d * FEE
-                amount_C2 = new_c2
-                last_C1, amount_C1 = amount_C1, 0.
-            elif action == 'sell':
-                if amount_C2 == 0.: continue
-                new_c1 = amount_C2 * d * FEE
-                amount_C1 = new_c1
-                last_C2, amount_C2 = amount_C2, 0.
-            trades.append((action, times[i], d))
-#            print('%.4d %.7d %9.2f %11.2f %11.9f %s' % (
-#                i, times[i], amount_C1, amount_C2, d, action))
-
-        if trades and trades[-1][0] == 'buy':
-            del trades[-1]
-
-        return last_C1, trades, plots
+        actions = mftl.backtest.executed(mftl.backtest.signals(
+            rates_fast, rates_medium, rates_slow))[0]
+        gain, _, _ = mftl.backtest.evaluate(rates, actions, FEE)
+        trades = [('buy' if actions[i] > 0 else 'sell', times[i], rates[i])
+                  for i in np.flatnonzero(actions)]
+        return amount * gain[0], trades, plots
 
-    def plot(self, market, gain, trades, plots):
-        w = mftl.qwtgraph.GraphUI('%s - %.1f%%' % (market, gain))
+    @staticmethod
+    def draw(w, trades, plots):
         for t, p in plots:
             for curve, color in p:
                 w.set_data(t, curve, color)
 
         for (a1, t1, v1), (a2, t2, v2) in sliced(trades, 2):
-            w.add_vmarker(t1, Pen.dark_green)
-            w.add_vmarker(t2, Pen.dark_red)
+            w.add_vmarker(t1, 'dark_green')
+            w.add_vmarker(t2, 'dark_red')
             #            w.add_hmarker(v, 'red' if a == 'sell' else 'green')
-            w.add_line(t1, v1, t2, v2, Pen.green_fat if v2 >= v1 else Pen.red_fat)
+            w.add_line(t1, v1, t2, v2, 'green_fat' if v2 >= v1 else 'red_fat')
 
+    def plot(self, market, gain, trades, plots):
+        from mftl import qwtgraph  # Qt is only needed for showing plots
+        w = qwtgraph.GraphUI('%s - %.1f%%' % (market, gain))
+        self.draw(w, trades, plots)
         w.show()
 
+    def render(self, filename, market, gain, trades, plots):
+        ''' like plot() but writes the chart to @filename instead '''
+        from mftl import qwtgraph
+        w = qwtgraph.GraphUI('%s - %.1f%%' % (market, gain), keep=False)
+        self.draw(w, trades, plots)
+        w.render(filename)
+        w.deleteLater()
 
-def show_curve(market):
+
+def analyze(market):
+    ''' returns the default Strategy and its result for @market (or None
+        if there is no trade history) '''
     th = mftl.TradeHistory(market)
     th.load()
-    if not th.count(): return
+    if not th.count(): return None
 
-    print('%r, #trades: %d, duration: %.1fh' % (
-        market, th.count(), th.duration() / 3600))
-    m = ((0, [],[]), market, 0, 0, 0)
-
-    #for s in range(20):
-            #fast = f + 1
-            #slow = fast + s + 1
+    log.info('%r, #trades: %d, duration: %.1fh',
+        market, th.count(), th.duration() / 3600)
     fast = 30 #20
     medium = 50 #35
     slow = 250 #medium + 50 * s #70
-
+    # see the backtest command for finding better parameters
     strategy = Strategy(fast, medium, slow)
-    g = strategy.feed(th, 100), market, fast, medium, slow
-    #m = max(g, m)
-    print(g[1:], m[1:])
-    strategy.plot(market, *g[0])
+    return strategy, strategy.feed(th, 100)
 
 
+def show_curve(market):
+    analysis = analyze(market)
+    if analysis is None: return
+    strategy, result = analysis
+    print(market, result[0])
+    strategy.plot(market, *result)
+
+
+def render_chart(market, directory, fmt):
+    ''' writes the chart for @market to @directory/<market>.@fmt '''
+    analysis = analyze(market)
+    if analysis is None: return None
+    strategy, result = analysis
+    filename = os.path.join(directory, '%s.%s' % (market, fmt))
+    strategy.render(filename, market, *result)
+    return filename
+
+
+_RENDER_APP = None
+
+
+def _init_renderer():
+    global _RENDER_APP
+    from mftl import qwtgraph
+    _RENDER_APP = qwtgraph.application(headless=True)
+
+
+def render_charts(pattern, directory, fmt, workers):
+    ''' renders charts for all stored markets matching @pattern into files
+        using @workers processes (each with its own QApplication) - no
+        window gets shown but Qt4 needs an X display (e.g. xvfb-run) '''
+    from mftl import qwtgraph
+    qwtgraph.require_display()
+    os.makedirs(directory, exist_ok=True)
+    markets = [m for m in sorted(mftl.TradeHistory.stored_markets())
+               if not pattern or m.lower().find(pattern.lower()) >= 0]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_renderer) as executor:
+            futures = {m: executor.submit(render_chart, m, directory, fmt)
+                       for m in markets}
+        results = {m: f.exception() or f.result() for m, f in futures.items()}
+    else:
+        _init_renderer()
+        results = {}
+        for market in markets:
+            try:
+                results[market] = render_chart(market, directory, fmt)
+            except Exception as exc:  # pylint: disable=broad-except
+                results[market] = exc
+    for market, result in results.items():
+        if isinstance(result, Exception):
+            log.error('could not render %r: %r', market, result)
+        elif result:
+            log.info('wrote %r', result)
+
+
+def fetch_history(market, min_duration):
+    ''' brings the history of @market up to date and makes sure it reaches
+        back at least @min_duration seconds '''
+    history = mftl.TradeHistory(market)
+    history.load()
+    while True:
+        log.info('fetch %r trade history (current: %.1fh)..',
+            market,  history.duration() * HOUR)
+        try:
+            fetched = history.fetch_next(api=mftl.px.PxApi, max_duration=-1)
+            history.save()
+        except mftl.util.ServerError as exc:
+            log.warning('error occured: %r', exc)
+            time.sleep(1)
+            continue
+        if not fetched or (history.duration() >= min_duration and
+                           not history.gaps()):
+            break
+    history.compact()
+    log.info('%r, #trades: %d, duration: %.1fh',
+        market, history.count(), history.duration() * HOUR)
+    return history
+
+
+def fetch_all(pattern, min_duration, workers):
+    ''' fetches all markets containing @pattern (comma separated list of
+        markets or part of a name) in parallel - requests are still
+        limited by mftl.util.REQUEST_LIMITER '''
+    names = pattern.split(',')
+    markets = sorted(
+        m for m in mftl.px.PxApi.get_ticker()
+        if m in names or (len(names) == 1 and pattern.lower() in m.lower()))
+    log.info('fetch %d markets using %d threads', len(markets), workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {m: executor.submit(fetch_history, m, min_duration)
+                   for m in markets}
+    for market, future in futures.items():
+        try:
+            future.result()
+        except Exception as exc:  # pylint: disable=broad-except
+            log.error('could not fetch %r: %r', market, exc)
+
+
+def parse_grid(spec) -> np.ndarray:
+    ''' turns 'FAST,MEDIUM,SLOW' with each of them being 'first-last[/step]'
+        or a single number into (fast, medium, slow) combinations '''
+    def parse_range(text):
+        bounds, _, step = text.partition('/')
+        first, _, last = bounds.partition('-')
+        return range(int(first), int(last or first) + 1, int(step or 1))
+    try:
+        fast, medium, slow = (parse_range(r) for r in spec.split(','))
+    except ValueError as exc:
+        raise ValueError('invalid parameter grid %r' % spec) from exc
+    return mftl.backtest.grid(fast, medium, slow)
+
+
+def backtest(pattern, spec, workers, filename):
+    ''' sweeps the parameter grid @spec for all stored markets matching
+        @pattern using @workers processes and prints (or writes to the CSV
+        file @filename) the results ranked by gain '''
+    combinations = parse_grid(spec)
+    series = {}
+    for market in sorted(mftl.TradeHistory.stored_markets()):
+        if pattern and market.lower().find(pattern.lower()) < 0:
+            continue
+        history = mftl.TradeHistory(market)
+        history.load()
+        if history.count():
+            series[market] = history.candles('5m')['vwap']
+    log.info('backtest %d parameter sets on %d markets using %d processes',
+             len(combinations), len(series), workers)
+    t1 = time.time()
+    results = mftl.backtest.sweep_markets(
+        series, combinations, fee=FEE, workers=workers)
+    log.info('took %.1fs', time.time() - t1)
+    if not results:
+        log.warning('no market with enough data')
+        return
+    markets = np.concatenate([[m] * len(r) for m, r in results.items()])
+    rows = np.concatenate(list(results.values()))
+    order = np.argsort(-rows['gain'], kind='stable')
+    markets, rows = markets[order], rows[order]
+    fields = ('fast', 'medium', 'slow', 'gain', 'trades', 'drawdown')
+    if filename:
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('market',) + fields)
+            writer.writerows(zip(markets, *(rows[k].tolist() for k in fields)))
+        log.info('wrote %d results to %r', len(rows), filename)
+    print('%-12s %5s %6s %5s %8s %6s %8s' % (('market',) + fields))
+    for market, row in zip(markets[:20], rows[:20]):
+        print('%-12s %5d %6d %5d %7.2f%% %6d %7.2f%%' % (
+            market, row['fast'], row['medium'], row['slow'],
+            (row['gain'] - 1) * 100, row['trades'], row['drawdown'] * 100))
+
+
+def watch(pattern, interval):
+    ''' shows live charts of the markets matching @pattern (a comma separated
+        list of markets or a part of a stored market's name) which get
+        updated every @interval seconds by a background thread '''
+    from mftl import qwtgraph, live
+    names = pattern.split(',')
+    markets = (names if len(names) > 1 or '_' in pattern else
+               sorted(m for m in mftl.TradeHistory.stored_markets()
+                      if pattern.lower() in m.lower()))
+    watcher = live.Watcher(markets, mftl.px.PxApi, interval=interval)
+    start = time.time()
+    curves = {}
+
+    def show_updates():
+        for market, points in watcher.updates():
+            x = (points['time'] - start) * HOUR
+            if market in curves:
+                # a reset batch (e.g. after a filled gap) has all points
+                update = (board.plot(market).replace_data
+                          if points.get('reset') else
+                          board.plot(market).append_data)
+                for key, curve in curves[market].items():
+                    update(curve, x, points[key])
+            else:
+                plot = board.plot(market)
+                curves[market] = {
+                    'rate': plot.set_data(x, points['rate'], 'gray'),
+                    'vema': plot.set_data(x, points['vema'], 'dark_cyan_fat')}
+
+    with qwtgraph.qtapp() as app:
+        board = qwtgraph.Dashboard('mftl - %s' % pattern)
+        board.show()
+        timer = qwtgraph.every(250, show_updates)
+        watcher.start()
+        try:
+            app.run()
+        finally:
+            timer.stop()
+            watcher.stop()
+
 
 def get_args() -> dict:
     parser = argparse.ArgumentParser(description='ticker')
     parser.add_argument("-v", "--verbose", action='store_true')
     parser.add_argument("-c", "--allow-cached", action='store_true')
+    parser.add_argument(
+        "--profile", nargs='?', const='', metavar='FILE',
+        help='print where time went (and write it to FILE, .csv or .json)')
     parser.add_argument('cmd')
     parser.add_argument('arg1', nargs='?')
     parser.add_argument('arg2', nargs='?')
@@ -152,30 +327,61 @@ def main():
     args = get_args()
     log.basicConfig(level=log.DEBUG if args.verbose else log.INFO)
     mftl.util.ALLOW_CACHED_VALUES = 'ALLOW' if args.allow_cached else 'NEVER'
+    if args.profile is None:
+        run(args)
+        return
+    mftl.perf.enable()
+    try:
+        with mftl.perf.timer('total'):
+            run(args)
+    finally:
+        mftl.perf.report()
+        if args.profile:
+            mftl.perf.export(args.profile)
+
 
+def run(args):
     if args.cmd == 'fetch':
-        market = args.arg1
-        history = mftl.TradeHistory(args.arg1)
-        history.load()
-        min_duration = int(args.arg2) if args.arg2 else 3600
-        while history.duration() < min_duration:
-            log.info('fetch %r trade history (current: %.1fh)..',
-                market,  history.duration() * HOUR)
-            try:
-                history.fetch_next(api=mftl.px.PxApi, max_duration=-1)
-                history.save()
-            except mftl.util.ServerError as exc:
-                log.warning('error occured: %r', exc)
-                time.sleep(1)
-        log.info('%r, #trades: %d, duration: %.1fh',
-            market, history.count(), history.duration() * HOUR)
+        fetch_history(args.arg1, int(args.arg2) if args.arg2 else 3600)
+
+    elif args.cmd == 'fetch-all':
+        fetch_all(args.arg1 or 'BTC_',
+                  int(args.arg2) if args.arg2 else 3600,
+                  int(args.arg3) if args.arg3 else 8)
+
+    elif args.cmd == 'convert':
+        for f in os.listdir():
+            if not (f.startswith('trade_history-') and f.endswith('.json')):
+                continue
+            market = f.split('.')[0].split('-')[1]
+            if args.arg1 and market.lower().find(args.arg1.lower()) < 0:
+                continue
+            history = mftl.TradeHistory.convert_json(market)
+            log.info('converted %r (%d trades)', market, history.count())
+
+    elif args.cmd == 'backtest':
+        backtest(args.arg1,
+                 args.arg2 or '5-50/5,10-100/5,50-300/10',
+                 int(args.arg3) if args.arg3 else os.cpu_count(),
+                 args.arg4)
+
+    elif args.cmd == 'render':
+        render_charts(args.arg1,
+                      args.arg2 or 'charts',
+                      args.arg3 or 'png',
+                      int(args.arg4) if args.arg4 else 1)
+
+    elif args.cmd == 'watch':
+        watch(args.arg1 or 'BTC_ETH',
+              float(args.arg2) if args.arg2 else 10.)
 
     elif args.cmd == 'show':
-        with mftl.qwtgraph.qtapp() as app:
-            for f in os.listdir():
-                if not f.startswith('trade_history'): continue
-                if args.arg1 and f.lower().find(args.arg1.lower()) < 0: continue
-                show_curve(f.split('.')[0].split('-')[1])
+        from mftl import qwtgraph
+        with qwtgraph.qtapp() as app:
+            for market in sorted(mftl.TradeHistory.stored_markets()):
+                if args.arg1 and market.lower().find(args.arg1.lower()) < 0:
+                    continue
+                show_curve(market)
             app.run()
 
 
@@ -0,0 +1,299 @@
+''' local copy of our own trades which gets synced incrementally
+'''
+import os
+import time
+import logging as log
+from collections import deque, namedtuple
+from types import MappingProxyType
+import numpy as np
+
+from ..util import json_mod
+from .. import perf
+
+__all__ = ['OrderHistory', 'CostBasis', 'Ledger', 'VALUATION_DTYPE']
+
+
+class OrderHistory:
+    ''' Own trades of all markets stored in an append-only JSON lines file
+        (one trade per line, with an additional 'market' key). sync()
+        remembers the newest trade of every market and only asks for trades
+        newer than what's known already.
+    '''
+    # first trade time to ask for if nothing is known yet
+    FIRST_START = 1489266632
+    # time requested again on sync() - covers clock and time zone issues,
+    # duplicates get dropped by globalTradeID anyway
+    OVERLAP = 24 * 3600
+
+    def __init__(self, filename='orders.jsonl'):
+        self._filename = filename
+        # market -> trades, oldest first
+        self._trades = {}
+        # market -> highest globalTradeID
+        self._marks = {}
+
+    def __len__(self):
+        return sum(len(t) for t in self._trades.values())
+
+    def load(self):
+        ''' reads the stored trades - a torn last line (interrupted write)
+            gets dropped '''
+        self._trades, self._marks = {}, {}
+        try:
+            with open(self._filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        lines = data.split(b'\n')
+        if lines[-1]:
+            log.warning('drop incomplete last line of %r', self._filename)
+            with open(self._filename, 'rb+') as f:
+                f.truncate(len(data) - len(lines[-1]))
+        trades = {}
+        for line in lines[:-1]:
+            trade = json_mod.loads(line.decode())
+            trades.setdefault(trade.pop('market'), []).append(trade)
+        self._merge(trades)
+
+    def _merge(self, trades) -> dict:
+        ''' adds @trades (market -> list in any order) which are not known
+            yet and returns them (market -> list, oldest first) '''
+        added = {}
+        for market, new in trades.items():
+            mark = self._marks.get(market, -1)
+            known = self._trades.setdefault(market, [])
+            new = sorted({t['globalTradeID']: t for t in new
+                          if t['globalTradeID'] > mark}.values(),
+                         key=lambda t: t['globalTradeID'])
+            if not new: continue
+            known.extend(new)
+            self._marks[market] = new[-1]['globalTradeID']
+            added[market] = new
+        return added
+
+    def merge(self, trades) -> int:
+        ''' adds the unknown ones of @trades (market -> list) and appends
+            them to the file - returns the number of trades added '''
+        added = self._merge(trades)
+        if not added: return 0
+        directory = os.path.dirname(self._filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self._filename, 'a') as f:
+            f.write(''.join(
+                json_mod.dumps(dict(t, market=market)) + '\n'
+                for market, new in added.items() for t in new))
+            f.flush()
+            os.fsync(f.fileno())
+        return sum(len(new) for new in added.values())
+
+    def marks(self) -> dict:
+        ''' returns market -> globalTradeID of the newest known trade '''
+        return dict(self._marks)
+
+    def newest_time(self) -> float:
+        return max((t[-1]['time'] for t in self._trades.values() if t),
+                   default=None)
+
+    def trades_since(self, marks) -> dict:
+        ''' returns market -> trades (oldest first) with a globalTradeID
+            higher than @marks[market] '''
+        result = {}
+        for market, trades in self._trades.items():
+            mark = marks.get(market, -1)
+            first = len(trades)
+            while first and trades[first - 1]['globalTradeID'] > mark:
+                first -= 1
+            if first < len(trades):
+                result[market] = trades[first:]
+        return result
+
+    def trades(self) -> dict:
+        ''' returns market -> trades, newest first like
+            PxApi.get_order_history() '''
+        return {market: trades[::-1]
+                for market, trades in self._trades.items() if trades}
+
+    @perf.timed()
+    def sync(self, api) -> int:
+        ''' fetches the trades newer than the newest known one (of any
+            market - all trades before it are known) and returns the number
+            of new trades. Responses hitting api.ORDER_HISTORY_LIMIT get
+            continued with older pages. '''
+        newest = self.newest_time()
+        start = self.FIRST_START if newest is None else newest - self.OVERLAP
+        end = time.time() + 60
+        fetched = {}
+        while True:
+            page = api.get_order_history(start=start, end=end)
+            for market, trades in page.items():
+                fetched.setdefault(market, []).extend(trades)
+            times = [t['time'] for trades in page.values() for t in trades]
+            if len(times) < api.ORDER_HISTORY_LIMIT or min(times) >= end:
+                break
+            if newest is not None and min(times) <= newest:
+                # reached what's known already
+                break
+            # the response contains the newest trades only - go on with
+            # the ones before (duplicates get dropped by merge())
+            end = min(times)
+        # merge all pages at once - older pages would be below the marks
+        added = self.merge(fetched)
+        log.info('synced order history: %d new trades', added)
+        return added
+
+
+VALUATION_DTYPE = np.dtype([
+    ('market', 'U16'), ('amount', np.float64), ('cost', np.float64),
+    ('realized', np.float64), ('value', np.float64),
+    ('unrealized', np.float64)])
+
+
+class CostBasis:
+    ''' FIFO cost basis of the coins bought in every market, built from
+        our own trades (see OrderHistory) and updated with new trades only.
+        Per market the bought amounts are kept as lots (amount, cost
+        including fees) which sells consume oldest first, realizing the
+        difference between proceeds (after fees) and the cost of the lots.
+    '''
+    def __init__(self):
+        # market -> deque of [amount, cost], oldest first
+        self._lots = {}
+        # market -> [held amount, cost] (sums over the lots)
+        self._totals = {}
+        self._realized = {}
+        # market -> globalTradeID of the last processed trade
+        self._marks = {}
+
+    def marks(self) -> dict:
+        return dict(self._marks)
+
+    def update(self, orders) -> int:
+        ''' processes the trades in @orders (OrderHistory) which have not
+            been processed yet and returns their number '''
+        count = 0
+        for market, trades in orders.trades_since(self._marks).items():
+            for trade in trades:
+                self.add(market, trade)
+            count += len(trades)
+        return count
+
+    def add(self, market, trade):
+        ''' processes a single @trade of @market - trades of a market have
+            to be added in order '''
+        lots = self._lots.setdefault(market, deque())
+        totals = self._totals.setdefault(market, [0., 0.])
+        fee = trade.get('fee', 0.)
+        if trade['type'] == 'buy':
+            # the fee gets taken from the bought coins
+            lot = [trade['amount'] * (1. - fee), trade['total']]
+            lots.append(lot)
+            totals[0] += lot[0]
+            totals[1] += lot[1]
+        else:
+            assert trade['type'] == 'sell'
+            amount, cost = trade['amount'], 0.
+            while amount > 0 and lots:
+                lot = lots[0]
+                if lot[0] > amount:
+                    part = lot[1] * amount / lot[0]
+                    lot[0] -= amount
+                    lot[1] -= part
+                    cost += part
+                    amount = 0.
+                    break
+                amount -= lot[0]
+                cost += lot[1]
+                lots.popleft()
+            if lots:
+                totals[0] -= trade['amount'] - amount
+                totals[1] -= cost
+            else:
+                # no rounding errors left behind
+                totals[:] = [0., 0.]
+            # coins not bought here (e.g. deposits) count without cost
+            self._realized[market] = (self._realized.get(market, 0.) +
+                                      trade['total'] * (1. - fee) - cost)
+        self._marks[market] = trade['globalTradeID']
+
+    def amount(self, market) -> float:
+        return self._totals.get(market, (0., 0.))[0]
+
+    def cost(self, market, amount=None) -> float:
+        ''' returns the cost of the coins held from @market - of the newest
+            @amount of them if given (the oldest ones get sold first) '''
+        if amount is None:
+            return self._totals.get(market, (0., 0.))[1]
+        return _newest_cost(self._lots.get(market, ()), amount)
+
+    def realized(self, market) -> float:
+        return self._realized.get(market, 0.)
+
+    def valuation(self, rates) -> np.ndarray:
+        ''' returns amount, cost, realized P&L, value and unrealized P&L of
+            every market with trades as array of VALUATION_DTYPE, valued at
+            @rates (market -> current rate, missing rates count as 0) '''
+        return _valuation(self._totals, self._realized, rates)
+
+    def ledger(self) -> 'Ledger':
+        ''' returns an immutable copy of the current state '''
+        return Ledger(
+            lots=MappingProxyType({market: tuple(map(tuple, lots))
+                                   for market, lots in self._lots.items()}),
+            totals=MappingProxyType({market: tuple(totals) for market, totals
+                                     in self._totals.items()}),
+            profits=MappingProxyType(dict(self._realized)))
+
+
+class Ledger(namedtuple('Ledger', ('lots', 'totals', 'profits'))):
+    ''' immutable state of a CostBasis (see CostBasis.ledger()) which can be
+        read from any thread: market -> tuple of (amount, cost) lots, market
+        -> (held amount, cost) and market -> realized P&L '''
+    __slots__ = ()
+
+    @classmethod
+    def empty(cls):
+        return cls(MappingProxyType({}), MappingProxyType({}),
+                   MappingProxyType({}))
+
+    def amount(self, market) -> float:
+        return self.totals.get(market, (0., 0.))[0]
+
+    def cost(self, market, amount=None) -> float:
+        ''' see CostBasis.cost() '''
+        if amount is None:
+            return self.totals.get(market, (0., 0.))[1]
+        return _newest_cost(self.lots.get(market, ()), amount)
+
+    def realized(self, market) -> float:
+        return self.profits.get(market, 0.)
+
+    def valuation(self, rates) -> np.ndarray:
+        ''' see CostBasis.valuation() '''
+        return _valuation(self.totals, self.profits, rates)
+
+
+def _newest_cost(lots, amount) -> float:
+    ''' cost of the newest @amount of coins in @lots (oldest first) '''
+    cost = 0.
+    for lot_amount, lot_cost in reversed(lots):
+        if amount <= 0: break
+        if lot_amount > amount:
+            return cost + lot_cost * amount / lot_amount
+        amount -= lot_amount
+        cost += lot_cost
+    return cost
+
+
+def _valuation(totals, realized, rates) -> np.ndarray:
+    markets = sorted(set(totals) | set(realized))
+    result = np.zeros(len(markets), VALUATION_DTYPE)
+    result['market'] = markets
+    result['amount'], result['cost'] = np.array(
+        [totals.get(m, (0., 0.)) for m in markets],
+        np.float64).reshape(-1, 2).T
+    result['realized'] = [realized.get(m, 0.) for m in markets]
+    result['value'] = result['amount'] * np.array(
+        [rates.get(m, 0.) for m in markets], np.float64)
+    result['unrealized'] = result['value'] - result['cost']
+    return result
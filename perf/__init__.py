@@ -0,0 +1,137 @@
+''' lightweight timers and counters for finding out where time goes
+'''
+import sys
+import time
+import json
+import csv
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+
+__all__ = ['enable', 'enabled', 'timed', 'timer', 'count', 'stats', 'reset',
+           'report', 'export']
+
+# timing is off unless enabled - decorated functions only check this flag
+_ENABLED = False
+_LOCK = threading.Lock()
+# name -> [calls, total seconds, max seconds, items]
+_TIMERS = {}
+# name -> value
+_COUNTERS = {}
+
+
+def enable(flag=True):
+    global _ENABLED
+    _ENABLED = flag
+
+
+def enabled() -> bool:
+    return _ENABLED
+
+
+def _add(name, duration, items):
+    with _LOCK:
+        entry = _TIMERS.get(name)
+        if entry is None:
+            _TIMERS[name] = [1, duration, duration, items]
+        else:
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+            entry[3] += items
+
+
+@contextmanager
+def _timer(name, items):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add(name, time.perf_counter() - start, items)
+
+
+_NOT_TIMED = nullcontext()
+
+
+def timer(name, items=0):
+    ''' context manager timing its body as stage @name which processed
+        @items items (e.g. trades) '''
+    return _timer(name, items) if _ENABLED else _NOT_TIMED
+
+
+def timed(name=None):
+    ''' decorator timing every call of a function as stage @name (defaults
+        to the qualified name of the function) '''
+    def decorate(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _add(label, time.perf_counter() - start, 0)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1):
+    ''' adds @value to counter @name (only if enabled) '''
+    if not _ENABLED: return
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def stats() -> dict:
+    ''' returns {'timers': {name: {calls, total, mean, max, items}},
+                 'counters': {name: value}} '''
+    with _LOCK:
+        return {
+            'timers': {name: {'calls': calls, 'total': total,
+                              'mean': total / calls, 'max': longest,
+                              'items': items}
+                       for name, (calls, total, longest, items)
+                       in _TIMERS.items()},
+            'counters': dict(_COUNTERS)}
+
+
+def reset():
+    with _LOCK:
+        _TIMERS.clear()
+        _COUNTERS.clear()
+
+
+def report(file=None):
+    ''' prints timers (longest total first) and counters - note that stages
+        can contain other stages '''
+    file = file or sys.stderr
+    data = stats()
+    print('%-36s %8s %10s %10s %10s %10s' % (
+        'stage', 'calls', 'total/s', 'mean/ms', 'max/ms', 'items'), file=file)
+    for name, entry in sorted(data['timers'].items(),
+                              key=lambda e: -e[1]['total']):
+        print('%-36s %8d %10.3f %10.3f %10.3f %10d' % (
+            name, entry['calls'], entry['total'], entry['mean'] * 1000,
+            entry['max'] * 1000, entry['items']), file=file)
+    for name, value in sorted(data['counters'].items()):
+        print('%-36s %8s %10s' % (name, '', value), file=file)
+
+
+def export(filename):
+    ''' writes stats() to @filename as CSV (if it ends with .csv) or JSON '''
+    data = stats()
+    with open(filename, 'w', newline='') as f:
+        if not filename.endswith('.csv'):
+            json.dump(data, f, indent=2, sort_keys=True)
+            return
+        writer = csv.writer(f)
+        writer.writerow(('kind', 'name', 'calls', 'total', 'mean', 'max',
+                         'items'))
+        for name, e in sorted(data['timers'].items()):
+            writer.writerow(('timer', name, e['calls'], e['total'],
+                             e['mean'], e['max'], e['items']))
+        for name, value in sorted(data['counters'].items()):
+            writer.writerow(('counter', name, '', value, '', '', ''))
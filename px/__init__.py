@@ -1,67 +1,234 @@
 
-from ..util import fetch_http, json_mod
+from ..util import (fetch_http, fetch_http_stream, iter_json_array,
+                    NotAnArray, RequestRejected, json_mod)
+from ..store import TradeStore
+from .. import perf
 
 import time
+import calendar
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from itertools import islice
 from urllib.parse import urlencode
 from urllib.request import Request
 import hmac
 import hashlib
 import logging as log
-from datetime import datetime
+import numpy as np
 
+def _identity(x):
+    return x
+
+_CONVERTERS = {
+    'date': _identity,
+    'type': _identity,
+    'category': _identity,
+    'tradeID': int,
+    'globalTradeID': int,
+    'orderNumber': int,
+    'id': int,
+    'total': float,
+    'amount': float,
+    'rate': float,
+    'fee': float,
+    'baseVolume': float,
+    'high24hr': float,
+    'highestBid': float,
+    'last': float,
+    'low24hr': float,
+    'lowestAsk': float,
+    'percentChange': float,
+    'quoteVolume': float,
+    'startingAmount': float,
+    'margin': float,
+    'isFrozen': lambda x: x != '0',
+}
+
+# hour (seconds since epoch / 3600 of a date read as UTC) -> the difference
+# between mktime() of that date and the date read as UTC
+_LOCAL_OFFSETS = {}
+
+
+def _local_offset(hour):
+    try:
+        return _LOCAL_OFFSETS[hour]
+    except KeyError:
+        utc = hour * 3600
+        offset = time.mktime(time.gmtime(utc)[:8] + (-1,)) - utc
+        _LOCAL_OFFSETS[hour] = offset
+        return offset
+
+
+def parse_date(date: str) -> float:
+    ''' fast version of
+        time.mktime(datetime.strptime(date, '%Y-%m-%d %H:%M:%S').timetuple())
+        - time.altzone
+        which is how 'time' has always been computed from 'date' '''
+    utc = calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                           int(date[11:13]), int(date[14:16]),
+                           int(date[17:19])))
+    return utc + _local_offset(utc // 3600) - time.altzone
+
+
+def parse_dates(dates) -> np.ndarray:
+    ''' vectorized parse_date() '''
+    utc = np.array(dates, dtype='datetime64[s]').astype(np.int64)
+    hours, index = np.unique(utc // 3600, return_inverse=True)
+    offsets = np.array([_local_offset(int(h)) for h in hours], np.float64)
+    return utc + offsets[index] - time.altzone
+
+
+@perf.timed()
 def translate_dataset(data: dict) -> dict:
-    result = {key: {
-        'date': lambda x: x,
-        'type': lambda x: x,
-        'category': lambda x: x,
-        'tradeID': int,
-        'globalTradeID': int,
-        'orderNumber': int,
-        'id': int,
-        'total': float,
-        'amount': float,
-        'rate': float,
-        'fee': float,
-        'baseVolume': float,
-        'high24hr': float,
-        'highestBid': float,
-        'last': float,
-        'low24hr': float,
-        'lowestAsk': float,
-        'percentChange': float,
-        'quoteVolume': float,
-        'startingAmount': float,
-        'margin': float,
-        'isFrozen': lambda x: x != '0',
-        }[key](v) for key, v in data.items()}
+    result = {key: _CONVERTERS[key](v) for key, v in data.items()}
 
     if 'date' in data:
-        result['time'] = (time.mktime(datetime.strptime(
-            data['date'], '%Y-%m-%d %H:%M:%S').timetuple()) - time.altzone)
+        result['time'] = parse_date(data['date'])
     return result
 
+
+@perf.timed()
+def decode_trade_history(records: list) -> TradeStore:
+    ''' turns a returnTradeHistory response (newest trades first) into a
+        TradeStore (oldest trades first) without dust trades '''
+    if not records: return TradeStore()
+    count = len(records)
+    perf.count('trades.decoded', count)
+
+    def column(key, convert, dtype):
+        return np.fromiter(map(convert, map(itemgetter(key), records)),
+                           dtype, count)
+
+    amount = column('amount', float, np.float64)
+    total = column('total', float, np.float64)
+    keep = (amount > 0.000001) & (total > 0.000001)
+    columns = {
+        'time': parse_dates(list(map(itemgetter('date'), records))),
+        'rate': column('rate', float, np.float64),
+        'amount': amount,
+        'total': total,
+        'globalTradeID': column('globalTradeID', int, np.int64),
+        'buy': column('type', 'buy'.__eq__, np.bool_),
+    }
+    order = np.flatnonzero(keep)[::-1]
+    return TradeStore({key: values[order] for key, values in columns.items()})
+
+@perf.timed()
+def stream_trade_history(chunks, batch_size=4096) -> tuple:
+    ''' decodes a returnTradeHistory response given as chunks of bytes in
+        batches of @batch_size records instead of parsing it as a whole -
+        returns the trades and the number of records (including dust) '''
+    result = TradeStore()
+    records = iter_json_array(chunks)
+    count = 0
+    try:
+        for batch in iter(lambda: list(islice(records, batch_size)), []):
+            result.prepend(decode_trade_history(batch))
+            count += len(batch)
+    except NotAnArray as exc:
+        if isinstance(exc.value, dict) and 'error' in exc.value:
+            raise RuntimeError(exc.value['error'])
+        raise
+    return result, count
+
+class NonceSequencer:
+    ''' hands out strictly increasing nonces (milliseconds since epoch as
+        long as requests don't come faster) - shared by all threads '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = 0
+
+    def __call__(self) -> int:
+        with self._lock:
+            self._last = max(self._last + 1, int(time.time() * 1000))
+            return self._last
+
+    def skip(self, nonce):
+        ''' makes sure all following nonces are bigger than @nonce '''
+        with self._lock:
+            self._last = max(self._last, nonce)
+
+
+# e.g. 'Nonce must be greater than 1500000000123. You provided 1500000000100.'
+_NONCE_ERROR = re.compile(r'nonce must be greater than (\d+)', re.IGNORECASE)
+
+
 class PxApi:
+    # returnTradeHistory returns at most this many (the newest) trades
+    TRADE_HISTORY_LIMIT = 50000
+    # number of private requests in flight at once (see in_parallel())
+    PRIVATE_WORKERS = 3
+    # how often a request with an outdated nonce gets signed and sent again
+    # - every request in flight can overtake it once per attempt
+    NONCE_RETRIES = 10
+
     def __init__(self, key, secret):
         self._key = key.encode()
         self._secret = secret.encode()
+        self._nonce = NonceSequencer()
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
     def _private_request(self, command, req=None):
-        request_data = {**(req if req else {}),
-                        **{'command': command,
-                           'nonce': int(time.time() * 1000)}}
-        post_data = urlencode(request_data).encode()
-        sign = hmac.new(
-            self._secret,
-            msg=post_data,
-            digestmod=hashlib.sha512).hexdigest()
-        request = Request(
-            'ipAgnidart/moc.xeinolop//:sptth'[::-1],
-            data=post_data,
-            headers={'Sign': sign, 'Key': self._key})
-        result = json_mod.loads(fetch_http(request, request_data))
-        if 'error' in result:
-            raise RuntimeError(result['error'])
-        return result
+        ''' signs and sends a private request - can be called from any
+            thread. Requests sent concurrently can reach the server in
+            another order than their nonces, the ones rejected for that
+            get sent again with a new nonce. '''
+        for attempt in range(self.NONCE_RETRIES + 1):
+            request_data = {**(req if req else {}),
+                            **{'command': command,
+                               'nonce': self._nonce()}}
+            post_data = urlencode(request_data).encode()
+            sign = hmac.new(
+                self._secret,
+                msg=post_data,
+                digestmod=hashlib.sha512).hexdigest()
+            request = Request(
+                'ipAgnidart/moc.xeinolop//:sptth'[::-1],
+                data=post_data,
+                headers={'Sign': sign, 'Key': self._key})
+            try:
+                result = json_mod.loads(fetch_http(request, request_data))
+            except RequestRejected as exc:
+                try:
+                    result = json_mod.loads(exc.body.decode())
+                except ValueError:
+                    raise exc from None
+            if not isinstance(result, dict) or 'error' not in result:
+                return result
+            match = _NONCE_ERROR.search(str(result['error']))
+            if not match or attempt == self.NONCE_RETRIES:
+                raise RuntimeError(result['error'])
+            log.debug('resend %r: %r', command, result['error'])
+            perf.count('px.nonce_retries')
+            self._nonce.skip(int(match.group(1)))
+
+    def _private_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.PRIVATE_WORKERS,
+                    thread_name_prefix='px-private')
+            return self._executor
+
+    def submit(self, function, *args, **kwargs):
+        ''' runs @function (e.g. get_balances) on the pool for private
+            requests and returns a Future '''
+        return self._private_executor().submit(function, *args, **kwargs)
+
+    def in_parallel(self, *functions) -> list:
+        ''' calls all @functions (without arguments, e.g. get_balances and
+            get_open_orders) concurrently and returns their results '''
+        futures = [self.submit(function) for function in functions]
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
 
 
     @staticmethod
@@ -76,7 +243,16 @@ class PxApi:
         return result
 
     @staticmethod
-    def _get_trade_history(currency_pair, start=None, stop=None) -> dict:
+    def _public_request_stream(command: str, req: dict, consume):
+        ''' like _public_request() but passes the chunks of the response to
+            @consume instead of parsing them '''
+        request_data = {**req, **{'command': command}}
+        post_data = '&'.join(['%s=%s' % (k, v) for k, v in request_data.items()])
+        request = '?cilbup/moc.xeinolop//:sptth'[::-1] + post_data
+        return fetch_http_stream(request, request_data, consume)
+
+    @staticmethod
+    def _get_trade_history(currency_pair, start=None, stop=None) -> tuple:
         request = {'currencyPair': currency_pair}
         now = time.time()
         if start is not None:  #ignore stop if start is not given
@@ -85,17 +261,20 @@ class PxApi:
                           (now - (360 * 24 * 3600)) if start == 0 else
                           start),
                 'end': (now + 60) if stop is None else stop})
-        translated = (translate_dataset(t)
-                      for t in PxApi._public_request(
-                          'returnTradeHistory', request))
-        cleaned = [e for e in translated
-                   if e['amount'] > 0.000001 and e['total'] > 0.000001]
-        return list(reversed(list(cleaned)))
+        return PxApi._public_request_stream(
+            'returnTradeHistory', request, stream_trade_history)
 
     @staticmethod
-    def get_trade_history(primary, coin, start, stop=None) -> dict:
-        return (PxApi._get_trade_history(primary + '_' + coin, start, stop)
-                if primary != coin else [])
+    def get_trade_history(primary, coin, start, stop=None) -> TradeStore:
+        return (PxApi._get_trade_history(primary + '_' + coin, start, stop)[0]
+                if primary != coin else TradeStore())
+
+    @staticmethod
+    def get_trade_window(market, start, end) -> tuple:
+        ''' returns the trades of @market between @start and @end and
+            whether older trades inside the window have been cut off '''
+        trades, count = PxApi._get_trade_history(market, start, end)
+        return trades, count >= PxApi.TRADE_HISTORY_LIMIT
 
     @staticmethod
     def get_ticker() -> dict:
@@ -122,13 +301,22 @@ class PxApi:
                     'returnOpenOrders', {'currencyPair': 'all'}).items()
                 if order_list}
 
-    def get_order_history(self, start=1489266632) -> dict:
+    # returnTradeHistory returns at most this many of our own trades
+    ORDER_HISTORY_LIMIT = 10000
+
+    def get_order_history(self, start=1489266632, end=None,
+                          limit=ORDER_HISTORY_LIMIT) -> dict:
+        ''' returns market -> own trades (newest first) between @start and
+            @end (default: now) '''
+        result = self._private_request(
+            'returnTradeHistory', {
+                'currencyPair': 'all',
+                'start': start,
+                'end': time.time() + 60 if end is None else end,
+                'limit': limit})
+        # there is an empty list instead of a dict if there are no trades
         return {c: [translate_dataset(o) for o in order_list]
-                for c, order_list in self._private_request(
-                    'returnTradeHistory', {
-                        'currencyPair': 'all',
-                        'start': start,
-                        'end': time.time() + 60}).items()}
+                for c, order_list in (result or {}).items()}
 
     def place_order(self, *,
                     market: str,
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import signal
 import logging as log
@@ -7,8 +8,13 @@ from PyQt4 import QtGui, QtCore, Qt
 import qwt
 from enum import Enum
 
+from ..downsample import MinMaxIndex
+
 GLOBAL = []
 
+# minimum time between two replots caused by appended data (ms)
+REPLOT_INTERVAL = 500
+
 
 class DataPlot(qwt.QwtPlot):
 
@@ -20,12 +26,62 @@ class DataPlot(qwt.QwtPlot):
         self.enableAxis(qwt.QwtPlot.yLeft, True)
         self.axisWidget(qwt.QwtPlot.yLeft).scaleDraw().setMinimumExtent(100)
 
+        # curves are drawn with as many points as there are pixels - the
+        # points get picked again whenever the visible range changes
+        self._curves = {}
+        self._updating = False
+        self.axisWidget(qwt.QwtPlot.xBottom).scaleDivChanged.connect(
+            self.update_level_of_detail)
+        # appended points get shown at most every REPLOT_INTERVAL ms
+        self._replot_timer = QtCore.QTimer(self)
+        self._replot_timer.setSingleShot(True)
+        self._replot_timer.setInterval(REPLOT_INTERVAL)
+        self._replot_timer.timeout.connect(self.update_level_of_detail)
+
     def set_data(self, datax, datay, pen):
+        ''' adds a curve and returns it (see append_data()) '''
         curve = qwt.QwtPlotCurve("Curve 1")
         curve.setRenderHint(qwt.QwtPlotItem.RenderAntialiased)
-        curve.setData(datax, datay)
-        curve.setPen(pen)
+        curve.setPen(easypen(pen))
+        index = MinMaxIndex(datax, datay)
+        self._curves[curve] = index
+        curve.setData(*index.query(*self._visible_range()))
         curve.attach(self)
+        return curve
+
+    def append_data(self, curve, datax, datay):
+        ''' appends points to @curve (returned by set_data()) - the plot
+            gets updated with the next (throttled) replot '''
+        self._curves[curve].append(datax, datay)
+        if not self._replot_timer.isActive():
+            self._replot_timer.start()
+
+    def replace_data(self, curve, datax, datay):
+        ''' replaces all points of @curve (returned by set_data()) '''
+        self._curves[curve] = MinMaxIndex(datax, datay)
+        self.update_level_of_detail()
+
+    def _visible_range(self):
+        width = max(self.canvas().width(), 100)
+        if self.axisAutoScale(qwt.QwtPlot.xBottom):
+            return -float('inf'), float('inf'), width
+        scale = self.axisScaleDiv(qwt.QwtPlot.xBottom)
+        return scale.lowerBound(), scale.upperBound(), width
+
+    def update_level_of_detail(self):
+        if self._updating: return
+        self._updating = True
+        try:
+            visible = self._visible_range()
+            for curve, index in self._curves.items():
+                curve.setData(*index.query(*visible))
+            self.replot()
+        finally:
+            self._updating = False
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_level_of_detail()
 
     def set_y_scale(self, smin, smax):
         self.setAxisScale(qwt.QwtPlot.yLeft, smin, smax)
@@ -52,7 +108,7 @@ class DataPlot(qwt.QwtPlot):
 
 class GraphUI(QtGui.QWidget):
 
-    def __init__(self, title=''):
+    def __init__(self, title='', *, keep=True):
         super().__init__()
         self.setLayout(QtGui.QVBoxLayout())
 
@@ -60,13 +116,19 @@ class GraphUI(QtGui.QWidget):
         self.layout().addWidget(self.plot)
         self.setGeometry(200, 200, 1100, 650)
 
-        GLOBAL.append(self)
+        # windows to be shown have to be kept alive until qtapp.run()
+        if keep:
+            GLOBAL.append(self)
         #self.plot.redraw()
         #self.show()
 
     def set_data(self, xdata, ydata, pen=None):
-        self.plot.set_data(xdata, ydata, easypen(pen))
+        curve = self.plot.set_data(xdata, ydata, easypen(pen))
         self.plot.redraw()
+        return curve
+
+    def append_data(self, curve, xdata, ydata):
+        self.plot.append_data(curve, xdata, ydata)
 
     def add_vmarker(self, pos, pen=None):
         self.plot.add_vmarker(pos, easypen(pen))
@@ -77,15 +139,98 @@ class GraphUI(QtGui.QWidget):
     def add_line(self, x1, y1, x2, y2, pen):
         self.plot.set_data([x1, x2], [y1, y2], easypen(pen))
 
+    def render(self, filename, size=(1100, 650), resolution=96):
+        ''' writes the plot to @filename (format by extension, e.g. .png,
+            .svg or .pdf) without showing it '''
+        render(self.plot, filename, size, resolution)
+
+
+# formats QwtPlotRenderer writes as documents - others get rendered into a
+# QImage and saved by Qt's image writers
+DOCUMENT_FORMATS = {'pdf', 'svg', 'ps'}
+
+
+def render(plot, filename, size=(1100, 650), resolution=96):
+    ''' renders @plot (a DataPlot) with @size pixels into @filename without
+        showing it (needs a QApplication, see application()) '''
+    plot.resize(*size)
+    plot.update_level_of_detail()
+    renderer = qwt.QwtPlotRenderer()
+    if os.path.splitext(filename)[1][1:].lower() in DOCUMENT_FORMATS:
+        renderer.renderDocument(
+            plot, filename,
+            tuple(pixels * 25.4 / resolution for pixels in size), resolution)
+        return
+    image = QtGui.QImage(size[0], size[1], QtGui.QImage.Format_ARGB32)
+    image.fill(QtGui.QColor(Qt.Qt.white).rgb())
+    painter = QtGui.QPainter(image)
+    try:
+        renderer.render(plot, painter, QtCore.QRectF(0, 0, *size))
+    finally:
+        painter.end()
+    if not image.save(filename):
+        raise IOError('could not write %r' % filename)
+
+
+class Dashboard(QtGui.QWidget):
+    ''' one window showing a grid of plots (e.g. one per market) '''
+    def __init__(self, title='', columns=3):
+        super().__init__()
+        self.setWindowTitle(title)
+        self.setLayout(QtGui.QGridLayout())
+        self.setGeometry(100, 100, 1400, 900)
+        self._columns = columns
+        self._plots = {}
+        GLOBAL.append(self)
+
+    def plot(self, name) -> DataPlot:
+        ''' returns the plot called @name - created on first use '''
+        if name not in self._plots:
+            plot = DataPlot(name)
+            count = len(self._plots)
+            self.layout().addWidget(
+                plot, count // self._columns, count % self._columns)
+            self._plots[name] = plot
+        return self._plots[name]
+
+
+def every(interval, callback):
+    ''' calls @callback every @interval ms from the Qt event loop - keep the
+        returned timer '''
+    timer = QtCore.QTimer()
+    timer.timeout.connect(callback)
+    timer.start(interval)
+    return timer
+
+
+def require_display():
+    ''' Qt4 always needs an X display, even if no window gets shown -
+        raises with a hint to use a virtual one if there is none '''
+    if not os.environ.get('DISPLAY'):
+        raise RuntimeError(
+            'Qt4 needs an X display for rendering - run with '
+            'xvfb-run -a (package xvfb)')
+
+
+def application(*, headless=False):
+    ''' creates the QApplication - with @headless set a missing display
+        gets reported early (see require_display()) '''
+    if headless:
+        require_display()
+    app = QtGui.QApplication(sys.argv)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    return app
+
 
 class qtapp:
-    def __init__(self, active=True):
+    ''' context creating the QApplication (see application()) '''
+    def __init__(self, active=True, *, headless=False):
         self._active = active
+        self._headless = headless
 
     def __enter__(self, *args):
         if self._active:
-            self.app = QtGui.QApplication(sys.argv)
-            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            self.app = application(headless=self._headless)
         return self
 
     def __exit__(self, *args):
@@ -132,8 +277,15 @@ class Pen(Enum):
     light_gray_fat = Qt.QPen(Qt.Qt.lightGray, 2, Qt.Qt.SolidLine)
 
 def easypen(pen):
+    ''' turns a Pen, the name of one (e.g. 'gray_fat') or a color name with
+        optional '_fat' suffix into a QPen '''
+    if isinstance(pen, Qt.QPen):
+        return pen
+    if isinstance(pen, Pen):
+        return pen.value
+    if pen in Pen.__members__:
+        return Pen[pen].value
     #  try:
-    return pen.value
     try:
         col, size = pen.split('_')
         size = 2
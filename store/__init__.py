@@ -0,0 +1,419 @@
+''' columnar storage for trade data
+'''
+import os
+import json
+import shutil
+import struct
+import zlib
+import logging as log
+import numpy as np
+
+__all__ = ['ColumnStore', 'TradeStore', 'COLUMNS', 'load_store', 'save_store',
+           'write_store', 'append_journal', 'journal_size']
+
+# name, dtype - 41 bytes per trade instead of a dict with strings
+COLUMNS = (
+    ('time', np.float64),
+    ('rate', np.float64),
+    ('amount', np.float64),
+    ('total', np.float64),
+    ('globalTradeID', np.int64),
+    ('buy', np.bool_),
+)
+
+
+def _readonly(array):
+    array.flags.writeable = False
+    return array
+
+
+class ColumnStore:
+    ''' Rows of data stored as one typed array per column (see COLUMNS).
+        Free capacity is kept on both ends so appending and prepending
+        are amortized O(len(new data)).
+    '''
+    COLUMNS = ()
+
+    def __init__(self, columns=None, *, capacity=0):
+        if columns is None:
+            self._begin = self._end = capacity // 2
+            self._cols = {name: np.empty(capacity, dtype)
+                          for name, dtype in self.COLUMNS}
+            return
+        length = len(columns[self.COLUMNS[0][0]])
+        self._begin, self._end = 0, length
+        self._cols = {name: np.asarray(columns[name], dtype)
+                      for name, dtype in self.COLUMNS}
+        assert all(len(c) == length for c in self._cols.values())
+
+    @classmethod
+    def convert(cls, data) -> 'ColumnStore':
+        return data if isinstance(data, cls) else cls(data)
+
+    def column(self, name):
+        ''' returns a (read only) view on column @name '''
+        return _readonly(self._cols[name][self._begin:self._end])
+
+    def columns(self) -> dict:
+        return {name: self.column(name) for name, _ in self.COLUMNS}
+
+    def nbytes(self):
+        return sum(c.itemsize for c in self._cols.values()) * len(self)
+
+    def __len__(self):
+        return self._end - self._begin
+
+    def __bool__(self):
+        return self._end > self._begin
+
+    def __repr__(self):
+        return '%s(len=%d)' % (self.__class__.__name__, len(self))
+
+    def _record(self, index):
+        i = self._begin + index
+        return {name: c[i].item() for name, c in self._cols.items()}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('only contiguous slices are supported')
+            begin = self._begin + start
+            end = self._begin + max(start, stop)
+            return self.__class__({name: _readonly(c[begin:end])
+                                   for name, c in self._cols.items()})
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('%s index out of range' % self.__class__.__name__)
+        return self._record(index)
+
+    def __iter__(self):
+        return (self._record(i) for i in range(len(self)))
+
+    def _reserve(self, front, back):
+        ''' make sure there is room for @front elements before and @back
+            elements after the current data - grows geometrically '''
+        first = self._cols[self.COLUMNS[0][0]]
+        if (first.flags.writeable and self._begin >= front and
+                len(first) - self._end >= back):
+            return
+        length = len(self)
+        spare = max(length // 2, 1024)
+        new_begin = front + (spare if front else 0)
+        new_capacity = new_begin + length + back + (spare if back else 0)
+        cols = {}
+        for name, dtype in self.COLUMNS:
+            col = np.empty(new_capacity, dtype)
+            col[new_begin:new_begin + length] = (
+                self._cols[name][self._begin:self._end])
+            cols[name] = col
+        self._cols = cols
+        self._begin, self._end = new_begin, new_begin + length
+
+    def append(self, other):
+        other = self.convert(other)
+        count = len(other)
+        if not count: return
+        self._reserve(0, count)
+        for name, col in self._cols.items():
+            col[self._end:self._end + count] = other.column(name)
+        self._end += count
+
+    def prepend(self, other):
+        other = self.convert(other)
+        count = len(other)
+        if not count: return
+        self._reserve(count, 0)
+        for name, col in self._cols.items():
+            col[self._begin - count:self._begin] = other.column(name)
+        self._begin -= count
+
+    def truncate(self, length):
+        ''' drop everything behind the first @length elements (negative
+            values count from the end like slices do) '''
+        if length < 0:
+            length += len(self)
+        self._end = self._begin + max(0, min(length, len(self)))
+
+    def drop_front(self, count):
+        ''' drop the first @count elements '''
+        self._begin = min(self._begin + max(0, count), self._end)
+
+    def clear(self):
+        self._begin = self._end = 0
+        self._cols = {name: np.empty(0, dtype) for name, dtype in self.COLUMNS}
+
+
+class TradeStore(ColumnStore):
+    ''' Time ordered trades stored as one typed array per column.
+        Iterating and indexing yields dicts like the ones returned by
+        translate_dataset() so old code working on lists keeps working.
+    '''
+    COLUMNS = COLUMNS
+
+    @classmethod
+    def convert(cls, data) -> 'TradeStore':
+        return cls.from_dicts(data)
+
+    @staticmethod
+    def from_dicts(data) -> 'TradeStore':
+        if isinstance(data, TradeStore):
+            return data
+        return TradeStore({
+            'time': [d['time'] for d in data],
+            'rate': [d.get('rate', 0.) for d in data],
+            'amount': [d.get('amount', 0.) for d in data],
+            'total': [d.get('total', 0.) for d in data],
+            'globalTradeID': [d['globalTradeID'] for d in data],
+            'buy': [d.get('type') == 'buy' for d in data],
+        })
+
+    def to_dicts(self) -> list:
+        return [self._record(i) for i in range(len(self))]
+
+    @property
+    def time(self):
+        return self.column('time')
+
+    @property
+    def rate(self):
+        return self.column('rate')
+
+    @property
+    def amount(self):
+        return self.column('amount')
+
+    @property
+    def total(self):
+        return self.column('total')
+
+    @property
+    def gid(self):
+        return self.column('globalTradeID')
+
+    @property
+    def buy(self):
+        return self.column('buy')
+
+    def index_of_gid(self, gid) -> int:
+        ''' returns the position of the first trade with a globalTradeID
+            not smaller than @gid (trades are ordered by globalTradeID) '''
+        return int(np.searchsorted(self.gid, gid))
+
+    def index_of_time(self, t) -> int:
+        ''' returns the position of the first trade not older than @t '''
+        return int(np.searchsorted(self.time, t))
+
+    def _record(self, index):
+        i = self._begin + index
+        c = self._cols
+        return {'time': float(c['time'][i]),
+                'rate': float(c['rate'][i]),
+                'amount': float(c['amount'][i]),
+                'total': float(c['total'][i]),
+                'globalTradeID': int(c['globalTradeID'][i]),
+                'type': 'buy' if c['buy'][i] else 'sell'}
+
+
+# on disk a TradeStore is a directory containing one raw little endian file
+# per column plus meta.json which holds the number of valid records. Data
+# behind that count (e.g. from an interrupted append) is ignored.
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+
+
+def _column_file(directory, name):
+    return os.path.join(directory, name + '.bin')
+
+
+def _disk_dtype(dtype):
+    return np.dtype(dtype).newbyteorder('<')
+
+
+def read_meta(directory) -> dict:
+    ''' returns the meta data of the store saved in @directory or None '''
+    try:
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta.get('version') != FORMAT_VERSION:
+        raise ValueError('unsupported trade store version in %r: %r' % (
+            directory, meta.get('version')))
+    return meta
+
+
+def _write_meta(directory, store, **extra):
+    meta = {'version': FORMAT_VERSION,
+            'count': len(store),
+            'first_gid': int(store.gid[0]) if store else None,
+            'last_gid': int(store.gid[-1]) if store else None}
+    meta.update(extra)
+    filename = os.path.join(directory, META_FILE)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + '.tmp', filename)
+
+
+def load_store(directory) -> TradeStore:
+    ''' memory maps the store saved in @directory and applies the journal
+        - the returned store gets copied on its first modification '''
+    old_dir = directory.rstrip(os.sep) + '.old'
+    if not os.path.isdir(directory) and os.path.isdir(old_dir):
+        # write_store() got interrupted while swapping directories
+        os.rename(old_dir, directory)
+    meta = read_meta(directory)
+    if meta is None:
+        raise FileNotFoundError(directory)
+    count = meta['count']
+    store = TradeStore({
+        name: np.memmap(_column_file(directory, name), mode='r',
+                        dtype=_disk_dtype(dtype), shape=(count,))
+        for name, dtype in COLUMNS}) if count else TradeStore()
+    return _replay_journal(store, directory)
+
+
+def write_store(store, directory):
+    ''' (re)writes @store to @directory (without journal) - the old content
+        gets replaced only after the new one has been written completely '''
+    tmp_dir = directory.rstrip(os.sep) + '.tmp'
+    old_dir = directory.rstrip(os.sep) + '.old'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, dtype in COLUMNS:
+        with open(_column_file(tmp_dir, name), 'wb') as f:
+            f.write(np.ascontiguousarray(
+                store.column(name), _disk_dtype(dtype)).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+    _write_meta(tmp_dir, store)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(directory):
+        os.rename(directory, old_dir)
+    os.rename(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def append_store(store, directory, meta):
+    ''' appends the part of @store behind the @meta['count'] records already
+        saved in @directory without rewriting them '''
+    count = meta['count']
+    for name, dtype in COLUMNS:
+        dtype = _disk_dtype(dtype)
+        with open(_column_file(directory, name), 'r+b') as f:
+            # drop leftovers from an interrupted append
+            f.truncate(count * dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(
+                store.column(name)[count:], dtype).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+    _write_meta(directory, store)
+
+
+def save_store(store, directory):
+    ''' saves @store to @directory, appending only if possible '''
+    meta = read_meta(directory) if os.path.isdir(directory) else None
+    if journal_size(directory):
+        meta = None
+    count = meta['count'] if meta else 0
+    if (count and count <= len(store) and
+            meta['first_gid'] == int(store.gid[0]) and
+            meta['last_gid'] == int(store.gid[count - 1])):
+        if count < len(store):
+            append_store(store, directory, meta)
+        return
+    write_store(store, directory)
+
+
+# Changes since the last complete write are appended to JOURNAL_FILE as
+# records of <header><payload>. A record either appends or prepends a
+# segment of trades or drops trades older than a given globalTradeID.
+# Replaying a record is idempotent so a journal that has been written
+# completely before it got discarded (or a torn last record) is harmless.
+JOURNAL_FILE = 'journal.bin'
+APPEND, PREPEND, DROP = b'A', b'P', b'D'
+_JOURNAL_MAGIC = b'MFTJ'
+_JOURNAL_HEADER = struct.Struct('<4sc3xIqI')
+_RECORD_DTYPE = np.dtype([(name, _disk_dtype(dtype))
+                          for name, dtype in COLUMNS])
+
+
+def _pack(store):
+    records = np.empty(len(store), _RECORD_DTYPE)
+    for name, _ in COLUMNS:
+        records[name] = store.column(name)
+    return records.tobytes()
+
+
+def _unpack(payload):
+    records = np.frombuffer(payload, _RECORD_DTYPE)
+    return TradeStore({name: records[name] for name, _ in COLUMNS})
+
+
+def journal_size(directory) -> int:
+    try:
+        return os.path.getsize(os.path.join(directory, JOURNAL_FILE))
+    except FileNotFoundError:
+        return 0
+
+
+def append_journal(directory, entries):
+    ''' appends @entries (list of (APPEND|PREPEND, TradeStore) or
+        (DROP, globalTradeID)) to the journal in @directory '''
+    chunks = []
+    for kind, value in entries:
+        if kind == DROP:
+            payload, count, gid = b'', 0, int(value)
+        else:
+            payload, count, gid = _pack(value), len(value), 0
+        chunks.append(_JOURNAL_HEADER.pack(
+            _JOURNAL_MAGIC, kind, count, gid, zlib.crc32(payload)))
+        chunks.append(payload)
+    with open(os.path.join(directory, JOURNAL_FILE), 'ab') as f:
+        f.write(b''.join(chunks))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def replay(store, kind, value):
+    ''' applies a journal entry to @store - this is a no-op for data which
+        is already contained '''
+    if kind == DROP:
+        store.drop_front(store.index_of_gid(value))
+    elif not store:
+        store.append(value)
+    elif kind == APPEND:
+        store.truncate(store.index_of_gid(value.gid[0]))
+        store.append(value)
+    elif kind == PREPEND:
+        store.prepend(value[:value.index_of_gid(store.gid[0])])
+
+
+def _replay_journal(store, directory):
+    filename = os.path.join(directory, JOURNAL_FILE)
+    try:
+        with open(filename, 'rb') as f:
+            journal = f.read()
+    except FileNotFoundError:
+        return store
+    position = 0
+    itemsize = _RECORD_DTYPE.itemsize
+    while position + _JOURNAL_HEADER.size <= len(journal):
+        magic, kind, count, gid, crc = _JOURNAL_HEADER.unpack_from(
+            journal, position)
+        begin = position + _JOURNAL_HEADER.size
+        payload = journal[begin:begin + count * itemsize]
+        if (magic != _JOURNAL_MAGIC or len(payload) != count * itemsize or
+                zlib.crc32(payload) != crc):
+            break
+        replay(store, kind, gid if kind == DROP else _unpack(payload))
+        position = begin + len(payload)
+    if position < len(journal):
+        log.warning('drop incomplete journal record in %r', directory)
+        with open(filename, 'r+b') as f:
+            f.truncate(position)
+    return store
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+''' compares the vectorized ema() with the plain Python recursion
+    usage: test/bench_indicators.py [N..]
+'''
+import os, sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import mftl
+
+import numpy as np
+
+
+def ema_loop(data, alpha):
+    alpha_n = 1 - alpha
+    result = []
+    n = data[0]
+    for x in data:
+        n = alpha * x + alpha_n * n
+        result.append(n)
+    return result
+
+
+def timed(fn, *args):
+    t1 = time.time()
+    fn(*args)
+    return time.time() - t1
+
+
+def main():
+    sizes = [int(float(a)) for a in sys.argv[1:]] or [10**6, 10**7]
+    for n in sizes:
+        data = np.random.lognormal(size=n)
+        t_vec = timed(mftl.ema, data, 0.005)
+        t_loop = timed(ema_loop, data.tolist(), 0.005)
+        print('N=%9d  loop: %7.3fs  vectorized: %7.3fs  speedup: %5.1fx' % (
+            n, t_loop, t_vec, t_loop / t_vec))
+
+
+if __name__ == '__main__':
+    main()
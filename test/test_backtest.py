@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import mftl
+import mftl.backtest as bt
+
+import numpy as np
+import pytest
+
+
+def reference(rates, fast, medium, slow, amount=100., fee=bt.FEE):
+    # the per bucket loop Strategy.feed() used to run
+    rates_fast = mftl.sma(rates, fast)
+    rates_medium = mftl.sma(rates, medium)
+    rates_slow = mftl.sma(rates, slow)
+    rates, rates_fast, rates_medium, rates_slow = mftl.trim(
+        rates, rates_fast, rates_medium, rates_slow)
+    amount_C1, amount_C2, last_C1 = amount, 0., amount
+    trades = []
+    for i, d in enumerate(rates):
+        if i == 0: continue
+        action = ('buy' if (rates_fast[i] >= rates_medium[i] and
+                            rates_fast[i - 1] < rates_medium[i - 1] and
+                            rates_fast[i] > rates_slow[i]) else
+                  'sell' if (rates_fast[i] <= rates_medium[i] and
+                             rates_fast[i - 1] > rates_medium[i - 1] and
+                             rates_fast[i] < rates_slow[i]) else
+                  'none')
+        if action == 'buy' and amount_C1:
+            last_C1, amount_C1, amount_C2 = amount_C1, 0., amount_C1 / d * fee
+        elif action == 'sell' and amount_C2:
+            amount_C1, amount_C2 = amount_C2 * d * fee, 0.
+        else:
+            continue
+        trades.append((action, i))
+    if trades and trades[-1][0] == 'buy':
+        del trades[-1]
+        amount_C1 = last_C1
+    return amount_C1 / amount, trades
+
+
+def random_walk(n=3000, seed=1):
+    rng = np.random.RandomState(seed)
+    return 0.01 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+
+
+def test_grid():
+    assert bt.grid([1, 2], [2, 3], [3]).tolist() == [[1, 2, 3]]
+    assert len(bt.grid(range(5, 50), range(10, 100, 5), range(50, 300, 10))) > 1000
+
+
+def test_single_combination_matches_loop():
+    rates = random_walk()
+    for fast, medium, slow in ((3, 7, 20), (30, 50, 250), (5, 6, 7)):
+        gain, trades = reference(rates, fast, medium, slow)
+        averages = bt.moving_averages(rates, (fast, medium, slow))
+        actions = bt.executed(bt.signals(*averages))[0]
+        assert [('buy' if actions[i] > 0 else 'sell', i)
+                for i in np.flatnonzero(actions)] == trades
+        assert bt.evaluate(rates[slow - 1:], actions)[0][0] == pytest.approx(gain)
+
+
+def test_sweep():
+    rates = random_walk()
+    combinations = bt.grid(range(2, 20, 3), range(5, 40, 4), range(20, 120, 15))
+    results = bt.sweep(rates, combinations, max_cells=10000)
+    assert len(results) == len(combinations)
+    slowest = combinations[:, 2].max()
+    for row in results[::17]:
+        f, m, s = int(row['fast']), int(row['medium']), int(row['slow'])
+        # the range is limited by the biggest window of the sweep
+        gain, trades = reference(rates[slowest - s:], f, m, s)
+        assert row['gain'] == pytest.approx(gain)
+        assert row['trades'] == len(trades)
+        assert 0. <= row['drawdown'] < 1.
+    best = bt.ranked(results)
+    assert best['gain'][0] == results['gain'].max()
+    assert bt.ranked(results, 'drawdown')['drawdown'][0] == results['drawdown'].min()
+
+
+def test_drawdown():
+    rates = np.array([1., 1., 2., 1., 4., 4.])
+    actions = np.array([0, 1, 0, 0, 0, -1], np.int8)
+    gain, trades, drawdown = bt.evaluate(rates, actions, fee=1.)
+    assert gain[0] == pytest.approx(4.)
+    assert trades[0] == 2
+    assert drawdown[0] == pytest.approx(0.5)
+
+
+def test_sweep_markets():
+    series = {'BTC_A': random_walk(seed=2), 'BTC_B': random_walk(2000, seed=3),
+              'BTC_C': random_walk(50)}
+    combinations = bt.grid(range(2, 20, 3), range(5, 40, 4), range(20, 120, 15))
+    results = bt.sweep_markets(series, combinations, workers=2)
+    # not enough data for the biggest window
+    assert set(results) == {'BTC_A', 'BTC_B'}
+    for market, result in results.items():
+        expected = bt.sweep(series[market], combinations)
+        assert result.tolist() == expected.tolist()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+from mftl.balances import BalanceHistory, RECORD_DTYPE
+
+import numpy as np
+
+
+def test_only_changes_get_recorded():
+    with tempfile.TemporaryDirectory() as directory:
+        history = BalanceHistory(directory)
+        assert history.record({'BTC': 1., 'ETH': 10.}, t=100.) == 2
+        assert history.record({'BTC': 1., 'ETH': 10.}, t=200.) == 0
+        assert history.record({'BTC': 2.}, t=300.) == 2
+        assert history.coins() == ['BTC', 'ETH']
+        assert history.records('ETH').tolist() == [(100., 10.), (300., 0.)]
+
+        # a new instance continues where the files end
+        history = BalanceHistory(directory)
+        assert history.record({'BTC': 2.}, t=400.) == 0
+        assert history.at('BTC', [50., 100., 250., 300., 1000.]).tolist() == [
+            0., 1., 1., 2., 2.]
+        assert history.value([150., 350.], {
+            'BTC': 1., 'ETH': np.array([0.1, 0.2])}).tolist() == [2., 2.]
+
+
+def test_torn_record_is_ignored():
+    with tempfile.TemporaryDirectory() as directory:
+        history = BalanceHistory(directory)
+        history.record({'BTC': 1.}, t=1.)
+        with open(os.path.join(directory, 'BTC.bin'), 'ab') as f:
+            f.write(b'\0' * 5)
+        history = BalanceHistory(directory)
+        assert len(history.records('BTC')) == 1
+        history.record({'BTC': 3.}, t=2.)
+        assert history.records('BTC').tolist() == [(1., 1.), (2., 3.)]
+        assert os.path.getsize(os.path.join(
+            directory, 'BTC.bin')) == 2 * RECORD_DTYPE.itemsize
+
+
+def test_range_and_downsampled_reads():
+    with tempfile.TemporaryDirectory() as directory:
+        history = BalanceHistory(directory)
+        for i in range(10000):
+            history.record({'BTC': float(i % 100)}, t=float(i))
+        times, amounts = history.series('BTC', 1000.5, 2000.)
+        assert times[0] == 1000. and times[-1] == 2000.
+        assert len(times) == 1001
+        times, amounts = history.series('BTC', width=100)
+        assert len(times) <= 1000
+        assert amounts.max() == 99. and amounts.min() == 0.
+        assert history.series('XMR')[0].tolist() == []
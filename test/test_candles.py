@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import mftl
+from mftl.candles import parse_interval, resample, CandlePyramid
+from mftl.store import TradeStore
+
+import numpy as np
+import pytest
+
+
+def random_trades(n=5000, seed=1):
+    rnd = np.random.RandomState(seed)
+    rate = rnd.uniform(1., 2., n)
+    amount = rnd.uniform(0.1, 5., n)
+    return TradeStore({
+        'time': np.cumsum(rnd.exponential(20., n)),
+        'rate': rate,
+        'amount': amount,
+        'total': rate * amount,
+        'globalTradeID': np.arange(n),
+        'buy': rnd.rand(n) < 0.5})
+
+
+def test_parse_interval():
+    assert parse_interval('5m') == 300
+    assert parse_interval('1d') == 86400
+    assert parse_interval(90) == 90
+    with pytest.raises(ValueError):
+        parse_interval('5x')
+
+
+def test_resample():
+    trades = random_trades()
+    c = resample(trades, '5m')
+    buckets = {}
+    for t in trades:
+        b = buckets.setdefault(int(t['time'] // 300) * 300, [])
+        b.append(t)
+    assert list(c['time']) == sorted(buckets)
+    for i, key in enumerate(sorted(buckets)):
+        b = buckets[key]
+        assert c['open'][i] == b[0]['rate']
+        assert c['close'][i] == b[-1]['rate']
+        assert c['high'][i] == max(t['rate'] for t in b)
+        assert c['low'][i] == min(t['rate'] for t in b)
+        assert c['count'][i] == len(b)
+        assert np.isclose(c['total_buy'][i], sum(
+            t['total'] for t in b if t['type'] == 'buy'))
+        assert np.isclose(c['vwap'][i], sum(t['total'] for t in b) /
+                          sum(t['amount'] for t in b))
+
+
+def test_rate_buckets():
+    h = mftl.TradeHistory('BTC_XMR')
+    h._attach_data(random_trades(100))
+    buckets = h.rate_buckets()
+    assert sum(b['amount_buy'] + b['amount_sell'] for b in buckets) == (
+        pytest.approx(float(h.data().amount.sum())))
+
+
+def assert_candles_equal(c1, c2):
+    assert c1.keys() == c2.keys()
+    for key in c1:
+        assert np.allclose(c1[key], c2[key], rtol=1e-12), key
+
+
+def test_candle_pyramid():
+    trades = random_trades(20000)
+    p = CandlePyramid()
+    # feed in overlapping chunks, older ones last
+    for first, last in ((10000, 15000), (14000, 20000), (0, 10001)):
+        p.update(trades, trades.time[first], trades.time[last - 1])
+    for interval in ('1m', '5m', '15m', '1h', '2h', '1d'):
+        assert_candles_equal(p.query(interval), resample(trades, interval))
+    assert p.level_for('15m') == 300
+    assert p.level_for('30s') is None
+    assert p.level_for_span(24 * 3600, 100) == 300
+
+    begin, end = trades.time[5000], trades.time[6000]
+    assert_candles_equal(
+        p.query('5m', begin, end),
+        resample(trades[trades.index_of_time(begin // 300 * 300):
+                        trades.index_of_time(end // 300 * 300 + 300)], '5m'))
+
+
+def test_trade_history_candles(tmp_path):
+    trades = random_trades(20000)
+    h = mftl.TradeHistory('BTC_XMR')
+    h._attach_data(trades[:15000])
+    h.compact(str(tmp_path))
+    h._attach_data(trades[14000:])
+    h.save(str(tmp_path))
+
+    # candles have been saved with compact() only and get updated on load
+    h2 = mftl.TradeHistory('BTC_XMR')
+    h2.load(str(tmp_path))
+    assert h2._candles.covered() == (trades.time[0], trades.time[-1])
+    assert_candles_equal(h2.candles('1h'), resample(trades, '1h'))
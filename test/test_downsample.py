@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+from mftl.downsample import MinMaxIndex, minmax, FACTOR
+
+import numpy as np
+
+
+def test_small_ranges_are_not_reduced():
+    x = np.arange(100.)
+    index = MinMaxIndex(x, x ** 2)
+    qx, qy = index.query(10, 20, width=1000)
+    assert qx.tolist() == list(range(9, 22))
+    assert (qy == qx ** 2).all()
+
+
+def test_envelope():
+    rng = np.random.RandomState(1)
+    x = np.arange(1000000.)
+    y = np.cumsum(rng.normal(size=len(x)))
+    y[1000:5000] = np.nan
+    index = MinMaxIndex(x, y)
+    for x0, x1, width in ((-np.inf, np.inf, 800), (1e5, 3e5, 500),
+                          (123456, 234567, 1000)):
+        qx, qy = index.query(x0, x1, width)
+        assert len(qx) <= 2 * FACTOR * width + 2
+        assert (np.diff(qx) >= 0).all()
+        # extremes of every pixel survive
+        pixels = np.linspace(max(x0, 0), min(x1, x[-1]), width + 1)
+        inner = (x >= pixels[1]) & (x < pixels[-2])
+        assert np.nanmax(qy) >= np.nanmax(y[inner])
+        assert np.nanmin(qy) <= np.nanmin(y[inner])
+        for a, b in zip(pixels[1::50], pixels[2::50]):
+            inside = (x >= a) & (x < b)
+            if np.isnan(y[inside]).all(): continue
+            shown = (qx >= a - len(x) / width) & (qx < b + len(x) / width)
+            assert np.nanmax(qy[shown]) >= np.nanmax(y[inside])
+            assert np.nanmin(qy[shown]) <= np.nanmin(y[inside])
+    assert len(minmax(x, y, 100)[0]) <= 2 * FACTOR * 100 + 2
+
+
+def test_append():
+    rng = np.random.RandomState(2)
+    x = np.arange(100000.)
+    y = rng.normal(size=len(x))
+    y[500:700] = np.nan
+    whole = MinMaxIndex(x, y)
+    parts = MinMaxIndex()
+    for first, last in ((0, 1), (1, 3), (3, 1000), (1000, 1001),
+                        (1001, 77777), (77777, 100000)):
+        parts.append(x[first:last], y[first:last])
+    assert len(parts) == len(whole)
+    for x0, x1, width in ((-np.inf, np.inf, 300), (500, 90000, 100)):
+        for a, b in zip(whole.query(x0, x1, width), parts.query(x0, x1, width)):
+            assert np.array_equal(a, b, equal_nan=True)
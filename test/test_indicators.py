@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import mftl
+from mftl import indicators
+from mftl.store import TradeStore
+
+import numpy as np
+import pytest
+
+
+def ema_reference(data, alpha):
+    alpha_n = 1 - alpha
+    result = []
+    n = data[0]
+    for x in data:
+        n = alpha * x + alpha_n * n
+        result.append(n)
+    return result
+
+
+@pytest.mark.parametrize('alpha', (0.5, 0.05, 0.005, 0.0001, 1., 0.))
+def test_ema(alpha):
+    data = np.random.RandomState(42).lognormal(size=20000)
+    assert np.allclose(mftl.ema(data, alpha), ema_reference(data, alpha),
+                       rtol=1e-9, atol=0)
+    assert len(mftl.ema([], alpha)) == 0
+
+
+def test_vema():
+    rnd = np.random.RandomState(23)
+    totals = rnd.uniform(0.1, 10., 5000)
+    amounts = rnd.uniform(0.1, 10., 5000)
+    expected = [t / a for t, a in zip(ema_reference(totals, 0.005),
+                                      ema_reference(amounts, 0.005))]
+    assert np.allclose(mftl.vema(totals, amounts, 0.005), expected,
+                       rtol=1e-9, atol=0)
+
+
+def random_trades(n, seed=5):
+    rnd = np.random.RandomState(seed)
+    rate = rnd.uniform(1., 2., n)
+    amount = rnd.uniform(0.1, 5., n)
+    return TradeStore({
+        'time': np.arange(n, dtype=float), 'rate': rate, 'amount': amount,
+        'total': rate * amount, 'globalTradeID': np.arange(n),
+        'buy': rnd.rand(n) < 0.5})
+
+
+def test_streaming_indicators():
+    trades = random_trades(1000)
+    rate = trades.rate
+    assert np.allclose(indicators.SMA(20).feed(trades)[19:],
+                       mftl.sma(rate, 20))
+    assert np.allclose(indicators.EMA(0.05).feed(trades),
+                       mftl.ema(rate, 0.05))
+    assert np.allclose(indicators.VEMA(0.05).feed(trades),
+                       mftl.vema(trades.total, trades.amount, 0.05))
+    assert np.allclose(indicators.RollingMin(7).feed(trades)[6:],
+                       [rate[i - 6:i + 1].min() for i in range(6, 1000)])
+    assert np.allclose(indicators.RollingMax(7).feed(trades)[6:],
+                       [rate[i - 6:i + 1].max() for i in range(6, 1000)])
+    assert np.allclose(indicators.VWAP(30).feed(trades)[29:],
+                       [trades.total[i - 29:i + 1].sum() /
+                        trades.amount[i - 29:i + 1].sum()
+                        for i in range(29, 1000)])
+
+
+def test_trade_history_indicators():
+    trades = random_trades(1000)
+    h = mftl.TradeHistory('BTC_XMR')
+    h.add_indicator('vwap', indicators.VWAP(50))
+    h.add_indicator('ema', indicators.EMA(0.1))
+    h._attach_data(trades[400:600])
+    h._attach_data(trades[550:1000])
+    h._attach_data(trades[0:401])
+    total, amount, _, _ = mftl.sum_trades(trades[-50:])
+    assert h.indicator('vwap').value() == pytest.approx(total / amount)
+    assert h.indicator('ema').value() == pytest.approx(
+        mftl.ema(trades.rate, 0.1)[-1])
+
+
+def test_indicator_is_abstract():
+    with pytest.raises(TypeError):
+        indicators.Indicator()
+
+
+def test_rebuilds_are_bounded():
+    trades = random_trades(20000)
+    ema = indicators.EMA(0.1)
+    assert ema.window == indicators.ema_window(0.1) < 300
+    h = mftl.TradeHistory('BTC_XMR')
+    h.add_indicator('ema', ema)
+    h.add_indicator('vema', indicators.VEMA(0.1))
+    h.add_indicator('vwap', indicators.VWAP())
+    mftl.perf.reset()
+    mftl.perf.enable()
+    try:
+        h._attach_data(trades[10000:])
+        for start in range(9000, -1, -1000):
+            h._attach_data(trades[start:start + 1001])
+        timers = mftl.perf.stats()['timers']
+    finally:
+        mftl.perf.enable(False)
+        mftl.perf.reset()
+    # EMA and VEMA only get fed their window, cumulative VWAP everything
+    assert timers['indicators.EMA']['items'] <= 10000 + ema.window
+    assert timers['indicators.VEMA']['items'] <= 10000 + ema.window
+    assert timers['indicators.VWAP']['items'] > 10 * 10000
+    assert h.indicator('ema').value() == pytest.approx(
+        mftl.ema(trades.rate, 0.1)[-1])
+    assert h.indicator('vema').value() == pytest.approx(
+        mftl.vema(trades.total, trades.amount, 0.1)[-1])
+    total, amount, _, _ = mftl.sum_trades(trades)
+    assert h.indicator('vwap').value() == pytest.approx(total / amount)
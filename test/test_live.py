@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import mftl
+import mftl.live
+
+import numpy as np
+
+
+class FakeApi:
+    TRADE_HISTORY_LIMIT = 1000
+    now = 1e6 + 500.
+
+    trades = mftl.TradeStore.from_dicts([
+        {'globalTradeID': i, 'time': 1e6 + i, 'rate': 1. + i % 7,
+         'amount': 1., 'total': 1. + i % 7, 'type': 'buy'}
+        for i in range(1000)])
+
+    @classmethod
+    def get_trade_window(cls, market, start, end):
+        times = cls.trades.time
+        first = int(np.searchsorted(times, start))
+        last = int(np.searchsorted(times, min(end, cls.now), 'right'))
+        return cls.trades[first:last], False
+
+
+def wait_for(watcher, count):
+    points = []
+    for _ in range(500):
+        points += [p for _, p in watcher.updates()]
+        if sum(len(p['time']) for p in points) >= count:
+            return points
+        time.sleep(0.01)
+    raise AssertionError('timeout')
+
+
+def test_watcher(tmp_path, monkeypatch):
+    monkeypatch.setattr(time, 'time', lambda: FakeApi.now)
+    watcher = mftl.live.Watcher(['BTC_XMR'], FakeApi, interval=0.01,
+                                directory=str(tmp_path))
+    watcher.start()
+    try:
+        first = wait_for(watcher, 1)
+        FakeApi.now = 1e6 + 999.
+        second = wait_for(watcher, 499)
+    finally:
+        watcher.stop(5)
+        FakeApi.now = 1e6 + 500.
+    times = np.concatenate([p['time'] for p in first + second])
+    vema = np.concatenate([p['vema'] for p in first + second])
+    # every trade gets published exactly once, in order
+    assert times.tolist() == FakeApi.trades.time[
+        int(times[0] - 1e6):].tolist()
+    expected = mftl.indicators.VEMA(0.005).feed(
+        FakeApi.trades[int(times[0] - 1e6):])
+    assert np.allclose(vema, expected)
+    # histories get saved when stopping
+    assert 'BTC_XMR' in mftl.TradeHistory.stored_markets(str(tmp_path))
+
+
+def test_scheduler_runs_jobs_independently():
+    runs = {'fast': 0, 'slow': 0, 'broken': 0}
+    release = mftl.live.threading.Event()
+
+    def job(name):
+        def run():
+            runs[name] += 1
+            if name == 'slow':
+                release.wait(5)
+            if name == 'broken':
+                raise RuntimeError('broken')
+        return run
+
+    scheduler = mftl.live.Scheduler(
+        {name: (0.01, job(name)) for name in runs}, tick=0.005)
+    scheduler.start()
+    try:
+        for _ in range(500):
+            if runs['fast'] >= 5 and runs['broken'] >= 2: break
+            time.sleep(0.01)
+        # the slow job blocks neither the others nor gets started twice
+        assert runs['fast'] >= 5 and runs['slow'] == 1
+    finally:
+        release.set()
+        scheduler.stop(5)
+    assert scheduler.failures()['broken'] >= 2
+    assert set(scheduler.completed()) == {'fast', 'slow'}
+
+
+class FakePrivateApi:
+    ORDER_HISTORY_LIMIT = 10000
+    balances = {'BTC': 1.}
+    orders = []
+
+    @classmethod
+    def get_balances(cls):
+        return dict(cls.balances)
+
+    @classmethod
+    def get_order_history(cls, start, end):
+        return {'BTC_XMR': cls.orders[::-1]} if cls.orders else {}
+
+    @staticmethod
+    def get_ticker():
+        return {'BTC_XMR': {}, 'BTC_ETH': {}}
+
+
+def test_trader_data_snapshots(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = mftl.TraderData()
+    before = data.snapshot()
+    jobs = data.refresh_jobs(FakePrivateApi, {'balances': 0.01})
+    assert jobs['balances'][0] == 0.01
+    jobs['balances'][1]()
+    jobs['available_markets'][1]()
+    after = data.snapshot()
+    # taken snapshots don't change
+    assert not before.balances and not before.available_markets
+    assert after.balances == {'BTC': 1.}
+    assert after.available_coins == {'BTC': {'XMR', 'ETH'}}
+    try:
+        after.balances['BTC'] = 2.
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('snapshot is writable')
+
+
+def test_trader_data_ledger_snapshots(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def buy(gid, amount, total):
+        return {'globalTradeID': gid, 'time': 1.6e9 + gid, 'type': 'buy',
+                'rate': total / amount, 'amount': amount, 'total': total}
+
+    monkeypatch.setattr(FakePrivateApi, 'balances', {'XMR': 2.})
+    monkeypatch.setattr(FakePrivateApi, 'orders', [buy(1, 2., 1.)])
+    data = mftl.TraderData()
+    data.update_balances(FakePrivateApi)
+    data.update_trade_history(FakePrivateApi)
+    before = data.snapshot()
+    assert before.ledger.lots == {'BTC_XMR': ((2., 1.),)}
+    assert data.get_asset_cost('XMR') == 1.
+
+    FakePrivateApi.orders = FakePrivateApi.orders + [buy(2, 2., 3.)]
+    data.update_trade_history(FakePrivateApi)
+    # the newest coins are held, taken snapshots keep their ledger
+    assert data.get_asset_cost('XMR') == 3.
+    assert data.ledger().cost('BTC_XMR') == 4.
+    assert data.get_asset_cost('XMR', before) == 1.
+    assert before.ledger.cost('BTC_XMR') == 1.
+    try:
+        before.ledger.lots['BTC_XMR'] = ()
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('ledger is writable')
+
+
+def test_watcher_keeps_stored_history(tmp_path, monkeypatch):
+    # five days of trades, one every ten minutes
+    now = 1e6 + 5 * 24 * 3600.
+    trades = mftl.TradeStore.from_dicts([
+        {'globalTradeID': i, 'time': 1e6 + 600. * i, 'rate': 1.,
+         'amount': 1., 'total': 1., 'type': 'buy'} for i in range(720)])
+
+    class Api:
+        TRADE_HISTORY_LIMIT = 1000
+
+        @staticmethod
+        def get_trade_window(market, start, end):
+            times = trades.time
+            return trades[int(np.searchsorted(times, start)):
+                          int(np.searchsorted(times, end, 'right'))], False
+
+    monkeypatch.setattr(time, 'time', lambda: now)
+    stored = mftl.TradeHistory('BTC_XMR')
+    stored._attach_data(trades[:700])
+    stored.save(str(tmp_path))
+
+    watcher = mftl.live.Watcher(['BTC_XMR'], Api, interval=0.01,
+                                directory=str(tmp_path))
+    watcher.start()
+    try:
+        wait_for(watcher, 720)
+    finally:
+        watcher.stop(5)
+    reloaded = mftl.TradeHistory('BTC_XMR')
+    reloaded.load(str(tmp_path))
+    assert reloaded.data().to_dicts() == trades.to_dicts()
+
+
+def test_watcher_publishes_filled_gaps(tmp_path, monkeypatch):
+    trades = mftl.TradeStore.from_dicts([
+        {'globalTradeID': i, 'time': 1e6 + 10. * i, 'rate': 1. + i % 7,
+         'amount': 1., 'total': 1. + i % 7, 'type': 'buy'}
+        for i in range(1000)])
+
+    class Api:
+        TRADE_HISTORY_LIMIT = 1000
+
+        @staticmethod
+        def get_trade_window(market, start, end):
+            times = trades.time
+            return trades[int(np.searchsorted(times, start)):
+                          int(np.searchsorted(times, end, 'right'))], False
+
+    monkeypatch.setattr(time, 'time', lambda: 1e6 + 10000.)
+    stored = mftl.TradeHistory('BTC_XMR')
+    stored._attach_data(trades[:300])
+    stored._attach_data(trades[600:], allow_gap=True)
+    stored._gaps = [[float(trades.time[299]), float(trades.time[600])]]
+    stored.save(str(tmp_path))
+
+    watcher = mftl.live.Watcher(['BTC_XMR'], Api, interval=0.01,
+                                directory=str(tmp_path))
+    watcher.start()
+    try:
+        series = None
+        for _ in range(500):
+            for _, points in watcher.updates():
+                if series is None or points.get('reset'):
+                    series = points
+                else:
+                    series = {key: np.r_[series[key], points[key]]
+                              for key in ('time', 'rate', 'vema')}
+            if series is not None and len(series['time']) == 1000:
+                break
+            time.sleep(0.01)
+    finally:
+        watcher.stop(5)
+    # the chart shows every trade once and the VEMA has seen all of them
+    assert series['time'].tolist() == trades.time.tolist()
+    assert np.allclose(series['vema'],
+                       mftl.indicators.VEMA(0.005).feed(trades))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import mftl
+import mftl.orders
+
+
+def trade(gid, time):
+    return {'globalTradeID': gid, 'time': time, 'type': 'buy',
+            'rate': 1., 'amount': 1., 'total': 1.}
+
+
+class FakeApi:
+    ORDER_HISTORY_LIMIT = 3
+
+    def __init__(self, trades):
+        # market -> trades, oldest first
+        self.trades = trades
+        self.requests = []
+
+    def get_order_history(self, start, end):
+        self.requests.append((start, end))
+        selected = sorted(
+            ((t['time'], market, t) for market, trades in self.trades.items()
+             for t in trades if start <= t['time'] <= end),
+            key=lambda e: e[0], reverse=True)[:self.ORDER_HISTORY_LIMIT]
+        result = {}
+        for _, market, t in selected:
+            result.setdefault(market, []).append(dict(t))
+        return result
+
+
+def test_sync_pages_and_persists():
+    api = FakeApi({'BTC_ETH': [trade(i, 1.6e9 + i) for i in range(0, 10, 2)],
+                   'BTC_XMR': [trade(i, 1.6e9 + i) for i in range(1, 8, 2)]})
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'orders.jsonl')
+        orders = mftl.orders.OrderHistory(filename)
+        assert orders.sync(api) == 9
+        assert len(api.requests) > 1
+        assert orders.marks() == {'BTC_ETH': 8, 'BTC_XMR': 7}
+        assert [t['globalTradeID'] for t in orders.trades()['BTC_ETH']] == [
+            8, 6, 4, 2, 0]
+
+        # nothing new: one request starting before the newest trade
+        api.requests.clear()
+        assert orders.sync(api) == 0
+        assert len(api.requests) == 1
+        assert api.requests[0][0] > mftl.orders.OrderHistory.FIRST_START
+
+        api.trades['BTC_XMR'].append(trade(11, 1.6e9 + 11))
+        assert orders.sync(api) == 1
+
+        loaded = mftl.orders.OrderHistory(filename)
+        loaded.load()
+        assert loaded.trades() == orders.trades()
+        assert len(loaded) == 10
+
+
+def test_load_drops_torn_line():
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'orders.jsonl')
+        orders = mftl.orders.OrderHistory(filename)
+        orders.merge({'BTC_ETH': [trade(2, 2.), trade(1, 1.)]})
+        with open(filename, 'a') as f:
+            f.write('{"globalTradeID": 3, "ti')
+        loaded = mftl.orders.OrderHistory(filename)
+        loaded.load()
+        assert loaded.marks() == {'BTC_ETH': 2}
+        assert loaded.merge({'BTC_ETH': [trade(3, 3.)]}) == 1
+        loaded.load()
+        assert len(loaded) == 3
+
+
+def order(gid, kind, amount, total, fee=0.):
+    return {'globalTradeID': gid, 'time': 1.6e9 + gid, 'type': kind,
+            'rate': total / amount, 'amount': amount, 'total': total,
+            'fee': fee}
+
+
+def test_cost_basis_fifo():
+    with tempfile.TemporaryDirectory() as directory:
+        orders = mftl.orders.OrderHistory(os.path.join(directory, 'o.jsonl'))
+        orders.merge({'BTC_ETH': [order(1, 'buy', 10., 1.),
+                                  order(2, 'buy', 10., 2.)]})
+        basis = mftl.orders.CostBasis()
+        assert basis.update(orders) == 2
+        assert basis.update(orders) == 0
+        assert basis.amount('BTC_ETH') == 20.
+        assert basis.cost('BTC_ETH') == 3.
+        # the newest coins are left over
+        assert basis.cost('BTC_ETH', 5.) == 1.
+
+        # sells consume the oldest lot first
+        orders.merge({'BTC_ETH': [order(3, 'sell', 15., 3.)],
+                      'BTC_XMR': [order(4, 'buy', 2., 1., fee=0.5)]})
+        assert basis.update(orders) == 2
+        assert basis.amount('BTC_ETH') == 5.
+        assert basis.cost('BTC_ETH') == 1.
+        assert basis.realized('BTC_ETH') == 1.
+        assert basis.amount('BTC_XMR') == 1.
+
+        valuation = basis.valuation({'BTC_ETH': 0.4, 'BTC_XMR': 3.})
+        assert valuation['market'].tolist() == ['BTC_ETH', 'BTC_XMR']
+        assert valuation['value'].tolist() == [2., 3.]
+        assert valuation['unrealized'].tolist() == [1., 2.]
+        assert valuation['realized'].tolist() == [1., 0.]
+
+        orders.merge({'BTC_ETH': [order(5, 'sell', 5., 1., fee=0.5)]})
+        basis.update(orders)
+        assert basis.amount('BTC_ETH') == 0. and basis.cost('BTC_ETH') == 0.
+        assert basis.realized('BTC_ETH') == 0.5
+
+        ledger = basis.ledger()
+        assert ledger.lots == {'BTC_ETH': (), 'BTC_XMR': ((1., 1.),)}
+        assert ledger.cost('BTC_XMR', 0.5) == 0.5
+        assert ledger.realized('BTC_ETH') == 0.5
+        assert ledger.valuation({'BTC_XMR': 3.}).tolist() == \
+            basis.valuation({'BTC_XMR': 3.}).tolist()
+        # later trades don't change a taken ledger
+        orders.merge({'BTC_XMR': [order(6, 'sell', 1., 2.)]})
+        basis.update(orders)
+        assert ledger.amount('BTC_XMR') == 1. and basis.amount('BTC_XMR') == 0.
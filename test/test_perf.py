@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+import json
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import mftl
+from mftl import perf
+
+import pytest
+
+
+@pytest.fixture
+def profiling():
+    perf.reset()
+    perf.enable()
+    yield
+    perf.enable(False)
+    perf.reset()
+
+
+def test_disabled():
+    perf.reset()
+    with perf.timer('x'):
+        perf.count('y')
+    assert perf.stats() == {'timers': {}, 'counters': {}}
+
+
+def test_timers_and_counters(profiling, tmp_path):
+    @perf.timed('stage')
+    def stage(n):
+        perf.count('items', n)
+        return n
+
+    assert [stage(i) for i in range(4)] == [0, 1, 2, 3]
+    with perf.timer('block', items=10):
+        pass
+    data = perf.stats()
+    assert data['timers']['stage']['calls'] == 4
+    assert data['timers']['block']['items'] == 10
+    assert data['counters'] == {'items': 6}
+
+    perf.export(str(tmp_path / 'p.json'))
+    assert json.load(open(str(tmp_path / 'p.json'))) == data
+    perf.export(str(tmp_path / 'p.csv'))
+    assert open(str(tmp_path / 'p.csv')).read().count('\n') == 4
+
+
+def test_pipeline_is_instrumented(profiling):
+    h = mftl.TradeHistory('BTC_XMR')
+    h._attach_data([{'globalTradeID': i, 'time': float(i), 'rate': 1.,
+                     'amount': 1., 'total': 1., 'type': 'buy'}
+                    for i in range(100)])
+    h.rate_buckets(10)
+    timers = perf.stats()['timers']
+    assert 'TradeHistory._attach_data' in timers
+    assert 'TradeHistory.rate_buckets' in timers
+    assert perf.stats()['counters']['trades.attached'] == 100
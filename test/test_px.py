@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+import time
+import json
+from datetime import datetime
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import mftl.px
+
+import pytest
+
+
+def response(n=3000):
+    # newest first like returnTradeHistory, crossing DST changes
+    start = 1490400000
+    return [{'globalTradeID': 1000 + n - i, 'tradeID': n - i,
+             'date': time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.gmtime(start - i * 3313)),
+             'type': 'buy' if i % 3 else 'sell',
+             'rate': '0.%08d' % (i + 1),
+             'amount': '0.0000001' if i % 17 == 0 else '%d.5' % i,
+             'total': '0.%08d' % (i + 5)}
+            for i in range(n)]
+
+
+def old_time(date):
+    return (time.mktime(datetime.strptime(
+        date, '%Y-%m-%d %H:%M:%S').timetuple()) - time.altzone)
+
+
+@pytest.mark.parametrize('tz', ('UTC', 'Europe/Berlin', 'America/New_York'))
+def test_decode_trade_history(tz, monkeypatch):
+    monkeypatch.setenv('TZ', tz)
+    time.tzset()
+    mftl.px._LOCAL_OFFSETS.clear()
+    try:
+        records = response()
+        expected = list(reversed([
+            {'time': old_time(r['date']), 'rate': float(r['rate']),
+             'amount': float(r['amount']), 'total': float(r['total']),
+             'globalTradeID': r['globalTradeID'], 'type': r['type']}
+            for r in records
+            if float(r['amount']) > 0.000001 and float(r['total']) > 0.000001]))
+        assert mftl.px.decode_trade_history(records).to_dicts() == expected
+        assert all(mftl.px.translate_dataset(r)['time'] == old_time(r['date'])
+                   for r in records[:500])
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+        mftl.px._LOCAL_OFFSETS.clear()
+
+
+def test_stream_trade_history():
+    records = response(10000)
+    document = json.dumps(records).encode()
+    chunks = [document[i:i + 5000] for i in range(0, len(document), 5000)]
+    trades, count = mftl.px.stream_trade_history(chunks, batch_size=999)
+    assert count == 10000
+    assert (trades.to_dicts() ==
+            mftl.px.decode_trade_history(records).to_dicts())
+    with pytest.raises(RuntimeError):
+        mftl.px.stream_trade_history([b'{"error": "Invalid currency pair."}'])
+
+
+class ErrorClient:
+    def __init__(self):
+        self.requests = 0
+
+    def fetch(self, request, consume):
+        self.requests += 1
+        return consume(iter([b'{"error": "Please do not make more ',
+                             b'than 6 API calls per second."}']))
+
+
+def test_trade_window_errors_are_not_cached(tmp_path, monkeypatch):
+    client = ErrorClient()
+    monkeypatch.setattr(mftl.util, 'HTTP_CLIENT', client)
+    monkeypatch.setattr(mftl.util, 'RESPONSE_CACHE',
+                        mftl.util.ResponseCache(str(tmp_path)))
+    monkeypatch.setattr(mftl.util, 'ALLOW_CACHED_VALUES', 'ALLOW')
+    for requests in (1, 2):
+        # a closed window would be cached forever
+        with pytest.raises(RuntimeError, match='6 API calls'):
+            mftl.px.PxApi.get_trade_window('BTC_XMR', 1e9, 1e9 + 3600)
+        assert client.requests == requests
+    assert not os.listdir(str(tmp_path))
+
+
+def test_nonce_sequencer():
+    sequencer = mftl.px.NonceSequencer()
+    nonces = [sequencer() for _ in range(1000)]
+    assert all(a < b for a, b in zip(nonces, nonces[1:]))
+    sequencer.skip(nonces[-1] + 10 ** 6)
+    assert sequencer() == nonces[-1] + 10 ** 6 + 1
+
+
+def test_private_requests_get_resent_on_nonce_errors(monkeypatch):
+    lock = mftl.px.threading.Lock()
+    # another client used nonces ahead of ours
+    last = [int(time.time() * 1000) + 10 ** 6]
+    sent = []
+
+    def fetch_http(request, request_data):
+        # requests arrive in any order, the server accepts increasing nonces
+        time.sleep(0.001 * (request_data['nonce'] % 3))
+        with lock:
+            sent.append(request_data['command'])
+            if request_data['nonce'] <= last[0]:
+                error = json.dumps({'error': (
+                    'Nonce must be greater than %d. You provided %d.' % (
+                        last[0], request_data['nonce']))}).encode()
+                if len(sent) % 2:
+                    return error.decode()
+                raise mftl.px.RequestRejected(422, error)
+            last[0] = request_data['nonce']
+        if request_data['command'] == 'returnBalances':
+            return json.dumps({'BTC': '1.5', 'XMR': '0.0'})
+        return json.dumps({'BTC_XMR': [], 'BTC_ETH': [
+            {'orderNumber': '1', 'type': 'buy', 'rate': '0.1',
+             'amount': '1', 'total': '0.1', 'date': '2017-06-01 00:00:00'}]})
+
+    monkeypatch.setattr(mftl.px, 'fetch_http', fetch_http)
+    api = mftl.px.PxApi('key', 'secret')
+    try:
+        results = api.in_parallel(*(
+            [api.get_balances, api.get_open_orders] * 10))
+    finally:
+        api.close()
+    assert results[0] == {'BTC': 1.5}
+    assert list(results[1]) == ['BTC_ETH']
+    assert results == [results[0], results[1]] * 10
+    assert len(sent) > 20
+
+
+def test_other_errors_are_raised(monkeypatch):
+    monkeypatch.setattr(mftl.px, 'fetch_http',
+                        lambda *_: json.dumps({'error': 'Invalid API key'}))
+    with pytest.raises(RuntimeError, match='Invalid API key'):
+        mftl.px.PxApi('key', 'secret').get_balances()
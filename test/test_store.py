@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+from mftl.store import TradeStore, load_store, save_store
+
+import numpy as np
+import pytest
+
+
+def trades(first, last):
+    return [{'globalTradeID': i, 'time': float(i), 'rate': 0.5,
+             'amount': 2., 'total': 1., 'type': 'buy' if i % 2 else 'sell'}
+            for i in range(first, last)]
+
+
+def test_trade_store_append_prepend():
+    s = TradeStore.from_dicts(trades(10, 20))
+    s.append(trades(20, 3000))
+    s.prepend(trades(0, 10))
+    assert len(s) == 3000
+    assert list(s.gid) == list(range(3000))
+    assert s[-1] == trades(2999, 3000)[0]
+    assert s[3:5].to_dicts() == trades(3, 5)
+    assert [d['type'] for d in s[:2]] == ['sell', 'buy']
+
+
+def test_trade_store_views_are_not_shared():
+    s = TradeStore.from_dicts(trades(0, 10))
+    tail = s[5:]
+    tail.truncate(2)
+    tail.append(trades(100, 103))
+    assert list(s.gid) == list(range(10))
+    assert list(tail.gid) == [5, 6, 100, 101, 102]
+    with pytest.raises(ValueError):
+        s.time[0] = 1.
+
+
+def test_trade_store_save_load(tmp_path):
+    directory = str(tmp_path / 'trade_history-BTC_XMR')
+    s = TradeStore.from_dicts(trades(0, 10))
+    save_store(s, directory)
+    s.append(trades(10, 15))
+    save_store(s, directory)
+    loaded = load_store(directory)
+    assert isinstance(loaded._cols['time'].base, np.memmap)
+    assert loaded.to_dicts() == trades(0, 15)
+
+    # older data forces a rewrite, data behind 'count' gets ignored
+    loaded.prepend(trades(-5, 0))
+    save_store(loaded, directory)
+    with open(os.path.join(directory, 'time.bin'), 'ab') as f:
+        f.write(b'garbage')
+    assert load_store(directory).to_dicts() == trades(-5, 15)
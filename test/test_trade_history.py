@@ -5,10 +5,12 @@
 # Disable the next check to allow fixtures.
 # pylint: disable=redefined-outer-name
 import os, sys
+import time
 sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
 import mftl
 from pprint import pprint
 
+import numpy as np
 import pytest
 
 #class myfix:
@@ -61,6 +63,127 @@ def test_trade_history_attach():
     pprint(h.data())
 
 
+def test_trade_history_journal(tmp_path):
+    def trades(first, last):
+        return [{'globalTradeID': i, 'time': float(i), 'rate': 1.,
+                 'amount': 1., 'total': 1., 'type': 'buy'}
+                for i in range(first, last)]
+
+    h = mftl.TradeHistory('BTC_XMR')
+    h._attach_data(trades(10, 20))
+    h.save(str(tmp_path))
+    h._attach_data(trades(18, 25))
+    h._attach_data(trades(5, 11))
+    h.save(str(tmp_path))
+    journal = tmp_path / 'trade_history-BTC_XMR' / 'journal.bin'
+    assert journal.stat().st_size > 0
+
+    # an interrupted save leaves a torn record which must be ignored
+    with open(str(journal), 'ab') as f:
+        f.write(b'MFTJA\0\0\0\x10')
+    h2 = mftl.TradeHistory('BTC_XMR')
+    h2.load(str(tmp_path))
+    assert h2.data().to_dicts() == trades(5, 25)
+
+    # the torn record got dropped so new records can be appended,
+    # compaction drops the journal
+    h2._attach_data(trades(24, 30))
+    h2.save(str(tmp_path))
+    h2.compact(str(tmp_path))
+    assert not journal.exists()
+    h3 = mftl.TradeHistory('BTC_XMR')
+    h3.load(str(tmp_path))
+    assert h3.data().to_dicts() == trades(5, 30)
+
+
+class FakeApi:
+    TRADE_HISTORY_LIMIT = 100
+
+    def __init__(self, trades):
+        self.trades = mftl.TradeStore.from_dicts(trades)
+        self.requests = []
+
+    def get_trade_window(self, market, start, end):
+        self.requests.append((start, end))
+        times = self.trades.time
+        first = int(np.searchsorted(times, start))
+        last = int(np.searchsorted(times, min(end, time.time()), 'right'))
+        first = max(first, last - self.TRADE_HISTORY_LIMIT)
+        return self.trades[first:last], last - first >= self.TRADE_HISTORY_LIMIT
+
+
+def test_trade_history_fill_gaps(tmp_path, monkeypatch):
+    trades = [{'globalTradeID': i, 'time': 1e6 + 10. * i, 'rate': 1.,
+               'amount': 1., 'total': 1., 'type': 'buy'}
+              for i in range(1000)]
+    api = FakeApi(trades)
+    h = mftl.TradeHistory('BTC_XMR', history_max_duration=9990)
+    h._attach_data(trades[:500])
+    monkeypatch.setattr(time, 'time', lambda: 1e6 + 9990.)
+
+    # the update gets truncated which leaves a gap
+    assert h.fetch_next(api=api)
+    assert h.last_time() == 1e6 + 9990.
+    assert h.gaps() == [(1e6 + 4990., 1e6 + 9000.)]
+    h.save(str(tmp_path))
+    h2 = mftl.TradeHistory('BTC_XMR', history_max_duration=9990)
+    h2.load(str(tmp_path))
+    assert h2.gaps() == h.gaps()
+
+    store_dir = h2._store_dir(str(tmp_path))
+    count = mftl.store.read_meta(store_dir)['count']
+    while h2.fetch_next(api=api):
+        assert len(api.requests) < 20
+    assert not h2.gaps()
+    assert h2.data().to_dicts() == trades
+    h2.save(str(tmp_path))
+    # the filled gap got journaled instead of rewriting the history
+    assert mftl.store.read_meta(store_dir)['count'] == count
+    assert mftl.store.journal_size(store_dir)
+    h3 = mftl.TradeHistory('BTC_XMR')
+    h3.load(str(tmp_path))
+    assert h3.data().to_dicts() == trades
+    assert not h3.gaps()
+
+
+def test_trade_history_big_gap_gets_split(monkeypatch):
+    trades = [{'globalTradeID': i, 'time': float(i), 'rate': 1.,
+               'amount': 1., 'total': 1., 'type': 'buy'}
+              for i in range(10000)]
+    api = FakeApi(trades)
+    monkeypatch.setattr(time, 'time', lambda: 10000.)
+    h = mftl.TradeHistory('BTC_XMR', step_size_sec=60,
+                          history_max_duration=20000)
+    h._attach_data(trades[:10] + trades[-10:], allow_gap=True)
+    h._gaps = [[9., 9990.]]
+    while h.gaps():
+        window = h._window_sec
+        assert h.fetch_next(api=api)
+        start, end = api.requests[-1]
+        assert end - start <= window
+    assert h.data().to_dicts() == trades
+    # windows grow to about TRADE_HISTORY_LIMIT / 2 trades
+    assert len(api.requests) < 200
+
+
+def test_trade_history_adaptive_window(monkeypatch):
+    # one trade per second - fixed one hour windows would be truncated
+    trades = [{'globalTradeID': i, 'time': float(i), 'rate': 1.,
+               'amount': 1., 'total': 1., 'type': 'buy'}
+              for i in range(100000)]
+    api = FakeApi(trades)
+    monkeypatch.setattr(time, 'time', lambda: 100000.)
+    h = mftl.TradeHistory('BTC_XMR', history_max_duration=5000)
+    while h.fetch_next(api=api):
+        pass
+    assert h.duration() >= 5000
+    assert h.data().to_dicts() == trades[-h.count():]
+    assert not h.gaps()
+    # the window shrinks to about TRADE_HISTORY_LIMIT / 2 trades
+    assert 25 <= h._window_sec <= 100
+    assert len(api.requests) < 150
+
+
 @pytest.mark.skip()
 def test_trade_history():
     h = mftl.TradeHistory('BTC_XMR', step_size_sec=60)
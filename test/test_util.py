@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+import os, sys
+import time
+import threading
+import json
+import http.server
+from urllib.request import Request
+from urllib.error import HTTPError
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import mftl.util
+
+import pytest
+
+
+def test_rate_limiter():
+    limiter = mftl.util.RateLimiter(rate=100, burst=5)
+    t1 = time.monotonic()
+    threads = [threading.Thread(target=lambda: [limiter.acquire()
+                                                for _ in range(10)])
+               for _ in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    # 5 requests at once, 35 more at 100/s
+    assert time.monotonic() - t1 == pytest.approx(0.35, abs=0.1)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def _respond(self, body):
+        Handler.connections.add(self.client_address)
+        if self.path.startswith('/missing'):
+            self.send_error(404)
+            return
+        if self.path.startswith(('/moved', '/loop')):
+            self.send_response(302 if self.path == '/loop' else 301)
+            self.send_header('Location', '/loop' if self.path == '/loop' else
+                             '/target' + self.path[len('/moved'):])
+            self.send_header('Content-Length', '5')
+            self.end_headers()
+            self.wfile.write(b'moved')
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond(('{"path": "%s"}' % self.path).encode())
+
+    def do_POST(self):
+        self._respond(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.connections = set()
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_http_client_keeps_connections(server):
+    client = mftl.util.HttpClient(pool_size=2, timeout=5)
+    for i in range(5):
+        assert client.fetch(server + '/?n=%d' % i) == (
+            ('{"path": "/?n=%d"}' % i).encode())
+    assert client.fetch(Request(server + '/', data=b'a=1')) == b'a=1'
+    assert len(Handler.connections) == 1
+    with pytest.raises(HTTPError):
+        client.fetch(server + '/missing')
+
+
+def test_http_client_follows_redirects(server, tmp_path, monkeypatch):
+    client = mftl.util.HttpClient(pool_size=2, timeout=5)
+    assert client.fetch(server + '/moved?a=1') == b'{"path": "/target?a=1"}'
+    assert client.fetch(server + '/moved', b''.join) == b'{"path": "/target"}'
+    with pytest.raises(HTTPError):
+        client.fetch(server + '/loop')
+    assert len(Handler.connections) == 1
+
+    # redirects don't end up in the cache as response
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mftl.util, 'RESPONSE_CACHE',
+                        mftl.util.ResponseCache('cache'))
+    monkeypatch.setattr(mftl.util, 'HTTP_CLIENT', client)
+    monkeypatch.setattr(mftl.util, 'ALLOW_CACHED_VALUES', 'NEVER')
+    assert mftl.util.fetch_http(
+        server + '/moved', {'command': 'moved'}) == '{"path": "/target"}'
+    with pytest.raises(mftl.util.ServerError):
+        mftl.util.fetch_http(server + '/loop', {'command': 'loop'})
+    monkeypatch.setattr(mftl.util, 'ALLOW_CACHED_VALUES', 'FORCE')
+    assert mftl.util.fetch_http(
+        server + '/moved', {'command': 'moved'}) == '{"path": "/target"}'
+    with pytest.raises(mftl.util.ServerError):
+        mftl.util.fetch_http(server + '/loop', {'command': 'loop'})
+
+
+def test_fetch_http_uses_pool(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mftl.util, 'ALLOW_CACHED_VALUES', 'NEVER')
+    for _ in range(3):
+        assert mftl.util.fetch_http(
+            server + '/ticker', {'command': 'ticker'}) == '{"path": "/ticker"}'
+    assert len(Handler.connections) == 1
+    # client errors don't fall back to cached data and keep the body
+    monkeypatch.setattr(mftl.util, 'ALLOW_CACHED_VALUES', 'ALLOW')
+    with pytest.raises(mftl.util.RequestRejected) as info:
+        mftl.util.fetch_http(server + '/missing', {'command': 'missing'})
+    assert info.value.status == 404 and info.value.body
+
+
+def test_request_key_and_ttl():
+    key = mftl.util.request_key
+    assert (key('http://a/x?a=1', {'start': 1, 'end': 2}) !=
+            key('http://a/x?a=2', {'start': 1, 'end': 3}))
+    assert (key('http://a/x', {'command': 'c', 'nonce': 1}) ==
+            key('http://a/x', {'command': 'c', 'nonce': 2}))
+    ttl = mftl.util.cache_ttl
+    assert ttl({'command': 'returnTicker'}) == 10
+    assert ttl({'command': 'returnTradeHistory', 'end': 1000}, now=5000) is None
+    assert ttl({'command': 'returnTradeHistory', 'end': 4900}, now=5000) == 30
+    assert ttl({'command': 'returnBalances', 'nonce': 1}) == 0
+
+
+def test_response_cache(tmp_path):
+    cache = mftl.util.ResponseCache(
+        str(tmp_path), max_size=1000, memory_size=400)
+    cache.put('a', b'a' * 300)
+    cache.put('b', b'b' * 300)
+    assert cache.get('a') == b'a' * 300
+    assert cache.get('a', max_age=0) is None
+    cache.clear_memory()
+    assert cache.get('b') == b'b' * 300
+    os.utime(str(tmp_path / 'a.cache'), (1, 1))
+    cache.put('c', b'c' * 500)
+    # 'a' has been used least recently
+    assert cache.get('a') is None
+    assert cache.get('b') == b'b' * 300
+    assert cache.get('c') == b'c' * 500
+
+
+def test_fetch_http_cache_policy(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mftl.util, 'RESPONSE_CACHE',
+                        mftl.util.ResponseCache('cache'))
+    monkeypatch.setattr(mftl.util, 'ALLOW_CACHED_VALUES', 'ALLOW')
+    window = {'command': 'returnTradeHistory', 'start': 1, 'end': 2}
+    url = server + '/?start=1&end=2'
+    assert mftl.util.fetch_http(url, window) == '{"path": "/?start=1&end=2"}'
+    assert len(Handler.connections) == 1
+    Handler.connections.clear()
+    # closed windows are served from cache, other windows are not
+    assert mftl.util.fetch_http(url, window) == '{"path": "/?start=1&end=2"}'
+    assert not Handler.connections
+    with pytest.raises(mftl.util.ServerError):
+        monkeypatch.setattr(mftl.util, 'ALLOW_CACHED_VALUES', 'FORCE')
+        mftl.util.fetch_http(url, {**window, 'end': 3})
+
+
+def test_iter_json_array():
+    document = json.dumps([{'a': 'ä' * 10, 'b': [1, 2.5]}, 123456, 'x', None,
+                           [], {}]).encode()
+    for size in (1, 3, 1000):
+        chunks = [document[i:i + size] for i in range(0, len(document), size)]
+        assert list(mftl.util.iter_json_array(chunks)) == json.loads(document)
+    assert list(mftl.util.iter_json_array([b' [ ] '])) == []
+    with pytest.raises(mftl.util.NotAnArray) as exc:
+        list(mftl.util.iter_json_array([b'{"err', b'or": "x"}']))
+    assert exc.value.value == {'error': 'x'}
+    with pytest.raises(ValueError):
+        list(mftl.util.iter_json_array([b'[1, 2']))
+
+
+def test_fetch_http_stream(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mftl.util, 'RESPONSE_CACHE',
+                        mftl.util.ResponseCache('cache'))
+    monkeypatch.setattr(mftl.util, 'ALLOW_CACHED_VALUES', 'ALLOW')
+    body = json.dumps(list(range(100000))).encode()
+    window = {'command': 'returnTradeHistory', 'start': 1, 'end': 2}
+    for _ in range(2):
+        Handler.connections.clear()
+        assert mftl.util.fetch_http_stream(
+            Request(server + '/', data=body), window,
+            lambda c: list(mftl.util.iter_json_array(c))) == list(range(100000))
+    # the second response came from the cache
+    assert not Handler.connections
+    assert mftl.util.fetch_http(
+        Request(server + '/', data=body), window) == body.decode()
+
+
+def test_failed_responses_are_not_cached(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mftl.util, 'RESPONSE_CACHE',
+                        mftl.util.ResponseCache('cache'))
+    monkeypatch.setattr(mftl.util, 'ALLOW_CACHED_VALUES', 'ALLOW')
+    error = b'{"error": "Please do not make more than 6 API calls per second."}'
+    window = {'command': 'returnTradeHistory', 'start': 1, 'end': 2}
+    for _ in range(2):
+        Handler.connections.clear()
+        assert mftl.util.fetch_http(
+            Request(server + '/', data=error), window) == error.decode()
+        assert Handler.connections
+        # the streaming consumer rejects it as well
+        Handler.connections.clear()
+        with pytest.raises(mftl.util.NotAnArray):
+            mftl.util.fetch_http_stream(
+                Request(server + '/', data=error), window,
+                lambda c: list(mftl.util.iter_json_array(c)))
+        assert Handler.connections
+    # a consumer failing on a valid looking response leaves no entry either
+    with pytest.raises(ValueError):
+        mftl.util.fetch_http_stream(
+            Request(server + '/', data=b'[1, 2]'), window,
+            lambda c: int(b''.join(c)))
+    assert not os.listdir('cache')
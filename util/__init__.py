@@ -1,10 +1,19 @@
 from urllib.request import (
     urlopen, Request, ProxyHandler, build_opener, install_opener,
     CacheFTPHandler)
-from urllib.error import URLError
+from urllib.error import URLError, HTTPError
+from urllib.parse import urlsplit, urljoin
+from queue import LifoQueue, Empty
 import socket
+import codecs
+import io
+import json
 import http
+import http.client
 import time
+import hashlib
+import threading
+from collections import OrderedDict
 import logging as log
 import os
 try:
@@ -12,7 +21,10 @@ try:
 except ImportError:
     import json_mod
 
-__all__ = ['set_proxies', 'fetch_http', 'get_EUR']
+from .. import perf
+
+__all__ = ['set_proxies', 'set_request_rate', 'set_http_options',
+           'fetch_http', 'fetch_http_stream', 'iter_json_array', 'get_EUR']
 
 ALLOW_CACHED_VALUES = 'ALLOW'  # 'NEVER', 'FORCE'
 
@@ -20,47 +32,570 @@ class ServerError(RuntimeError):
     pass
 
 
+class RequestRejected(ServerError):
+    ''' the server answered with a client error (4xx) - @body might explain
+        why (e.g. an outdated nonce) '''
+    def __init__(self, status, body):
+        super().__init__('request rejected (%d): %r' % (status, body[:200]))
+        self.status = status
+        self.body = body
+
+
+class NotAnArray(ValueError):
+    ''' raised by iter_json_array() for documents which are no arrays '''
+    def __init__(self, value):
+        super().__init__('JSON document is not an array')
+        self.value = value
+
+
+class RateLimiter:
+    ''' token bucket: allows @rate requests per second on average and up to
+        @burst requests at once - shared by all threads '''
+    def __init__(self, rate, burst=1):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst=1):
+        with self._lock:
+            self._rate = float(rate)
+            self._burst = float(max(burst, 1))
+            self._tokens = self._burst
+            self._last = time.monotonic()
+
+    def acquire(self):
+        ''' blocks until a request may be sent '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._burst, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1.:
+                    self._tokens -= 1.
+                    return
+                wait = (1. - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+# the exchange allows 6 requests per second - stay a bit below
+REQUEST_LIMITER = RateLimiter(rate=5, burst=5)
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _chunks(response):
+    return iter(lambda: response.read(CHUNK_SIZE), b'')
+
+
+class ConnectionPool:
+    ''' keeps up to @size keep-alive connections to one host '''
+    def __init__(self, scheme, host, port, *, size, timeout):
+        self._connection_class = (http.client.HTTPSConnection
+                                  if scheme == 'https' else
+                                  http.client.HTTPConnection)
+        self._host, self._port = host, port
+        self._timeout = timeout
+        self._idle = LifoQueue(maxsize=size)
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _get(self):
+        try:
+            return self._idle.get_nowait(), True
+        except Empty:
+            return self._connection_class(
+                self._host, self._port, timeout=self._timeout), False
+
+    def request(self, method, path, body=None, headers=None,
+                consume=None) -> tuple:
+        ''' returns status, reason, headers and body of the response - with
+            @consume given the body is what @consume returns for an
+            iterator over the chunks of the (successful, 2xx) response '''
+        with self._slots:
+            connection, reused = self._get()
+            try:
+                try:
+                    connection.request(method, path, body, headers or {})
+                    response = connection.getresponse()
+                except (http.client.RemoteDisconnected,
+                        ConnectionResetError, BrokenPipeError):
+                    if not reused:
+                        raise
+                    # the server closed the idle connection - retry once
+                    connection.close()
+                    connection, reused = self._connection_class(
+                        self._host, self._port, timeout=self._timeout), False
+                    connection.request(method, path, body, headers or {})
+                    response = connection.getresponse()
+                data = (consume(_chunks(response))
+                        if consume and response.status < 300 else
+                        response.read())
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close or not response.isclosed():
+                connection.close()
+            else:
+                self._idle.put_nowait(connection)
+            return response.status, response.reason, response.headers, data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                return
+
+
+class HttpClient:
+    ''' fetches urllib Requests (or urls) using one ConnectionPool per host
+        so requests to the same host don't have to connect (and handshake)
+        again '''
+    REDIRECTS = {301, 302, 303, 307, 308}
+    MAX_REDIRECTS = 5
+
+    def __init__(self, pool_size=4, timeout=15):
+        self._lock = threading.Lock()
+        self._pools = {}
+        self.configure(pool_size, timeout)
+
+    def configure(self, pool_size=None, timeout=None):
+        with self._lock:
+            if pool_size is not None:
+                self._pool_size = pool_size
+            if timeout is not None:
+                self._timeout = timeout
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.close()
+
+    def _pool(self, scheme, host, port):
+        key = scheme, host, port
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(
+                    scheme, host, port,
+                    size=self._pool_size, timeout=self._timeout)
+            return self._pools[key]
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    def fetch(self, request, consume=None) -> bytes:
+        ''' returns the body of @request (or what @consume returns for the
+            chunks of the body) and raises URLError (HTTPError) like
+            urlopen() does - redirects get followed like urlopen() does '''
+        if isinstance(request, str):
+            request = Request(request)
+        url, method, body = request.full_url, request.get_method(), request.data
+        headers = dict(request.header_items())
+        for _ in range(self.MAX_REDIRECTS + 1):
+            status, reason, response_headers, data = self._send(
+                url, method, body, headers, consume)
+            location = response_headers.get('Location')
+            if status not in self.REDIRECTS or not location:
+                break
+            url = urljoin(url, location)
+            if status == 303 or (status in {301, 302} and method == 'POST'):
+                # like browsers and urlopen() do
+                method, body = 'GET', None
+                headers = {k: v for k, v in headers.items()
+                           if k.lower() not in {'content-type',
+                                                'content-length'}}
+        else:
+            raise HTTPError(url, status, 'too many redirects',
+                            response_headers, None)
+        if status >= 300:
+            raise HTTPError(url, status, reason,
+                            response_headers, io.BytesIO(data))
+        return data
+
+    def _send(self, url, method, body, headers, consume) -> tuple:
+        url = urlsplit(url)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        if body is not None:
+            headers = {'Content-type': 'application/x-www-form-urlencoded',
+                       **headers}
+        try:
+            return self._pool(url.scheme, url.hostname, url.port).request(
+                method, path, body, headers, consume)
+        except socket.timeout:
+            raise
+        except (OSError, http.client.HTTPException) as exc:
+            if isinstance(exc, http.client.IncompleteRead):
+                raise
+            raise URLError(exc) from exc
+
+
+HTTP_CLIENT = HttpClient()
+_PROXIES = None
+
+
+def set_http_options(pool_size=None, timeout=None):
+    ''' configures the number of connections per host and the timeout '''
+    HTTP_CLIENT.configure(pool_size, timeout)
+
+
 def set_proxies(proxies):
+    global _PROXIES
+    _PROXIES = proxies
     install_opener(build_opener(ProxyHandler(proxies), CacheFTPHandler))
 
 
-def get_unique_name(data: dict) -> str:
-    ''' turn dict into unambiguous string '''
-    return ('.'.join('%s=%s' % (
-        k, 'xxx' if k in {'start', 'end', 'nonce'} else v)
-                     for k, v in sorted(data.items()))
-            .replace(',', '_')
-            .replace('/', '_')
-            .translate(dict.fromkeys(map(ord, u"\"'[]{}() "))))
+def set_request_rate(rate, burst=1):
+    ''' configures how many requests per second fetch_http() may send '''
+    REQUEST_LIMITER.configure(rate, burst)
+
+
+def request_key(request, request_data: dict) -> str:
+    ''' returns a hash over url and all parameters of a request except
+        'nonce' which differs for every private request '''
+    url = request if isinstance(request, str) else request.full_url
+    url = urlsplit(url)
+    canonical = '%s://%s%s?%s' % (
+        url.scheme, url.netloc, url.path,
+        '&'.join('%s=%s' % (k, v) for k, v in sorted(request_data.items())
+                 if k != 'nonce'))
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def cache_ttl(request_data: dict, now=None) -> float:
+    ''' returns how long (seconds) a response may be served from cache,
+        None meaning forever '''
+    if 'nonce' in request_data:
+        # private data - only used as fallback
+        return 0
+    command = request_data.get('command')
+    if command == 'returnTicker':
+        return 10
+    if command == 'returnTradeHistory' and 'end' in request_data:
+        # trades of a window which is over won't change anymore
+        closed = float(request_data['end']) < (now or time.time()) - 300
+        return None if closed else 30
+    return 60
+
 
+class ResponseCache:
+    ''' Responses stored in files named by their request_key() in
+        @directory, limited to @max_size bytes by evicting the least
+        recently used ones. A LRU memory tier of @memory_size bytes sits in
+        front. A file's mtime is the time it has been stored, its atime the
+        time it has been used last.
+    '''
+    def __init__(self, directory='cache', *,
+                 max_size=512 * 1024**2, memory_size=32 * 1024**2):
+        self._directory = directory
+        self._max_size = max_size
+        self._memory_size = memory_size
+        self._memory = OrderedDict()   # key -> (stored, data)
+        self._memory_used = 0
+        self._disk_used = None         # determined on first put()
+        self._lock = threading.Lock()
 
-def fetch_http(request, request_data):
+    def _filename(self, key):
+        return os.path.join(self._directory, key + '.cache')
+
+    def get(self, key, max_age=None) -> bytes:
+        ''' returns the data stored for @key if it is not older than
+            @max_age seconds (None: any age) or None '''
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is None:
+            filename = self._filename(key)
+            try:
+                stored = os.stat(filename).st_mtime
+                with open(filename, 'rb') as file:
+                    entry = stored, file.read()
+                os.utime(filename, (now, stored))
+            except FileNotFoundError:
+                return None
+            self._remember(key, *entry)
+        stored, data = entry
+        if max_age is not None and now - stored > max_age:
+            return None
+        return data
+
+    def put(self, key, data: bytes):
+        now = time.time()
+        filename = self._filename(key)
+        os.makedirs(self._directory, exist_ok=True)
+        try:
+            old_size = os.stat(filename).st_size
+        except FileNotFoundError:
+            old_size = 0
+        with open(filename + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(filename + '.tmp', filename)
+        self._remember(key, now, data)
+        self._account(len(data) - old_size)
+
+    def chunks(self, key, max_age=None):
+        ''' like get() but returns an iterator over chunks of the data
+            which doesn't get loaded into the memory tier '''
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is not None:
+            data = self.get(key, max_age)
+            return None if data is None else iter([data])
+        filename = self._filename(key)
+        now = time.time()
+        try:
+            stored = os.stat(filename).st_mtime
+            if max_age is not None and now - stored > max_age:
+                return None
+            file = open(filename, 'rb')
+            os.utime(filename, (now, stored))
+        except FileNotFoundError:
+            return None
+
+        def read():
+            with file:
+                yield from iter(lambda: file.read(CHUNK_SIZE), b'')
+        return read()
+
+    def put_chunks(self, key, chunks) -> '_PendingEntry':
+        ''' returns an iterator passing through @chunks while writing them
+            to a temporary file - the entry gets stored only if commit() is
+            called after all chunks have been read '''
+        return _PendingEntry(self, key, chunks)
+
+    def _commit(self, key, tmp_filename, size):
+        filename = self._filename(key)
+        try:
+            old_size = os.stat(filename).st_size
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp_filename, filename)
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry:
+                self._memory_used -= len(entry[1])
+        self._account(size - old_size)
+
+    def _account(self, delta):
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = sum(e.stat().st_size for e in self._entries())
+            else:
+                self._disk_used += delta
+            evict = self._disk_used > self._max_size
+        if evict:
+            self._evict()
+
+    def _remember(self, key, stored, data):
+        if len(data) > self._memory_size // 4: return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old:
+                self._memory_used -= len(old[1])
+            self._memory[key] = stored, data
+            self._memory_used += len(data)
+            while self._memory_used > self._memory_size:
+                _, (_, dropped) = self._memory.popitem(last=False)
+                self._memory_used -= len(dropped)
+
+    def _entries(self):
+        return (e for e in os.scandir(self._directory)
+                if e.name.endswith('.cache'))
+
+    def _evict(self):
+        ''' removes least recently used files down to 90% of max_size '''
+        entries = sorted(((e.stat().st_atime, e.stat().st_size, e.path)
+                          for e in self._entries()))
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if used <= self._max_size * 0.9: break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+            with self._lock:
+                key = os.path.basename(path)[:-len('.cache')]
+                entry = self._memory.pop(key, None)
+                if entry:
+                    self._memory_used -= len(entry[1])
+        with self._lock:
+            self._disk_used = used
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+
+
+# responses starting like this report a failure and must not be cached
+_ERROR_PREFIX = b'{"error"'
+
+
+class _PendingEntry:
+    ''' cache entry being written by ResponseCache.put_chunks() '''
+    def __init__(self, cache, key, chunks):
+        self._cache = cache
+        self._key = key
+        self._chunks = chunks
+        self._tmp_filename = cache._filename(key) + '.%d.tmp' % id(self)
+        self._size = 0
+        self._head = b''
+        self._complete = False
+
+    def __iter__(self):
+        os.makedirs(self._cache._directory, exist_ok=True)
+        with open(self._tmp_filename, 'wb') as file:
+            for chunk in self._chunks:
+                file.write(chunk)
+                self._size += len(chunk)
+                if len(self._head) < len(_ERROR_PREFIX):
+                    self._head = (self._head + chunk).lstrip()
+                yield chunk
+        self._complete = True
+
+    def commit(self):
+        ''' stores the entry if it has been read completely and doesn't
+            look like an error report - discards it otherwise '''
+        if not self._complete or self._head.startswith(_ERROR_PREFIX):
+            self.discard()
+            return
+        self._cache._commit(self._key, self._tmp_filename, self._size)
+
+    def discard(self):
+        try:
+            os.remove(self._tmp_filename)
+        except FileNotFoundError:
+            pass
+
+
+RESPONSE_CACHE = ResponseCache('cache')
+_JSON_DECODER = json.JSONDecoder()
+
+
+@perf.timed('fetch_http')
+def fetch_http_stream(request, request_data, consume):
+    ''' returns what @consume returns for an iterator over the chunks of the
+        response body for @request. Depending on ALLOW_CACHED_VALUES cached
+        responses are used
+          'NEVER': never (but responses still get stored)
+          'ALLOW': if they are fresh (see cache_ttl()) or the request fails
+          'FORCE': always, without sending a request
+        @consume may get called twice (for the response and for cached
+        data as fallback) so it must not keep state between calls.
+    '''
     assert ALLOW_CACHED_VALUES in {'NEVER', 'ALLOW', 'FORCE'}
     log.debug('caching policy: %r', ALLOW_CACHED_VALUES)
     log.debug('XXXX fetch %r', request_data)
-    os.makedirs('cache', exist_ok=True)
-    filename = os.path.join('cache', get_unique_name(request_data) + '.cache')
+    key = request_key(request, request_data)
+    if ALLOW_CACHED_VALUES == 'ALLOW':
+        max_age = cache_ttl(request_data)
+        cached = RESPONSE_CACHE.chunks(key, max_age) if max_age != 0 else None
+        if cached is not None:
+            perf.count('fetch_http.cache_hits')
+            return consume(cached)
+
+    def consume_and_store(chunks):
+        # only responses @consume accepted get stored
+        entry = RESPONSE_CACHE.put_chunks(key, chunks)
+        try:
+            result = consume(entry)
+        except BaseException:
+            entry.discard()
+            raise
+        entry.commit()
+        return result
+
     if ALLOW_CACHED_VALUES in {'NEVER', 'ALLOW'}:
         try:
-            time.sleep(0.2)
-            #t1 = time.time()
-            result = urlopen(request, timeout=15).read()
-            #log.info('fetched in %6.2fs: %r', time.time() - t1, request_data)
+            with perf.timer('fetch_http.rate_limit'):
+                REQUEST_LIMITER.acquire()
+            perf.count('fetch_http.requests')
+            if _PROXIES:
+                with urlopen(request, timeout=HTTP_CLIENT.timeout) as response:
+                    return consume_and_store(
+                        iter(lambda: response.read(CHUNK_SIZE), b''))
+            return HTTP_CLIENT.fetch(request, consume_and_store)
         except (http.client.IncompleteRead, socket.timeout) as exc:
             raise ServerError(repr(exc))
+        except HTTPError as exc:
+            # the request itself is wrong - cached data won't help (unless
+            # there have been too many requests)
+            if 400 <= exc.code < 500 and exc.code != 429:
+                raise RequestRejected(exc.code, exc.read() if exc.fp else b'')
+            if ALLOW_CACHED_VALUES == 'NEVER':
+                raise ServerError(repr(exc)) from exc
         except URLError as exc:
             if ALLOW_CACHED_VALUES == 'NEVER':
                 raise ServerError(repr(exc)) from exc
-        else:
-            with open(filename, 'wb') as file:
-                file.write(result)
-            return result.decode()
-    try:
-        with open(filename, 'rb') as file:
-            log.warning('use chached values for %r', request)
-            return file.read().decode()
-    except FileNotFoundError as exc:
-        raise ServerError('could not load cached file %r' % exc.filename) from exc
+    cached = RESPONSE_CACHE.chunks(key)
+    if cached is None:
+        raise ServerError('no cached response for %r' % request_data)
+    log.warning('use chached values for %r', request)
+    return consume(cached)
+
+
+def fetch_http(request, request_data) -> str:
+    ''' returns the response body for @request as string, see
+        fetch_http_stream() for caching '''
+    return fetch_http_stream(request, request_data, b''.join).decode()
+
+
+def iter_json_array(chunks):
+    ''' yields the elements of a JSON array read from @chunks (bytes)
+        without holding more than an element and a chunk in memory. If the
+        document is not an array NotAnArray gets raised carrying it. '''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer, pos, eof = '', 0, False
+
+    def more():
+        nonlocal buffer, pos, eof
+        chunk = next(chunks, None)
+        eof = chunk is None
+        buffer = buffer[pos:] + decoder.decode(chunk or b'', final=eof)
+        pos = 0
+
+    def next_char():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buffer): return buffer[pos]
+            if eof: return ''
+            more()
+
+    if next_char() != '[':
+        while not eof:
+            more()
+        raise NotAnArray(json.loads(buffer[pos:]))
+    pos += 1
+    empty = next_char() == ']'
+    pos += empty
+    while not empty:
+        try:
+            value, end = _JSON_DECODER.raw_decode(buffer, pos)
+        except ValueError:
+            if eof: raise
+            more()
+            continue
+        if end == len(buffer) and not eof:
+            # a number might continue in the next chunk
+            more()
+            continue
+        pos = end
+        yield value
+        separator = next_char()
+        pos += 1
+        if separator == ']': break
+        if separator != ',':
+            raise ValueError('invalid JSON array: %r' % separator)
+        next_char()
+    # read up to the end so streams get completed (and cached)
+    if next_char():
+        raise ValueError('extra data after JSON array')
 
 
 def get_EUR():